@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+"""録画済みプレゼンテーションからのスライド一括抽出 (GUIなし)
+
+使い方:
+    python main.py batch 入力1.mp4 入力2.mp4 フレームフォルダ/ -o 出力フォルダ
+    python batch.py --input-list inputs.txt -o 出力フォルダ --workers 8
+
+入力ごとに 出力フォルダ/<入力名>/ へスライドを保存する。完了した入力には
+完了マーカー (_done.json) を書き込み、中断後に同じコマンドを再実行すると
+完了済みの入力はスキップする。未完了の入力は、前回のスライドインデックスと
+ジャーナルを削除して最初からやり直す (前回保存したスライドを既出として扱わない)。
+保存ファイル名は動画内の位置から決まるため、同じファイルが上書きされるだけになる。
+判定と保存は GUI と同じ CaptureSession で行う (スライドインデックスによる
+既出スライドの照合、領域指定、安定確認も共通)。保存はセッションジャーナル
+経由で確定するため、中断時に書きかけのファイルが残ることはない。
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import cv2
+
+from encoders import create_encoder
+from fingerprint import create_engine
+from frame_pool import FramePool
+from frame_source import create_frame_source
+from journal import JOURNAL_FILENAME, recover
+from metrics import CaptureMetrics
+from regions import parse_regions
+from save_pipeline import POLICY_BLOCK
+from session import CaptureSession, SessionError
+from slide_index import INDEX_FILENAME
+
+logger = logging.getLogger(__name__)
+
+DONE_MARKER = "_done.json"
+SUMMARY_FILENAME = "batch_summary.json"
+log_format = "%(asctime)s - %(levelname)s - %(processName)s - %(message)s"
+
+
+def output_dir_names(inputs):
+    """入力ごとの出力サブフォルダ名 (入力名の重複時は連番を付ける)"""
+    names = []
+    used = set()
+    for path in inputs:
+        base = os.path.splitext(os.path.basename(os.path.normpath(path)))[0] or "input"
+        name = base
+        suffix = 2
+        while name in used:
+            name = f"{base}_{suffix}"
+            suffix += 1
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def _init_worker(log_level):
+    """ワーカープロセスの初期化"""
+    # プロセス並列で全コアを使うため、OpenCV内部のスレッド並列は無効にする
+    cv2.setNumThreads(1)
+    logging.basicConfig(level=log_level, format=log_format)
+
+
+def empty_result(input_path, output_dir, worker=None, error=None):
+    """1つの入力の結果の初期値 (ワーカーから結果を受け取れなかった入力にも使う)"""
+    return {
+        "input": input_path,
+        "output": output_dir,
+        "worker": worker,
+        "frames": 0,
+        "slides": 0,
+        "repeats": 0,
+        "bytes": 0,
+        "seconds": 0.0,
+        "fps": 0.0,
+        "error": error,
+    }
+
+
+def extract_slides(
+    input_path,
+    output_dir,
+    sample_interval=1.0,
+    engine_name="fingerprint",
+    encoder_spec="png:3",
+    stable_ticks=0,
+    regions="",
+):
+    """1つの入力からスライドを抽出して output_dir に保存し、結果を辞書で返す
+
+    判定と保存は GUI と同じ CaptureSession で行う (領域ごとの比較、安定確認、
+    スライドインデックスによる既出スライドの照合、ジャーナル経由の保存)。
+    """
+    result = empty_result(input_path, output_dir, worker=os.getpid())
+    start = time.perf_counter()
+    session = CaptureSession(
+        os.path.basename(os.path.normpath(output_dir)),
+        output_dir,
+        regions=regions,
+        source=input_path,
+        encoder=encoder_spec,
+        engine=engine_name,
+        stable_ticks=stable_ticks,
+    )
+    session.save_workers = 1
+    session.save_queue_size = 4
+    session.save_policy = POLICY_BLOCK
+    session.retro_seconds = 0.0  # さかのぼり保存は使わない
+    # 再生は実時間より速いため、保存を確定させてから次のサンプルを既出スライドと照合する
+    session.sync_saves = True
+    try:
+        # 完了マーカーのない (未完了の) 入力の前回の記録は使わない
+        reset_unfinished(output_dir)
+        session.validate()
+        # デコード先のバッファを使い回す (保存待ちのフレームの分だけ増える)
+        pool = FramePool()
+        with create_frame_source(
+            input_path,
+            session.regions,
+            sample_interval=sample_interval,
+            metrics=CaptureMetrics(),
+            pool=pool,
+        ) as source:
+            session.open()
+            session.begin(source.description or input_path)
+            try:
+                while True:
+                    frames = source.read()
+                    if frames is None:
+                        if source.finished:
+                            break
+                        continue
+                    session.process(frames, source.timestamp_label())
+                    frames = None  # 保存待ちでなければバッファをプールへ戻す
+            finally:
+                session.close()
+            result["frames"] = source.frames_read
+        result["slides"] = session.saved_count
+        result["repeats"] = session.metrics.counters["repeats"]
+        result["bytes"] = session.save_pool.total_bytes
+        # 段階ごとの処理時間 (p50/p95/p99)
+        result["stages"] = session.metrics.snapshot()["stages"]
+        if session.save_pool.failed_count:
+            result["error"] = f"{session.save_pool.failed_count} 枚の保存に失敗しました"
+        elif session.error_occurred:
+            result["error"] = "処理中にエラーが発生しました (ログを確認してください)"
+    except SessionError as e:
+        logger.error(f"エラー (一括抽出): {e.title}: {e}\n - 入力: {input_path}")
+        result["error"] = f"{e.title}: {e}"
+    except Exception as e:
+        logger.exception(
+            f"エラー (一括抽出): {type(e).__name__}: {e}\n - 入力: {input_path}"
+        )
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = time.perf_counter() - start
+    if result["seconds"] > 0:
+        result["fps"] = result["frames"] / result["seconds"]
+
+    if result["error"] is None:
+        # 完了マーカー (再実行時にこの入力をスキップする)
+        # 書きかけのマーカーが残らないよう、一時ファイルに書いてから置き換える
+        marker = os.path.join(output_dir, DONE_MARKER)
+        with open(marker + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        os.replace(marker + ".tmp", marker)
+    return result
+
+
+def reset_unfinished(output_dir):
+    """前回の未完了の実行が残したスライドインデックスとジャーナルを削除する
+
+    残したままだと、前回保存したスライドが今回は既出として扱われて保存されず、
+    最初から実行した場合と結果が変わる。書きかけの一時ファイルは先に片付ける。
+    """
+    if not os.path.isdir(output_dir):
+        return
+    recover(output_dir)
+    paths = [os.path.join(output_dir, JOURNAL_FILENAME), os.path.join(output_dir, INDEX_FILENAME)]
+    # 領域ごとのサブフォルダのインデックス
+    for entry in os.scandir(output_dir):
+        if entry.is_dir():
+            paths.append(os.path.join(entry.path, INDEX_FILENAME))
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+            logger.info(f"未完了の前回の記録を削除しました: {path}")
+
+
+def read_input_list(path):
+    """1行1入力のリストファイルを読む (空行と # で始まる行は無視)"""
+    with open(path, encoding="utf-8") as f:
+        return [
+            line.strip() for line in f if line.strip() and not line.startswith("#")
+        ]
+
+
+def load_done(output_dir):
+    """完了マーカーがあれば前回の結果を返す"""
+    marker = os.path.join(output_dir, DONE_MARKER)
+    if not os.path.exists(marker):
+        return None
+    try:
+        with open(marker, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logger.warning(f"警告: 完了マーカーを読み込めないため再処理します: {marker}")
+        return None
+
+
+def run_batch(
+    inputs,
+    output_root,
+    workers=None,
+    sample_interval=1.0,
+    engine_name="fingerprint",
+    encoder_spec="png:3",
+    stable_ticks=0,
+    regions="",
+):
+    """入力をプロセスプールで並列処理し、集計結果を返す"""
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(output_root, exist_ok=True)
+    jobs = []
+    results = []
+    for path, name in zip(inputs, output_dir_names(inputs)):
+        output_dir = os.path.join(output_root, name)
+        done = load_done(output_dir)
+        if done is not None:
+            done["skipped"] = True
+            results.append(done)
+            continue
+        jobs.append((path, output_dir))
+    logger.info(
+        f"一括抽出を開始します: {len(jobs)} 件 (完了済みスキップ {len(results)} 件), ワーカー数 {workers}"
+    )
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(logging.getLogger().level or logging.INFO,),
+    ) as executor:
+        futures = {
+            executor.submit(
+                extract_slides,
+                path,
+                output_dir,
+                sample_interval,
+                engine_name,
+                encoder_spec,
+                stable_ticks,
+                regions,
+            ): (path, output_dir)
+            for path, output_dir in jobs
+        }
+        for index, future in enumerate(as_completed(futures), start=1):
+            try:
+                result = future.result()
+            except Exception as e:
+                # ワーカープロセスの異常終了 (BrokenProcessPool) など。この入力を失敗として続ける
+                path, output_dir = futures[future]
+                logger.error(f"エラー (一括抽出ワーカー): {type(e).__name__}: {e}\n - 入力: {path}")
+                result = empty_result(path, output_dir, error=f"{type(e).__name__}: {e}")
+            results.append(result)
+            status = "失敗" if result["error"] else "完了"
+            logger.info(
+                f"[{index}/{len(jobs)}] {status}: {result['input']} "
+                f"({result['frames']} フレーム, {result['slides']} 枚, {result['fps']:.1f} frames/s)"
+            )
+    elapsed = time.perf_counter() - start
+    return summarize(results, elapsed, workers)
+
+
+def summarize(results, elapsed, workers):
+    """入力ごとの結果とワーカーごとの集計をまとめる"""
+    per_worker = {}
+    for result in results:
+        if result.get("skipped") or result["worker"] is None:
+            continue
+        stats = per_worker.setdefault(
+            str(result["worker"]), {"inputs": 0, "frames": 0, "seconds": 0.0}
+        )
+        stats["inputs"] += 1
+        stats["frames"] += result["frames"]
+        stats["seconds"] += result["seconds"]
+    for stats in per_worker.values():
+        stats["fps"] = stats["frames"] / stats["seconds"] if stats["seconds"] else 0.0
+
+    processed = [r for r in results if not r.get("skipped")]
+    total_frames = sum(r["frames"] for r in processed)
+    return {
+        "finished_at": datetime.now().isoformat(timespec="seconds"),
+        "workers": workers,
+        "elapsed_seconds": elapsed,
+        "inputs": len(results),
+        "processed": len(processed),
+        "skipped": len(results) - len(processed),
+        "failed": sum(1 for r in processed if r["error"]),
+        "frames": total_frames,
+        "slides": sum(r["slides"] for r in results),
+        "repeats": sum(r.get("repeats", 0) for r in results),
+        "bytes": sum(r.get("bytes", 0) for r in results),
+        "fps": total_frames / elapsed if elapsed else 0.0,
+        "per_worker": per_worker,
+        "results": results,
+    }
+
+
+def print_summary(summary):
+    print(
+        f"入力 {summary['inputs']} 件 (処理 {summary['processed']}, "
+        f"スキップ {summary['skipped']}, 失敗 {summary['failed']}), "
+        f"スライド {summary['slides']} 枚 (既出 {summary['repeats']} 回)"
+    )
+    print(
+        f"{summary['frames']} フレーム / {summary['elapsed_seconds']:.1f} 秒 "
+        f"= {summary['fps']:.1f} frames/s (ワーカー {summary['workers']})"
+    )
+    print(f"{'ワーカー(PID)':<14}{'入力数':>8}{'フレーム':>10}{'frames/s':>10}")
+    for worker, stats in sorted(summary["per_worker"].items()):
+        print(
+            f"{worker:<14}{stats['inputs']:>8}{stats['frames']:>10}{stats['fps']:>10.1f}"
+        )
+    for result in summary["results"]:
+        if result.get("error") and not result.get("skipped"):
+            print(f"失敗: {result['input']} - {result['error']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="録画済みの動画/画像フォルダからスライドを一括抽出する"
+    )
+    parser.add_argument("inputs", nargs="*", help="動画ファイルまたは画像フォルダ")
+    parser.add_argument("--input-list", help="入力パスを1行に1つ書いたファイル")
+    parser.add_argument("-o", "--output", required=True, help="出力先フォルダ")
+    parser.add_argument(
+        "--workers", type=int, default=None, help="プロセス数 (既定: CPUコア数)"
+    )
+    parser.add_argument(
+        "--sample-interval", type=float, default=1.0, help="動画のサンプリング間隔 (秒)"
+    )
+    parser.add_argument(
+        "--engine",
+        default="fingerprint",
+        help="比較エンジン (fingerprint / full / block / ssim。例: full:tolerance=8,blur=3)",
+    )
+    parser.add_argument(
+        "--stable-ticks",
+        type=int,
+        default=0,
+        help="変化後、このサンプル数だけ静止してから保存する (既定: 0 = 即保存)",
+    )
+    parser.add_argument(
+        "--regions",
+        default="",
+        help="切り出す領域 (GUI と同じ形式。名前=左,上,右,下 を ; 区切り。既定: 全体)",
+    )
+    parser.add_argument(
+        "--format",
+        default="png:3",
+        help="保存形式 (png[:0-9], png-fast, webp-lossless, webp[:品質], jpeg[:品質], bmp)",
+    )
+    args = parser.parse_args(argv)
+
+    inputs = list(args.inputs)
+    if args.input_list:
+        inputs.extend(read_input_list(args.input_list))
+    if not inputs:
+        parser.error("入力が指定されていません")
+    try:
+        create_encoder(args.format)
+        create_engine(args.engine)
+        parse_regions(args.regions)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format=log_format)
+
+    summary = run_batch(
+        inputs,
+        os.path.abspath(args.output),
+        workers=args.workers,
+        sample_interval=args.sample_interval,
+        engine_name=args.engine,
+        encoder_spec=args.format,
+        stable_ticks=args.stable_ticks,
+        regions=args.regions,
+    )
+    summary_path = os.path.join(os.path.abspath(args.output), SUMMARY_FILENAME)
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print_summary(summary)
+    print(f"集計結果: {summary_path}")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,835 @@
+# -*- coding: utf-8 -*-
+"""スライドキャプチャ処理のベンチマーク
+
+使い方:
+    python benchmark.py compare [--repeat N]
+    python benchmark.py schedule [--min-interval S] [--max-interval S]
+    python benchmark.py replay [動画ファイル/画像フォルダ] [--sample-interval S]
+    python benchmark.py tick [--repeat N]
+    python benchmark.py encode [画像フォルダ] [--formats png:3,webp:90,...]
+    python benchmark.py index [--sizes 1000,10000,50000]
+    python benchmark.py detect [ラベル付きフォルダ] [--write-set フォルダ]
+    python benchmark.py soak [--hours H] [--interval S] [--limit-mb MB]
+    python benchmark.py startup [--exe 凍結したexe] [--screen] [--repeat N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from encoders import ENCODER_PRESETS, create_encoder
+from fingerprint import (
+    ENGINE_PRESETS,
+    FingerprintEngine,
+    FullFrameEngine,
+    StableFrameGate,
+    create_engine,
+)
+from frame import Frame, frame_from_pil
+from frame_source import FrameSource, create_frame_source, crop_regions
+from metrics import current_rss, peak_rss
+from slide_index import SlideIndex, SlideKey
+from scheduler import AdaptiveScheduler, FixedScheduler
+from session import STATE_STOPPED, CaptureSession, SessionManager
+
+RESOLUTIONS = {
+    "1080p": (1920, 1080),
+    "1440p": (2560, 1440),
+    "4K": (3840, 2160),
+}
+
+
+def make_slide(width, height, seed, cursor=None):
+    """テキスト行と図形を並べた、スライド風の合成画像 (BGR) を作る"""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 245, dtype=np.uint8)
+    scale = width / 1920.0
+    # タイトル帯
+    cv2.rectangle(
+        image, (0, 0), (width, int(140 * scale)), (120, 60, 20), thickness=-1
+    )
+    cv2.putText(
+        image,
+        f"Slide {seed}",
+        (int(60 * scale), int(100 * scale)),
+        cv2.FONT_HERSHEY_SIMPLEX,
+        2.5 * scale,
+        (255, 255, 255),
+        max(1, int(4 * scale)),
+    )
+    # 本文の箇条書き
+    for line in range(8):
+        y = int((220 + line * 90) * scale)
+        words = int(rng.integers(3, 9))
+        text = " ".join(f"item{int(rng.integers(100, 999))}" for _ in range(words))
+        cv2.putText(
+            image,
+            f"- {text}",
+            (int(80 * scale), y),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1.2 * scale,
+            (30, 30, 30),
+            max(1, int(2 * scale)),
+        )
+    # 図形
+    x0 = int(rng.integers(int(1200 * scale), int(1500 * scale)))
+    y0 = int(rng.integers(int(300 * scale), int(600 * scale)))
+    cv2.rectangle(
+        image,
+        (x0, y0),
+        (x0 + int(300 * scale), y0 + int(250 * scale)),
+        tuple(int(c) for c in rng.integers(0, 255, 3)),
+        thickness=-1,
+    )
+    if cursor is not None:
+        cx, cy = cursor
+        cv2.rectangle(image, (cx, cy), (cx + 12, cy + 20), (0, 0, 0), thickness=-1)
+    return image
+
+
+def _time_per_call(func, repeat):
+    """1回あたりの平均実行時間 (ms) を返す"""
+    func()  # ウォームアップ
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000.0 / repeat
+
+
+def _peak_alloc(func):
+    """1回の呼び出しで確保されたメモリのピーク (bytes)"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_compare(repeat):
+    """従来のフル解像度比較とフィンガープリント比較の速度・メモリを比較する"""
+    engines = [FullFrameEngine(), FingerprintEngine()]
+    print(
+        f"{'解像度':<8}{'方式':<13}{'シナリオ':<10}"
+        f"{'比較ms/frame':>14}{'参照保持MB':>12}{'一時確保MB':>12}"
+    )
+    for res_name, (width, height) in RESOLUTIONS.items():
+        base = make_slide(width, height, seed=1)
+        scenarios = {
+            "静止": base.copy(),
+            "カーソル": make_slide(width, height, seed=1, cursor=(width // 2, height // 2)),
+            "切替": make_slide(width, height, seed=2),
+        }
+        for engine in engines:
+            reference = engine.to_reference(engine.prepare(base))
+            ref_bytes = reference.nbytes
+            for scenario, frame in scenarios.items():
+
+                def run():
+                    engine.is_similar(engine.prepare(frame), reference)
+
+                ms = _time_per_call(run, repeat)
+                peak = _peak_alloc(run)
+                print(
+                    f"{res_name:<8}{engine.name:<13}{scenario:<10}"
+                    f"{ms:>14.2f}{ref_bytes / 1e6:>12.2f}{peak / 1e6:>12.2f}"
+                )
+
+
+# (開始秒, 継続秒, スライド切替間隔秒): 静止→連続めくり→静止… の台本
+SCRIPTED_SESSION = [
+    (0, 120, 60.0),  # 1分ごとにゆっくり切り替え
+    (120, 20, 1.5),  # 連続めくり
+    (140, 300, 90.0),  # 長い静止 (説明中)
+    (440, 30, 3.0),  # やや速い切り替え
+    (470, 130, 45.0),
+]
+
+
+def scripted_transitions(script):
+    """台本からスライド切替時刻のリストを作る (最初のスライドは0秒)"""
+    times = []
+    for start, duration, step in script:
+        t = float(start)
+        while t < start + duration:
+            times.append(t)
+            t += step
+    return sorted(set(times))
+
+
+def replay_schedule(scheduler, engine, transitions, end_time, frames):
+    """仮想時計でキャプチャを再生し、(キャプチャ回数, 遅延リスト, 見逃し数, CPU秒) を返す"""
+    def slide_at(t):
+        index = 0
+        for i, change in enumerate(transitions):
+            if change <= t:
+                index = i
+        return index
+
+    now = 0.0
+    captures = 0
+    reference = None
+    detected_at = {}
+    cpu_start = time.process_time()
+    while now < end_time:
+        slide = slide_at(now)
+        current = engine.prepare(frames[slide % len(frames)])
+        captures += 1
+        changed = reference is None or not engine.is_similar(current, reference)
+        if changed:
+            reference = engine.to_reference(current)
+            detected_at.setdefault(slide, now)
+        now += scheduler.record(changed)
+    cpu = time.process_time() - cpu_start
+
+    latencies = [detected_at[i] - t for i, t in enumerate(transitions) if i in detected_at]
+    missed = len(transitions) - len(latencies)
+    return captures, latencies, missed, cpu
+
+
+def bench_schedule(min_interval, max_interval):
+    """固定2秒間隔と適応型スケジューラを台本付きフレーム列で比較する"""
+    transitions = scripted_transitions(SCRIPTED_SESSION)
+    end_time = max(start + duration for start, duration, _ in SCRIPTED_SESSION)
+    frames = [make_slide(1280, 720, seed=i) for i in range(8)]
+    schedulers = {
+        "fixed-2.0s": FixedScheduler(2.0),
+        "adaptive": AdaptiveScheduler(min_interval, max_interval),
+    }
+    print(
+        f"台本: {end_time / 60:.0f} 分, スライド切替 {len(transitions)} 回"
+        f" (適応型: {min_interval}〜{max_interval} 秒)"
+    )
+    print(
+        f"{'方式':<12}{'キャプチャ/分':>12}{'平均遅延s':>10}{'最大遅延s':>10}"
+        f"{'見逃し':>8}{'CPU秒':>8}"
+    )
+    for name, scheduler in schedulers.items():
+        captures, latencies, missed, cpu = replay_schedule(
+            scheduler, FingerprintEngine(), transitions, end_time, frames
+        )
+        mean_latency = sum(latencies) / len(latencies) if latencies else 0.0
+        max_latency = max(latencies) if latencies else 0.0
+        print(
+            f"{name:<12}{captures / (end_time / 60):>12.1f}{mean_latency:>10.2f}"
+            f"{max_latency:>10.2f}{missed:>8}{cpu:>8.2f}"
+        )
+
+
+def write_synthetic_video(path, width=1280, height=720, fps=30, slides=12, seconds_per_slide=5):
+    """スライドが一定間隔で切り替わる合成動画 (MJPG/AVI) を書き出す"""
+    writer = cv2.VideoWriter(
+        path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height)
+    )
+    if not writer.isOpened():
+        raise OSError(f"合成動画を書き出せませんでした: {path}")
+    try:
+        for seed in range(slides):
+            frame = make_slide(width, height, seed=seed)
+            for _ in range(fps * seconds_per_slide):
+                writer.write(frame)
+    finally:
+        writer.release()
+
+
+def bench_replay(path, sample_interval):
+    """再生ソースからスライド検出までのスループットを測る"""
+    with tempfile.TemporaryDirectory() as tmp:
+        if path is None:
+            path = os.path.join(tmp, "synthetic.avi")
+            write_synthetic_video(path)
+            print("合成動画を生成しました: 12 スライド x 5 秒 (1280x720, 30fps)")
+
+        engine = FingerprintEngine()
+        reference = None
+        slides = 0
+        decode_time = 0.0
+        detect_time = 0.0
+        with create_frame_source(path, sample_interval=sample_interval) as source:
+            while True:
+                start = time.perf_counter()
+                frames = source.read()
+                decode_time += time.perf_counter() - start
+                if frames is None:
+                    if source.finished:
+                        break
+                    continue
+                start = time.perf_counter()
+                current = engine.prepare(frames[0])
+                if reference is None or not engine.is_similar(current, reference):
+                    reference = engine.to_reference(current)
+                    slides += 1
+                detect_time += time.perf_counter() - start
+            frames_read = source.frames_read
+
+    total = decode_time + detect_time
+    print(f"入力: {path}")
+    print(f"処理フレーム数: {frames_read} (サンプリング間隔 {sample_interval} 秒)")
+    print(f"検出スライド数: {slides}")
+    print(
+        f"デコード: {decode_time:.2f} 秒, 検出: {detect_time:.2f} 秒, "
+        f"スループット: {frames_read / total if total else 0.0:.1f} frames/s"
+    )
+
+
+def legacy_extract(screenshot):
+    """変更前の取り出し: PIL -> convert("RGB") -> np.array"""
+    return np.array(screenshot.convert("RGB"))
+
+
+def legacy_compare(current_rgb, last_image):
+    """変更前の変換・比較: RGB -> BGR、両フレームをグレー化して全画素差分"""
+    current_image_cv = cv2.cvtColor(current_rgb, cv2.COLOR_RGB2BGR)
+    gray1 = cv2.cvtColor(current_image_cv, cv2.COLOR_BGR2GRAY)
+    gray2 = cv2.cvtColor(last_image, cv2.COLOR_BGR2GRAY)
+    diff = cv2.absdiff(gray1, gray2)
+    return 1.0 - np.count_nonzero(diff) / gray1.size >= 0.95
+
+
+def bench_tick(repeat):
+    """1ティックあたりの確保メモリと処理時間を、取り出しと変換・比較に分けて比較する
+
+    確保メモリは tracemalloc で追跡できる Python/NumPy 側の確保量のピーク。
+    PIL 内部の確保 (convert のコピーなど) は含まれないため、変更前の値は過小評価になる。
+    """
+    print(
+        f"{'解像度':<8}{'方式':<10}{'ms/tick':>10}"
+        f"{'取り出しMB':>12}{'変換・比較MB':>14}"
+    )
+    for res_name, (width, height) in RESOLUTIONS.items():
+        rgb = cv2.cvtColor(make_slide(width, height, seed=1), cv2.COLOR_BGR2RGB)
+        screenshot = Image.fromarray(rgb)
+        last_bgr = make_slide(width, height, seed=1)
+        engine = FingerprintEngine()
+        reference = engine.to_reference(engine.prepare(frame_from_pil(screenshot)))
+        legacy_buffer = legacy_extract(screenshot)
+        frame_buffer = frame_from_pil(screenshot)
+
+        paths = {
+            "変更前": (
+                lambda: legacy_compare(legacy_extract(screenshot), last_bgr),
+                lambda: legacy_extract(screenshot),
+                lambda: legacy_compare(legacy_buffer, last_bgr),
+            ),
+            "Frame": (
+                lambda: engine.is_similar(
+                    engine.prepare(frame_from_pil(screenshot)), reference
+                ),
+                lambda: frame_from_pil(screenshot),
+                lambda: engine.is_similar(engine.prepare(frame_buffer), reference),
+            ),
+        }
+        for name, (tick, extract, compare) in paths.items():
+            ms = _time_per_call(tick, repeat)
+            print(
+                f"{res_name:<8}{name:<10}{ms:>10.2f}"
+                f"{_peak_alloc(extract) / 1e6:>12.2f}{_peak_alloc(compare) / 1e6:>14.2f}"
+            )
+
+
+def bench_encode(folder, formats, repeat):
+    """保存形式ごとのエンコード時間 (ms/frame) とサイズ (bytes/frame)"""
+    if folder:
+        with create_frame_source(folder) as source:
+            images = []
+            while True:
+                frames = source.read()
+                if frames is None:
+                    break
+                images.append(frames[0].bgr())
+        if not images:
+            print(f"画像が見つかりません: {folder}")
+            return
+        print(f"入力: {folder} ({len(images)} 枚)")
+    else:
+        images = [make_slide(1920, 1080, seed=i) for i in range(5)]
+        print("入力: 合成スライド 1920x1080 x 5 枚")
+
+    print(f"{'形式':<16}{'ms/frame':>10}{'KB/frame':>12}{'可逆':>6}")
+    for spec in formats:
+        encoder = create_encoder(spec)
+        sizes = []
+
+        def run():
+            sizes.clear()
+            for image in images:
+                sizes.append(encoder.encode(image).size)
+
+        ms = _time_per_call(run, repeat) / len(images)
+        kb = sum(sizes) / len(sizes) / 1024.0
+        lossless = "○" if encoder.lossless else "×"
+        print(f"{encoder.name:<16}{ms:>10.1f}{kb:>12.1f}{lossless:>6}")
+
+
+def bench_index(sizes, lookups=2000):
+    """スライドインデックスの検索時間。登録済みスライド数ごとに測る"""
+    rng = np.random.default_rng(0)
+    print(f"{'登録数':>8}{'構築s':>8}{'既出ms':>10}{'未登録ms':>10}")
+    for size in sizes:
+        coarse = [int(v) for v in rng.integers(0, 2**63, size, dtype=np.int64)]
+        with tempfile.TemporaryDirectory() as tmp:
+            index = SlideIndex(tmp)
+            start = time.perf_counter()
+            for i, value in enumerate(coarse):
+                index.table.add(value, (value, f"slide_{i}.png"))
+            build = time.perf_counter() - start
+
+            # 既出: 登録済みハッシュから数bit反転したもの
+            hits = []
+            for value in coarse[:lookups]:
+                flipped = value ^ (1 << int(rng.integers(0, 63)))
+                hits.append(SlideKey(flipped, value))
+            misses = [
+                SlideKey(int(v), int(v))
+                for v in rng.integers(0, 2**63, lookups, dtype=np.int64)
+            ]
+            results = {}
+            for name, keys in (("hit", hits), ("miss", misses)):
+                start = time.perf_counter()
+                for key in keys:
+                    index.lookup(key)
+                results[name] = (time.perf_counter() - start) * 1000.0 / len(keys)
+        print(f"{size:>8}{build:>8.2f}{results['hit']:>10.3f}{results['miss']:>10.3f}")
+
+
+LABELS_FILENAME = "labels.json"
+
+
+def write_labelled_set(folder, width=1280, height=720, slides=10, seed=0):
+    """ノイズ入りの再生用フレーム列と正解ラベルを書き出す
+
+    各スライドを8ティック表示し、フレームごとに次のノイズを加える:
+    - 動画の圧縮ノイズ (ガウスノイズ + JPEG 品質 70〜85 で保存)
+    - カーソルの点滅 (1ティックおき)
+    - 画面全体のサブピクセル移動 (拡大表示やアニメーションの再サンプリング)
+    スライド切り替えの一部は3フレームのクロスフェードにし、一部のスライドでは
+    途中で箇条書きを1行追加する。labels.json の changes には、新しい内容が
+    現れ始めたフレームのファイル名を並べる。
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    cursor = (width // 2, height // 2)
+    frames = []  # (画像, 新しい内容の開始フレームなら True)
+    previous = None
+    for slide in range(slides):
+        base = make_slide(width, height, seed=100 + slide)
+        if previous is not None and slide % 2 == 1:
+            for step in (0.25, 0.5, 0.75):
+                frames.append(
+                    (cv2.addWeighted(previous, 1.0 - step, base, step, 0), step == 0.25)
+                )
+            fading = True
+        else:
+            fading = False
+        for tick in range(8):
+            image = base
+            if slide % 3 == 2 and tick == 4:
+                # 箇条書きの追加
+                base = base.copy()
+                cv2.putText(
+                    base,
+                    "- additional point revealed",
+                    (int(80 * width / 1920), int(1000 * height / 1080)),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    1.2 * width / 1920,
+                    (30, 30, 30),
+                    max(1, int(2 * width / 1920)),
+                )
+                image = base
+            frames.append((image, (tick == 0 and not fading) or (slide % 3 == 2 and tick == 4)))
+        previous = base
+
+    names = []
+    changes = []
+    for number, (image, is_change) in enumerate(frames):
+        noisy = image.copy()
+        if number % 2:
+            cx, cy = cursor
+            cv2.rectangle(noisy, (cx, cy), (cx + 12, cy + 20), (0, 0, 0), thickness=-1)
+        if number % 3:
+            shift = np.float32([[1, 0, rng.uniform(-0.5, 0.5)], [0, 1, rng.uniform(-0.5, 0.5)]])
+            noisy = cv2.warpAffine(noisy, shift, (width, height), borderMode=cv2.BORDER_REPLICATE)
+        noise = rng.normal(0.0, 2.0, noisy.shape)
+        noisy = np.clip(noisy + noise, 0, 255).astype(np.uint8)
+        name = f"frame_{number:05d}.jpg"
+        quality = int(rng.integers(70, 86))
+        cv2.imwrite(os.path.join(folder, name), noisy, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        names.append(name)
+        if is_change:
+            changes.append(name)
+    with open(os.path.join(folder, LABELS_FILENAME), "w", encoding="utf-8") as f:
+        json.dump({"frames": names, "changes": changes}, f, ensure_ascii=False, indent=2)
+    return len(names), len(changes)
+
+
+def score_detections(saved, changes, frame_count):
+    """保存したフレーム番号を正解と照合し (適合率, 再現率, 誤保存数, 見逃し数) を返す
+
+    正解の変化から次の変化の直前までを1区間とし、区間内の最初の保存を正解、
+    2回目以降の保存を誤保存とする。保存のない区間は見逃し。
+    """
+    bounds = list(changes) + [frame_count]
+    true_positive = 0
+    false_positive = 0
+    saved = sorted(saved)
+    false_positive += sum(1 for i in saved if i < bounds[0])
+    for start, end in zip(bounds, bounds[1:]):
+        hits = sum(1 for i in saved if start <= i < end)
+        if hits:
+            true_positive += 1
+            false_positive += hits - 1
+    missed = len(changes) - true_positive
+    precision = true_positive / len(saved) if saved else 0.0
+    recall = true_positive / len(changes) if changes else 0.0
+    return precision, recall, false_positive, missed
+
+
+def run_detector(folder, engine_spec, stable_ticks):
+    """ラベル付きフォルダを再生して保存するフレーム番号と CPU 時間 (ms/frame) を返す"""
+    engine = create_engine(engine_spec)
+    gate = StableFrameGate(stable_ticks)
+    reference = None
+    saved = []
+    cpu = 0.0
+    with create_frame_source(folder) as source:
+        while True:
+            frames = source.read()
+            if frames is None:
+                if source.finished:
+                    break
+                continue
+            start = time.process_time()
+            current = engine.prepare(frames[0])
+            similar = reference is not None and engine.is_similar(current, reference)
+            if similar:
+                gate.reset()
+            elif gate.confirm(frames[0]):
+                reference = engine.to_reference(current)
+                saved.append(source.frames_read - 1)
+            cpu += time.process_time() - start
+        frame_count = source.frames_read
+    return saved, cpu * 1000.0 / max(1, frame_count), frame_count
+
+
+def bench_detect(folder, engine_specs, stable_ticks_list, write_set=None):
+    """検出方式ごとの適合率・再現率と1フレームあたりの CPU 時間"""
+    with tempfile.TemporaryDirectory() as tmp:
+        if folder is None:
+            folder = write_set or os.path.join(tmp, "labelled")
+            count, change_count = write_labelled_set(folder)
+            print(f"ラベル付き合成フレームを生成しました: {count} フレーム, 変化 {change_count} 回 ({folder})")
+        with open(os.path.join(folder, LABELS_FILENAME), encoding="utf-8") as f:
+            labels = json.load(f)
+        with create_frame_source(folder) as source:
+            order = {name: i for i, name in enumerate(source.files)}
+        changes = sorted(order[name] for name in labels["changes"])
+
+        print(
+            f"{'方式':<28}{'安定':>4}{'保存':>6}{'適合率':>8}{'再現率':>8}"
+            f"{'誤保存':>7}{'見逃し':>7}{'CPU ms/frame':>14}"
+        )
+        for spec in engine_specs:
+            for stable_ticks in stable_ticks_list:
+                saved, cpu_ms, frame_count = run_detector(folder, spec, stable_ticks)
+                precision, recall, false_positive, missed = score_detections(
+                    saved, changes, frame_count
+                )
+                print(
+                    f"{spec:<28}{stable_ticks:>4}{len(saved):>6}{precision:>8.2f}{recall:>8.2f}"
+                    f"{false_positive:>7}{missed:>7}{cpu_ms:>14.2f}"
+                )
+
+
+class SyntheticSource(FrameSource):
+    """ソーク試験用の合成フレームソース
+
+    あらかじめ描いた slides 枚のスライドを seconds_per_slide 秒ずつ順に繰り返し、
+    1回の read() を interval 秒の1ティックとみなす。フレームは GUI の画面
+    キャプチャと同じくプールの配列に写して返すため、プールの上限を超える分は
+    取り込む前に PoolExhaustedError になる。ticks 回読んだら終端になる。
+    on_tick(tick, virtual_time) はティックごとに呼ばれる (RSS の記録など)。
+    """
+
+    realtime = False
+    description = "合成スライド"
+
+    def __init__(
+        self,
+        ticks,
+        interval,
+        width=1280,
+        height=720,
+        slides=12,
+        seconds_per_slide=20,
+        on_tick=None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.ticks = ticks
+        self.interval = interval
+        self.seconds_per_slide = seconds_per_slide
+        self.on_tick = on_tick
+        self.images = [make_slide(width, height, seed) for seed in range(slides)]
+        self.tick = 0
+
+    def read(self):
+        if self.tick >= self.ticks:
+            self.finished = True
+            return None
+        virtual_time = self.tick * self.interval
+        if self.on_tick:
+            self.on_tick(self.tick, virtual_time)
+        self.tick += 1
+        image = self.images[int(virtual_time // self.seconds_per_slide) % len(self.images)]
+        with self.metrics.stage("convert"):
+            data = image
+            if self.pool is not None:
+                data = self.pool.acquire(image.shape)
+                np.copyto(data, image)
+            frames = crop_regions(Frame(data, "BGR", self.pool), self.regions)
+        self.frames_read += 1
+        return frames
+
+    def timestamp_label(self):
+        return f"{(self.tick - 1) * self.interval:010.1f}"
+
+
+def bench_soak(hours, interval, limit_mb, growth_limit_mb):
+    """長時間セッションのソーク試験: 合成ソースで実際のセッションを回し、RSS が平坦か確認する
+
+    GUI と同じ SessionManager / CaptureLoop / CaptureSession (バッファプール、
+    さかのぼり保存用のリングバッファ、安定確認、スライドインデックス、保存ワーカー)
+    で合成スライドを処理する。最初の 10% を慣らし運転として、それ以降の RSS の
+    増加が growth_limit_mb を超えるか、最大 RSS が limit_mb を超えたら失敗
+    (終了コード 1) とする。
+    """
+    ticks = int(hours * 3600 / interval)
+    sample_every = max(1, int(300 / interval))  # 仮想時間で5分ごとに記録
+    samples = []  # (仮想時刻, RSS)
+
+    manager = SessionManager()
+    manager.memory_limit_mb = limit_mb
+    manager.min_capture_interval = interval
+
+    def on_tick(tick, virtual_time):
+        if tick % sample_every:
+            return
+        rss = current_rss()
+        samples.append((virtual_time, rss))
+        if tick % (sample_every * 12) == 0 and session.metrics is not None:
+            counters = session.metrics.counters
+            print(
+                f"{virtual_time / 3600:>7.1f}h{rss / 1e6:>9.1f}"
+                f"{source.pool.allocated_bytes / 1e6:>10.1f}{len(session.recent_frames):>9}"
+                f"{counters['saved']:>6}{counters['repeats']:>6}"
+            )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        session = CaptureSession("soak", os.path.join(tmp, "out"), encoder="png-fast", stable_ticks=1)
+        session.retro_seconds = 10.0
+        source = SyntheticSource(ticks, interval, on_tick=on_tick)
+        print(
+            f"ソーク試験: 仮想 {hours:g} 時間 ({ticks} ティック x {interval:g} 秒), "
+            f"メモリ上限 {limit_mb} MB"
+        )
+        print(f"{'仮想時間':>8}{'RSS MB':>9}{'プール MB':>10}{'直近枚数':>9}{'保存':>6}{'既出':>6}")
+        start = time.perf_counter()
+        manager.start_session(session, source)
+        try:
+            while session.state != STATE_STOPPED:
+                time.sleep(0.2)
+        finally:
+            manager.stop_all()
+        elapsed = time.perf_counter() - start
+        counters = dict(session.metrics.counters)
+
+    warmup = samples[max(1, len(samples) // 10):]
+    baseline = warmup[0][1] if warmup else 0
+    tail = warmup[len(warmup) * 3 // 4:] or warmup
+    growth = (max(rss for _, rss in tail) - baseline) / 1e6 if tail else 0.0
+    peak = peak_rss() / 1e6
+    print(
+        f"実時間 {elapsed:.1f} 秒 ({ticks / elapsed if elapsed else 0.0:.0f} ティック/秒), "
+        f"慣らし後の RSS 増加 {growth:+.1f} MB (許容 {growth_limit_mb} MB), 最大 RSS {peak:.0f} MB"
+    )
+    print(
+        f"保存 {counters.get('saved', 0)} 枚, 既出 {counters.get('repeats', 0)} 回, "
+        f"エラー {counters.get('errors', 0)} 回, メモリ上限超過 {counters.get('memory_pressure', 0)} 回"
+    )
+    if growth > growth_limit_mb or peak > limit_mb:
+        print("NG: メモリ使用量が平坦ではありません")
+        sys.exit(1)
+    print("OK: メモリ使用量は平坦です")
+
+
+def bench_startup(exe, screen, repeat):
+    """起動からウィンドウ表示まで、および最初のフレーム取得までの時間
+
+    GUI を startup-probe モードで起動し、ウィンドウ表示・画像処理モジュールの
+    読み込み完了・最初のフレーム取得の各時点を、プロセス起動からの経過時間で測る。
+    exe を指定すると凍結したexe (PyInstaller / cx_Freeze) を計測する。
+    """
+    main_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    command = [exe] if exe else [sys.executable, main_script]
+    with tempfile.TemporaryDirectory() as tmp:
+        source = ""
+        if not screen:
+            # 画面がない環境でも最初のフレームまで測れるよう、短い合成動画を入力にする
+            source = os.path.join(tmp, "startup.avi")
+            write_synthetic_video(source, fps=5, slides=2, seconds_per_slide=1)
+        print(f"起動コマンド: {' '.join(command)} (入力: {source or '画面キャプチャ'})")
+        print(f"{'回':>3}{'ウィンドウ ms':>14}{'モジュール ms':>14}{'最初のフレーム ms':>18}")
+        results = {"window": [], "modules": [], "first_capture": []}
+        for run in range(repeat):
+            output = os.path.join(tmp, f"out_{run}")
+            launched_at = time.time()
+            completed = subprocess.run(
+                command + ["startup-probe", output, source],
+                cwd=tmp,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                timeout=120,
+            )
+            lines = completed.stdout.strip().splitlines()
+            probe = json.loads(lines[-1]) if lines else {"error": "出力がありません"}
+            if "error" in probe:
+                print(f"計測に失敗しました: {probe['error']} (終了コード {completed.returncode})")
+                sys.exit(1)
+            elapsed = {
+                key: (probe[key] - launched_at) * 1000.0 if probe.get(key) else float("nan")
+                for key in results
+            }
+            for key, value in elapsed.items():
+                results[key].append(value)
+            print(
+                f"{run + 1:>3}{elapsed['window']:>14.0f}{elapsed['modules']:>14.0f}"
+                f"{elapsed['first_capture']:>18.0f}"
+            )
+    print(
+        f"{'中央値':>3}{statistics.median(results['window']):>14.0f}"
+        f"{statistics.median(results['modules']):>14.0f}"
+        f"{statistics.median(results['first_capture']):>18.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="スライド比較エンジンの比較時間とメモリ"
+    )
+    compare_parser.add_argument("--repeat", type=int, default=20)
+
+    schedule_parser = subparsers.add_parser(
+        "schedule", help="キャプチャ間隔スケジューラの再生ベンチマーク"
+    )
+    schedule_parser.add_argument("--min-interval", type=float, default=0.5)
+    schedule_parser.add_argument("--max-interval", type=float, default=4.0)
+
+    replay_parser = subparsers.add_parser(
+        "replay", help="動画/画像フォルダ再生によるスライド検出スループット"
+    )
+    replay_parser.add_argument(
+        "path", nargs="?", help="動画ファイルまたは画像フォルダ (省略時は合成動画)"
+    )
+    replay_parser.add_argument("--sample-interval", type=float, default=1.0)
+
+    tick_parser = subparsers.add_parser(
+        "tick", help="1ティックあたりの確保メモリと処理時間 (変換経路の比較)"
+    )
+    tick_parser.add_argument("--repeat", type=int, default=10)
+
+    encode_parser = subparsers.add_parser(
+        "encode", help="保存形式ごとのエンコード時間とファイルサイズ"
+    )
+    encode_parser.add_argument(
+        "folder", nargs="?", help="代表的なスライド画像のフォルダ (省略時は合成画像)"
+    )
+    encode_parser.add_argument(
+        "--formats",
+        default=",".join(ENCODER_PRESETS + ("png:1", "jpeg:75", "webp:75")),
+        help="カンマ区切りの保存形式",
+    )
+    encode_parser.add_argument("--repeat", type=int, default=3)
+
+    index_parser = subparsers.add_parser(
+        "index", help="スライドインデックスの検索時間"
+    )
+    index_parser.add_argument("--sizes", default="1000,10000,50000")
+
+    detect_parser = subparsers.add_parser(
+        "detect", help="ノイズ入りラベル付きフレームでの検出精度 (適合率/再現率) と CPU 時間"
+    )
+    detect_parser.add_argument(
+        "folder",
+        nargs="?",
+        help="labels.json のある画像フォルダ (省略時は合成フレームを生成)",
+    )
+    detect_parser.add_argument(
+        "--engines", default=";".join(ENGINE_PRESETS), help="セミコロン区切りの比較エンジン指定"
+    )
+    detect_parser.add_argument(
+        "--stable-ticks", default="0,2", help="カンマ区切りの安定確認ティック数"
+    )
+    detect_parser.add_argument(
+        "--write-set", help="生成した合成フレームを残すフォルダ"
+    )
+
+    soak_parser = subparsers.add_parser(
+        "soak", help="再生ソースによる長時間セッションのソーク試験 (RSS が平坦か確認)"
+    )
+    soak_parser.add_argument("--hours", type=float, default=8.0, help="仮想の実行時間")
+    soak_parser.add_argument("--interval", type=float, default=2.0, help="1ティックの仮想秒数")
+    soak_parser.add_argument("--limit-mb", type=int, default=1024, help="メモリ上限 (MB)")
+    soak_parser.add_argument(
+        "--growth-limit-mb", type=float, default=16.0, help="許容する RSS の増加 (MB)"
+    )
+
+    startup_parser = subparsers.add_parser(
+        "startup", help="起動からウィンドウ表示・最初のフレーム取得までの時間"
+    )
+    startup_parser.add_argument("--exe", help="計測する凍結したexe (省略時は python main.py)")
+    startup_parser.add_argument(
+        "--screen", action="store_true", help="合成動画ではなく画面キャプチャで計測する"
+    )
+    startup_parser.add_argument("--repeat", type=int, default=5)
+
+    args = parser.parse_args()
+    if args.command == "compare":
+        bench_compare(args.repeat)
+    elif args.command == "schedule":
+        bench_schedule(args.min_interval, args.max_interval)
+    elif args.command == "replay":
+        bench_replay(args.path, args.sample_interval)
+    elif args.command == "tick":
+        bench_tick(args.repeat)
+    elif args.command == "encode":
+        bench_encode(args.folder, args.formats.split(","), args.repeat)
+    elif args.command == "index":
+        bench_index([int(v) for v in args.sizes.split(",")])
+    elif args.command == "detect":
+        bench_detect(
+            args.folder,
+            args.engines.split(";"),
+            [int(v) for v in args.stable_ticks.split(",")],
+            args.write_set,
+        )
+    elif args.command == "soak":
+        bench_soak(args.hours, args.interval, args.limit_mb, args.growth_limit_mb)
+    elif args.command == "startup":
+        bench_startup(args.exe, args.screen, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,647 @@
+# -*- coding: utf-8 -*-
+"""ローカル制御 API (HTTP / Unix ソケット)
+
+Tk のボタン以外から、セッションの開始・停止と状態の取得を行うための API。
+asyncio のイベントループを専用スレッド (ヘッドレス時はメインスレッド) で動かし、
+セッションの開始・停止のように待ち時間のある処理はスレッドプールで実行する。
+Tk のメインループやキャプチャスレッドを待たせることはない。
+
+エンドポイント (本文・応答は JSON):
+    GET  /status                  全セッションの状態
+    GET  /sessions/<名前>          1セッションの状態
+    POST /sessions                セッションを開始する
+                                  {"name", "folder", "regions", "source", "encoder",
+                                   "engine", "stable_ticks", "deck"} (folder 以外は省略可)
+    POST /sessions/<名前>/stop     セッションを停止する (保存とデッキの完成まで待つ)
+    POST /sessions/<名前>/retro    直前のフレームを保存する
+    DELETE /sessions/<名前>        停止済みのセッションを一覧から外す
+    GET  /events                  保存・開始・停止のイベントを Server-Sent Events で配信
+
+token を指定した場合は "Authorization: Bearer <token>" ヘッダーが必要になる。
+token を指定しない場合は、ブラウザ経由の要求 (CSRF や DNS リバインディング) を
+防ぐため、ループバック以外の Host ヘッダーや Origin ヘッダーを持つ要求を拒否する。
+
+ヘッドレスで起動する:
+    python main.py serve [--host 127.0.0.1] [--port 8765] [--socket パス] [--token 値]
+クライアント (CI などから操作する):
+    python control_api.py status | start 保存フォルダ [--source 入力] | stop 名前 | remove 名前 | events
+"""
+import argparse
+import asyncio
+import http.client
+import ipaddress
+import json
+import logging
+import signal
+import socket
+import sys
+import threading
+from urllib.parse import unquote, urlsplit
+
+from log_config import log_stats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8765
+# POST /sessions で指定できる項目 (CaptureSession の引数)
+SESSION_OPTIONS = ("name", "folder", "regions", "source", "encoder", "engine", "stable_ticks", "deck")
+# POST /sessions の項目のうち整数で指定するもの (それ以外は文字列)
+INTEGER_OPTIONS = ("stable_ticks",)
+# 保存イベントに含める保存記録の項目
+SAVED_EVENT_FIELDS = ("seq", "bytes", "label", "region", "retro")
+MAX_BODY_BYTES = 64 * 1024
+
+_REASONS = {
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class ControlError(Exception):
+    """制御 API のエラー応答 (status は HTTP ステータスコード)"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class EventHub:
+    """イベントを購読者ごとの asyncio キューに配る
+
+    publish() は保存ワーカーやキャプチャスレッドから呼ばれるため、
+    イベントループのスレッドへは call_soon_threadsafe で渡す。読み出しの遅い
+    購読者のキューが満杯になったら、そのイベントは捨てて件数を数える。
+    """
+
+    def __init__(self, loop, max_queue=256):
+        self.loop = loop
+        self.max_queue = max_queue
+        self.dropped_count = 0
+        self._subscribers = set()
+
+    def subscribe(self):
+        queue = asyncio.Queue(maxsize=self.max_queue)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, event):
+        if self._subscribers:
+            self.loop.call_soon_threadsafe(self._deliver, event)
+
+    def _deliver(self, event):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.dropped_count += 1
+
+    def close(self):
+        """購読者に配信の終了 (None) を伝える (イベントループのスレッドで呼ぶ)"""
+        for queue in list(self._subscribers):
+            while queue.full():
+                queue.get_nowait()
+            queue.put_nowait(None)
+
+
+def _is_loopback(hostname):
+    """ホスト名が localhost またはループバックアドレスか"""
+    if not hostname:
+        return False
+    if hostname == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(hostname).is_loopback
+    except ValueError:
+        return False
+
+
+class ControlServer:
+    """SessionManager を操作するローカル HTTP サーバー
+
+    get_manager: SessionManager を返す関数 (GUI では画像処理モジュールの読み込みを
+        伴うため、スレッドプールで呼ぶ)
+    socket_path: 指定すると TCP ではなく Unix ソケットで待ち受ける
+    """
+
+    def __init__(self, get_manager, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, token=None):
+        self.get_manager = get_manager
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.token = token
+        self.loop = None
+        self.hub = None
+        self._server = None
+        self._manager = None
+        self._manager_lock = None
+        self._watched = set()  # 保存の通知先を登録済みのセッション
+        self._watch_lock = threading.Lock()  # 登録はキャプチャスレッドからも行われる
+        self._streams = set()  # イベント配信中のタスク (終了時に取り消す)
+        self._thread = None
+        self._ready = threading.Event()
+        self._start_error = None
+
+    @property
+    def address(self):
+        return self.socket_path or f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        """待ち受けを開始する (イベントループのスレッドで呼ぶ)"""
+        self.loop = asyncio.get_running_loop()
+        self.hub = EventHub(self.loop)
+        self._manager_lock = asyncio.Lock()
+        if self.socket_path:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        else:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            # port=0 なら空いているポートが割り当てられる
+            self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"制御 API を開始しました: {self.address}")
+
+    async def serve_forever(self):
+        """SIGINT / SIGTERM を受け取るまで待ち受ける (ヘッドレス起動用)"""
+        await self.start()
+        stop_event = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signum, stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows では Ctrl+C の KeyboardInterrupt で終了する
+        await stop_event.wait()
+        await self._close()
+        logger.info("制御 API を終了します")
+
+    def start_in_thread(self):
+        """専用スレッドでイベントループを動かす (GUI と同時に使う場合)。待ち受け開始まで待つ"""
+        self._thread = threading.Thread(target=self._run_thread, name="ControlAPI", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._start_error:
+            raise self._start_error
+        return self
+
+    def _run_thread(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.start())
+        except OSError as e:
+            self._start_error = e
+            self._ready.set()
+            loop.close()
+            return
+        self._ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def stop(self, timeout=2.0):
+        """待ち受けとイベント配信を止め、イベントループを終了する (start_in_thread で開始した場合)"""
+        if self._server is None or self._thread is None or self.loop.is_closed():
+            return
+        future = asyncio.run_coroutine_threadsafe(self._close(), self.loop)
+        try:
+            future.result(timeout)
+        except Exception as e:
+            logger.warning(f"警告: 制御 API の終了処理が完了しませんでした: {type(e).__name__} - {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+    async def _close(self, timeout=1.0):
+        """新しい接続の受け付けをやめ、配信中のイベントストリームを終わらせる"""
+        self._server.close()
+        streams = list(self._streams)
+        self.hub.close()
+        if streams:
+            _, pending = await asyncio.wait(streams, timeout=timeout)
+            # 送信が詰まっているストリームは取り消す
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _manager_ready(self):
+        """SessionManager を取得し、初回だけイベントの通知先を登録する"""
+        if self._manager is not None:
+            return self._manager
+        async with self._manager_lock:
+            if self._manager is None:
+                manager = await self.loop.run_in_executor(None, self.get_manager)
+                manager.listeners.append(self._on_session_event)
+                # GUI などから開始済みのセッションの保存も通知する
+                for session in manager.active_sessions:
+                    self._watch(session)
+                self._manager = manager
+        return self._manager
+
+    def _watch(self, session):
+        """保存の通知先をセッションごとに1回だけ登録する"""
+        with self._watch_lock:
+            if session in self._watched:
+                return
+            self._watched.add(session)
+        session.add_saved_listener(self._on_saved)
+
+    def _on_session_event(self, event, session):
+        if event == "started":
+            self._watch(session)
+        self.hub.publish({"event": event, "session": session.name, "status": session.status()})
+
+    def _on_saved(self, session, path, info):
+        event = {"event": "saved", "session": session.name, "path": path}
+        event.update({key: info[key] for key in SAVED_EVENT_FIELDS if key in info})
+        self.hub.publish(event)
+
+    async def _handle(self, reader, writer):
+        try:
+            method, path, headers, body = await self._read_request(reader)
+            if self.token:
+                if headers.get("authorization") != f"Bearer {self.token}":
+                    raise ControlError(401, "認証トークンが正しくありません")
+            else:
+                self._check_local(headers)
+            if method == "GET" and path == "/events":
+                # 購読だけのクライアントにも GUI から開始したセッションのイベントを届ける
+                await self._manager_ready()
+                await self._stream_events(writer)
+                return
+            status, data = await self._dispatch(method, path, body)
+        except ControlError as e:
+            status, data = e.status, {"error": str(e)}
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as e:
+            logger.exception(f"エラー (制御 API): {type(e).__name__}: {e}")
+            status, data = 500, {"error": f"{type(e).__name__}: {e}"}
+        await self._write_response(writer, status, data)
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split()
+        if len(parts) != 3:
+            raise ControlError(400, f"リクエスト行が不正です: {request_line!r}")
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+            if line in ("\r\n", "\n", ""):
+                break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise ControlError(400, "Content-Length が不正です") from None
+        if length < 0:
+            raise ControlError(400, "Content-Length が不正です")
+        if length > MAX_BODY_BYTES:
+            raise ControlError(413, "本文が大きすぎます")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), unquote(urlsplit(target).path).rstrip("/") or "/", headers, body
+
+    @staticmethod
+    def _check_local(headers):
+        """トークンなしの場合に、ローカルのクライアント以外からの要求を拒否する
+
+        Web ページからの要求 (Origin あり) と、ループバック以外の名前で
+        届いた要求 (DNS リバインディング) は 403 にする。
+        """
+        host = headers.get("host")
+        if host and not _is_loopback(urlsplit(f"//{host}").hostname):
+            raise ControlError(403, f"ローカル以外のホスト名での要求は受け付けません: {host}")
+        origin = headers.get("origin")
+        if origin and not _is_loopback(urlsplit(origin).hostname):
+            raise ControlError(403, f"別のオリジンからの要求は受け付けません: {origin}")
+
+    async def _dispatch(self, method, path, body):
+        parts = [part for part in path.split("/") if part]
+        manager = await self._manager_ready()
+        if parts == ["status"]:
+            self._require(method, "GET")
+            return 200, self._status(manager)
+        if parts == ["sessions"]:
+            self._require(method, "POST")
+            options = self._parse_body(body)
+            session = await self._run(self._start_session, manager, options)
+            return 201, session.status()
+        if len(parts) >= 2 and parts[0] == "sessions":
+            session = manager.get(parts[1])
+            if session is None:
+                raise ControlError(404, f"セッションが見つかりません: {parts[1]}")
+            if len(parts) == 2:
+                if method == "DELETE":
+                    if not manager.remove_session(session.name):
+                        raise ControlError(409, f"セッションが停止していません: {session.name}")
+                    return 200, {"removed": session.name}
+                self._require(method, "GET")
+                return 200, session.status()
+            if parts[2:] == ["stop"]:
+                self._require(method, "POST")
+                await self._run(manager.stop_session, session.name)
+                return 200, session.status()
+            if parts[2:] == ["retro"]:
+                self._require(method, "POST")
+                if not session.save_recent_frames():
+                    raise ControlError(409, "保存できる直近のフレームがありません")
+                return 200, session.status()
+        raise ControlError(404, f"未対応のパスです: {path}")
+
+    async def _run(self, func, *args):
+        """待ち時間のある処理をスレッドプールで実行する"""
+        return await self.loop.run_in_executor(None, func, *args)
+
+    @staticmethod
+    def _start_session(manager, options):
+        from session import SessionError
+
+        try:
+            return manager.start_session(manager.new_session(**options))
+        except SessionError as e:
+            raise ControlError(400, f"{e.title}: {e}") from None
+        except OSError as e:
+            raise ControlError(500, f"フォルダの作成/アクセス中にOSエラーが発生しました: {e}") from None
+
+    @staticmethod
+    def _require(method, expected):
+        if method != expected:
+            raise ControlError(405, f"{expected} で呼び出してください")
+
+    @staticmethod
+    def _parse_body(body):
+        try:
+            options = json.loads(body or b"{}")
+        except ValueError:
+            raise ControlError(400, "本文が JSON ではありません") from None
+        if not isinstance(options, dict):
+            raise ControlError(400, "本文は JSON のオブジェクトで指定してください")
+        unknown = set(options) - set(SESSION_OPTIONS)
+        if unknown:
+            raise ControlError(
+                400,
+                f"未対応の項目です: {', '.join(sorted(unknown))} (選択肢: {', '.join(SESSION_OPTIONS)})",
+            )
+        for key, value in options.items():
+            if key in INTEGER_OPTIONS:
+                valid = isinstance(value, (int, str)) and not isinstance(value, bool)
+            else:
+                valid = isinstance(value, str)
+            if not valid:
+                expected = "整数" if key in INTEGER_OPTIONS else "文字列"
+                raise ControlError(400, f"{key} は{expected}で指定してください")
+        return options
+
+    def _status(self, manager):
+        sessions = [session.status() for session in manager.snapshot()]
+        status = {
+            "capturing": bool(manager.active_sessions),
+            "sessions": sessions,
+            "events_dropped": self.hub.dropped_count,
+        }
+        status.update(log_stats())
+        return status
+
+    async def _write_response(self, writer, status, data):
+        payload = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        head = (
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        try:
+            writer.write(head.encode("latin-1") + payload)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _stream_events(self, writer, heartbeat=15.0):
+        """保存・開始・停止のイベントを Server-Sent Events で送り続ける"""
+        queue = self.hub.subscribe()
+        task = asyncio.current_task()
+        self._streams.add(task)
+        try:
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/event-stream; charset=utf-8\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"Connection: close\r\n\r\n"
+            )
+            await writer.drain()
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    # 切断を検出できるよう、一定時間ごとにコメント行を送る
+                    writer.write(b": keep-alive\n\n")
+                else:
+                    if event is None:  # サーバーの終了
+                        break
+                    data = json.dumps(event, ensure_ascii=False)
+                    writer.write(f"event: {event['event']}\ndata: {data}\n\n".encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._streams.discard(task)
+            self.hub.unsubscribe(queue)
+            writer.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ControlClient:
+    """制御 API のクライアント (標準ライブラリのみ。CI のテストなどから使う)
+
+    エラー応答は ControlError を送出する。
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None, token=None, timeout=60.0):
+        self.host = host
+        self.port = port
+        self.socket_path = socket_path
+        self.token = token
+        self.timeout = timeout
+
+    def _connection(self, timeout):
+        if self.socket_path:
+            return _UnixHTTPConnection(self.socket_path, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        return headers
+
+    def request(self, method, path, body=None):
+        connection = self._connection(self.timeout)
+        try:
+            payload = None if body is None else json.dumps(body).encode("utf-8")
+            connection.request(method, path, body=payload, headers=self._headers())
+            response = connection.getresponse()
+            data = json.loads(response.read() or b"{}")
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise ControlError(response.status, data.get("error", response.reason))
+        return data
+
+    def status(self):
+        return self.request("GET", "/status")
+
+    def session(self, name):
+        return self.request("GET", f"/sessions/{name}")
+
+    def start(self, folder, **options):
+        """セッションを開始する。options は SESSION_OPTIONS の項目"""
+        options["folder"] = folder
+        return self.request("POST", "/sessions", options)
+
+    def stop(self, name):
+        return self.request("POST", f"/sessions/{name}/stop")
+
+    def retro(self, name):
+        return self.request("POST", f"/sessions/{name}/retro")
+
+    def remove(self, name):
+        return self.request("DELETE", f"/sessions/{name}")
+
+    def events(self, timeout=None):
+        """イベントを1件ずつ辞書で返すジェネレーター (timeout 秒イベントがなければ終了)"""
+        connection = self._connection(timeout)
+        try:
+            connection.request("GET", "/events", headers=self._headers())
+            response = connection.getresponse()
+            if response.status >= 400:
+                data = json.loads(response.read() or b"{}")
+                raise ControlError(response.status, data.get("error", response.reason))
+            while True:
+                try:
+                    line = response.fp.readline()
+                except socket.timeout:
+                    return
+                if not line:
+                    return
+                if line.startswith(b"data: "):
+                    yield json.loads(line[len(b"data: "):])
+        finally:
+            connection.close()
+
+
+def _add_connection_arguments(parser):
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けるアドレス (既定: ローカルのみ)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", help="TCP の代わりに使う Unix ソケットのパス")
+    parser.add_argument("--token", help="Authorization: Bearer に指定するトークン")
+
+
+def serve_main(argv=None):
+    """GUI なしで SessionManager と制御 API を動かす (python main.py serve)"""
+    parser = argparse.ArgumentParser(description="ヘッドレスで制御 API を起動する")
+    _add_connection_arguments(parser)
+    parser.add_argument(
+        "--memory-limit-mb",
+        type=int,
+        help="プロセスのメモリ使用量の上限 (MB, 0 で無効。既定: 1024)",
+    )
+    args = parser.parse_args(argv)
+
+    from session import SessionManager
+
+    manager = SessionManager()
+    if args.memory_limit_mb is not None:
+        try:
+            manager.set_memory_limit(args.memory_limit_mb)
+        except ValueError as e:
+            parser.error(str(e))
+    server = ControlServer(
+        lambda: manager, args.host, args.port, socket_path=args.socket, token=args.token
+    )
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        logger.error(f"制御 API を開始できませんでした: {e}")
+        return 1
+    finally:
+        # 実行中のセッションの保存とデッキを完成させてから終了する
+        manager.stop_all()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="制御 API のクライアント")
+    _add_connection_arguments(parser)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="全セッションの状態")
+    start_parser = subparsers.add_parser("start", help="セッションを開始する")
+    start_parser.add_argument("folder", help="保存フォルダ")
+    for option in SESSION_OPTIONS:
+        if option != "folder":
+            start_parser.add_argument(
+                f"--{option.replace('_', '-')}",
+                dest=option,
+                type=int if option == "stable_ticks" else str,
+            )
+    for command in ("stop", "retro", "remove", "session"):
+        subparsers.add_parser(command).add_argument("name", help="セッション名")
+    events_parser = subparsers.add_parser("events", help="イベントを表示し続ける")
+    events_parser.add_argument("--timeout", type=float, help="この秒数イベントがなければ終了")
+    args = parser.parse_args(argv)
+
+    client = ControlClient(args.host, args.port, socket_path=args.socket, token=args.token)
+    try:
+        if args.command == "events":
+            for event in client.events(args.timeout):
+                print(json.dumps(event, ensure_ascii=False), flush=True)
+            return 0
+        if args.command == "status":
+            result = client.status()
+        elif args.command == "start":
+            options = {k: getattr(args, k) for k in SESSION_OPTIONS if k != "folder" and getattr(args, k) is not None}
+            result = client.start(args.folder, **options)
+        elif args.command == "session":
+            result = client.session(args.name)
+        elif args.command == "stop":
+            result = client.stop(args.name)
+        elif args.command == "remove":
+            result = client.remove(args.name)
+        else:
+            result = client.retro(args.name)
+    except ControlError as e:
+        print(f"エラー ({e.status}): {e}", file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f"制御 API に接続できませんでした: {e}", file=sys.stderr)
+        return 1
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,453 @@
+# -*- coding: utf-8 -*-
+"""スライドデッキの書き出し (PDF / マニフェスト付き zip)
+
+保存が確定したスライドを1枚ずつデッキに追記する。画像はディスク上の保存済み
+ファイルから1枚ずつ読み、書き込んだら手放すため、スライド数が増えても
+メモリ使用量は一定になる (保持するのはページごとのオフセットとマニフェストの
+記録だけ)。stop_capture で finalize() を呼ぶと、PDF の相互参照表や zip の
+マニフェストを書き込んでデッキが完成する。
+
+指定文字列 "形式" または "形式:キー=値,キー=値":
+    pdf                  PNG/JPEG をそのまま埋め込む PDF (PNG は再圧縮しない)
+    zip                  保存済みファイルと manifest.json を格納した zip
+    オプション:
+        width=1600       この幅を超えるスライドを縮小する
+        format=jpeg:85   デッキ用に再圧縮する保存形式 (encoders の指定)
+        dpi=144          PDF のページサイズの基準解像度
+
+コマンドラインから、保存済みフォルダのジャーナルを元にデッキを作ることもできる:
+    python deck.py 保存フォルダ [--deck pdf:width=1600] [-o 出力ファイル]
+"""
+import argparse
+import heapq
+import json
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import zipfile
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from encoders import create_encoder
+from journal import JOURNAL_FILENAME
+from presets import DECK_PRESETS  # noqa: F401 (再エクスポート)
+
+logger = logging.getLogger(__name__)
+
+DECK_FORMATS = ("pdf", "zip")
+_STOP = object()
+
+
+class DeckOptions:
+    """デッキの形式と変換オプション"""
+
+    def __init__(self, deck_format="pdf", max_width=0, encoder_spec=None, dpi=144):
+        self.format = deck_format
+        self.max_width = max_width
+        self.encoder_spec = encoder_spec
+        self.dpi = dpi
+
+    @property
+    def extension(self):
+        return "." + self.format
+
+
+def parse_deck_spec(spec):
+    """デッキの指定文字列を DeckOptions にする。空欄や "なし" は None。不正な指定は ValueError"""
+    spec = (spec or "").strip()
+    if not spec or spec.lower() in ("なし", "none", "off"):
+        return None
+    name, _, option_text = spec.partition(":")
+    name = name.strip().lower()
+    if name not in DECK_FORMATS:
+        raise ValueError(f"未対応のデッキ形式です: '{spec}' (選択肢: {', '.join(DECK_FORMATS)})")
+    options = DeckOptions(name)
+    for item in filter(None, (part.strip() for part in option_text.split(","))):
+        key, sep, value = item.partition("=")
+        key = key.strip().lower()
+        value = value.strip()
+        if not sep:
+            raise ValueError(f"デッキのオプションは キー=値 で指定してください: '{spec}'")
+        if key in ("width", "dpi"):
+            try:
+                number = int(value)
+            except ValueError:
+                raise ValueError(f"デッキのオプションの値が数値ではありません: '{item}'") from None
+            if number <= 0:
+                raise ValueError(f"デッキのオプションの値は正の数で指定してください: '{item}'")
+            if key == "width":
+                options.max_width = number
+            else:
+                options.dpi = number
+        elif key == "format":
+            create_encoder(value)  # 不正な指定はここで ValueError
+            options.encoder_spec = value
+        else:
+            raise ValueError(f"未対応のデッキのオプションです: '{key}' ({spec})")
+    return options
+
+
+def _png_info(data):
+    """PNG の (幅, 高さ, ビット深度, カラータイプ, インターレース) を返す"""
+    if data[:8] != b"\x89PNG\r\n\x1a\n" or data[12:16] != b"IHDR":
+        return None
+    width, height, depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", data[16:29])
+    return width, height, depth, color_type, interlace
+
+
+def _png_idat(data):
+    """PNG の IDAT チャンクを連結した zlib ストリーム"""
+    chunks = []
+    pos = 8
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        if kind == b"IDAT":
+            chunks.append(data[pos + 8:pos + 8 + length])
+        elif kind == b"IEND":
+            break
+        pos += 12 + length
+    return b"".join(chunks)
+
+
+def _jpeg_info(data):
+    """JPEG の (幅, 高さ, 成分数) を SOF マーカーから読む"""
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if marker in (0xC0, 0xC1, 0xC2):
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return width, height, data[pos + 9]
+        pos += 2 + length
+    return None
+
+
+class PdfStreamWriter:
+    """1ページずつ追記できる最小限の PDF ライター
+
+    ページの画像・内容・ページオブジェクトを追加のたびにファイルへ書き出し、
+    メモリにはオブジェクトのオフセットだけを保持する。ページツリー・カタログ・
+    相互参照表は close() で書き込む。
+    """
+
+    _CATALOG_ID = 1
+    _PAGES_ID = 2
+
+    def __init__(self, path, dpi=144):
+        self.path = path
+        self.scale = 72.0 / dpi
+        self._file = open(path, "wb")
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._offsets = {}
+        self._next_id = 3
+        self._page_ids = []
+
+    @property
+    def page_count(self):
+        return len(self._page_ids)
+
+    def _new_id(self):
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _write_object(self, obj_id, body, stream=None):
+        self._offsets[obj_id] = self._file.tell()
+        self._file.write(f"{obj_id} 0 obj\n".encode("ascii"))
+        self._file.write(body.encode("ascii"))
+        if stream is not None:
+            self._file.write(b"\nstream\n")
+            self._file.write(stream)
+            self._file.write(b"\nendstream")
+        self._file.write(b"\nendobj\n")
+
+    def add_png_page(self, data):
+        """8bit・非インターレースの RGB/グレースケール PNG を再圧縮せずにページにする"""
+        width, height, _, color_type, _ = _png_info(data)
+        colors = 3 if color_type == 2 else 1
+        self._add_image_page(
+            width,
+            height,
+            _png_idat(data),
+            "/FlateDecode",
+            f"/DecodeParms << /Predictor 15 /Colors {colors} /BitsPerComponent 8 /Columns {width} >>",
+            "/DeviceRGB" if colors == 3 else "/DeviceGray",
+        )
+
+    def add_jpeg_page(self, data):
+        width, height, components = _jpeg_info(data)
+        self._add_image_page(
+            width,
+            height,
+            data,
+            "/DCTDecode",
+            "",
+            "/DeviceRGB" if components == 3 else "/DeviceGray",
+        )
+
+    def _add_image_page(self, width, height, stream, filter_name, decode_parms, colorspace):
+        image_id = self._new_id()
+        content_id = self._new_id()
+        page_id = self._new_id()
+        self._write_object(
+            image_id,
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace {colorspace} /BitsPerComponent 8 /Filter {filter_name} "
+            f"{decode_parms} /Length {len(stream)} >>",
+            stream,
+        )
+        page_width = width * self.scale
+        page_height = height * self.scale
+        content = f"q {page_width:.2f} 0 0 {page_height:.2f} 0 0 cm /Im0 Do Q".encode("ascii")
+        self._write_object(content_id, f"<< /Length {len(content)} >>", content)
+        self._write_object(
+            page_id,
+            f"<< /Type /Page /Parent {self._PAGES_ID} 0 R "
+            f"/MediaBox [0 0 {page_width:.2f} {page_height:.2f}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>",
+        )
+        self._page_ids.append(page_id)
+
+    def close(self):
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._page_ids)
+        self._write_object(
+            self._PAGES_ID,
+            f"<< /Type /Pages /Kids [{kids}] /Count {len(self._page_ids)} >>",
+        )
+        self._write_object(self._CATALOG_ID, f"<< /Type /Catalog /Pages {self._PAGES_ID} 0 R >>")
+        xref_offset = self._file.tell()
+        lines = [f"xref\n0 {self._next_id}\n", "0000000000 65535 f \n"]
+        for obj_id in range(1, self._next_id):
+            lines.append(f"{self._offsets[obj_id]:010d} 00000 n \n")
+        lines.append(
+            f"trailer\n<< /Size {self._next_id} /Root {self._CATALOG_ID} 0 R >>\n"
+            f"startxref\n{xref_offset}\n%%EOF\n"
+        )
+        self._file.write("".join(lines).encode("ascii"))
+        self._file.close()
+
+
+class ZipBundleWriter:
+    """スライド画像と manifest.json を格納する zip
+
+    画像は圧縮済みのため無圧縮で格納する。manifest.json は close() で書き込む。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._zip = zipfile.ZipFile(path, "w", zipfile.ZIP_STORED)
+        self.manifest = []
+
+    @property
+    def page_count(self):
+        return len(self.manifest)
+
+    def add(self, name, data, entry):
+        self._zip.writestr(name, data)
+        entry = dict(entry)
+        entry["entry"] = name
+        self.manifest.append(entry)
+
+    def close(self):
+        manifest = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "slides": self.manifest,
+        }
+        self._zip.writestr(
+            "manifest.json",
+            json.dumps(manifest, ensure_ascii=False, indent=2),
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        self._zip.close()
+
+
+class DeckBuilder:
+    """保存が確定したスライドをデッキに追記するスレッド
+
+    add() は保存ワーカー (ジャーナルの同期スレッド) から呼ばれ、パスをキューに
+    積むだけで戻る。保存は複数のワーカーで行われ確定順がキャプチャ順と前後する
+    ため、reorder_window 件まで保存順 (seq) で並べ替えてから書き込む。
+    書き込み中は <デッキ名>.part に書き、finalize() で完成したデッキに置き換える。
+    """
+
+    def __init__(self, path, options, reorder_window=16, on_error=None):
+        self.path = path
+        self.options = options
+        self.reorder_window = reorder_window
+        self.on_error = on_error
+        self.encoder = create_encoder(options.encoder_spec) if options.encoder_spec else None
+        self.page_count = 0
+        self.failed_count = 0
+        self._temp_path = path + ".part"
+        if options.format == "pdf":
+            self._writer = PdfStreamWriter(self._temp_path, options.dpi)
+        else:
+            self._writer = ZipBundleWriter(self._temp_path)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="DeckWriter", daemon=True)
+        self._thread.start()
+
+    def add(self, path, info=None):
+        """保存済みファイルをデッキに追加する (書き込みは別スレッド)"""
+        self._queue.put((path, info or {}))
+
+    def finalize(self, timeout=None):
+        """残りのスライドを書き込んでデッキを完成させる。完成したデッキのパスを返す"""
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"警告: デッキの書き出しが時間内に終わりませんでした: {self.path}")
+            return None
+        return self.path if os.path.exists(self.path) else None
+
+    def _run(self):
+        pending = []  # (seq, 到着順, パス, 情報)
+        arrival = 0
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            path, info = item
+            heapq.heappush(pending, (info.get("seq", arrival), arrival, path, info))
+            arrival += 1
+            while len(pending) > self.reorder_window:
+                self._append(*heapq.heappop(pending)[2:])
+        while pending:
+            self._append(*heapq.heappop(pending)[2:])
+        try:
+            self._writer.close()
+            if self.page_count:
+                os.replace(self._temp_path, self.path)
+                logger.info(f"デッキを書き出しました: {self.path} ({self.page_count} 枚)")
+            else:
+                os.remove(self._temp_path)
+        except OSError as e:
+            logger.exception(f"エラー (デッキ): {type(e).__name__} - {e}\n - デッキ: {self.path}")
+            self._record_failure()
+
+    def _append(self, path, info):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            data, extension = self._prepare(data, os.path.splitext(path)[1].lower())
+            if self.options.format == "pdf":
+                if extension == ".jpg":
+                    self._writer.add_jpeg_page(data)
+                else:
+                    self._writer.add_png_page(data)
+            else:
+                name = os.path.splitext(os.path.basename(path))[0] + extension
+                entry = {"page": self.page_count + 1, "file": os.path.basename(path)}
+                entry.update({k: v for k, v in info.items() if k != "seq"})
+                self._writer.add(f"slides/{self.page_count + 1:04d}_{name}", data, entry)
+            self.page_count += 1
+        except (OSError, cv2.error, ValueError, struct.error) as e:
+            logger.exception(
+                f"エラー (デッキ): {type(e).__name__} - {e}\n - スライド: {path}"
+            )
+            self._record_failure()
+
+    def _prepare(self, data, extension):
+        """必要なら縮小・再圧縮し、(データ, 拡張子) を返す"""
+        needs_decode = self.encoder is not None
+        if self.options.format == "pdf" and not needs_decode:
+            # PDF にそのまま埋め込めるのは JPEG と 8bit 非インターレースの RGB/グレー PNG
+            if extension == ".jpg":
+                needs_decode = _jpeg_info(data) is None
+            else:
+                info = _png_info(data)
+                needs_decode = info is None or info[2] != 8 or info[3] not in (0, 2) or info[4]
+        size = None
+        if self.options.max_width:
+            if extension == ".png" and _png_info(data):
+                size = _png_info(data)[:2]
+            elif extension == ".jpg" and _jpeg_info(data):
+                size = _jpeg_info(data)[:2]
+            if size is None or size[0] > self.options.max_width:
+                needs_decode = True
+        if not needs_decode:
+            return data, extension
+
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("画像をデコードできませんでした")
+        height, width = image.shape[:2]
+        if self.options.max_width and width > self.options.max_width:
+            new_height = max(1, round(height * self.options.max_width / width))
+            image = cv2.resize(
+                image, (self.options.max_width, new_height), interpolation=cv2.INTER_AREA
+            )
+        encoder = self.encoder or create_encoder("png:6")
+        if self.options.format == "pdf" and encoder.extension not in (".png", ".jpg"):
+            # PDF に埋め込めない形式 (WebP など) はロスレスの PNG にする
+            encoder = create_encoder("png:6")
+        buffer = encoder.encode(image)
+        if buffer is None:
+            raise ValueError(f"デッキ用の再圧縮に失敗しました ({encoder.name})")
+        return buffer.tobytes(), encoder.extension
+
+    def _record_failure(self):
+        self.failed_count += 1
+        if self.on_error:
+            self.on_error()
+
+
+def deck_filename(options, started_at=None):
+    """セッションごとのデッキファイル名"""
+    started_at = started_at or datetime.now()
+    return f"slides_{started_at.strftime('%Y%m%d_%H%M%S')}{options.extension}"
+
+
+def build_from_journal(folder, options, output=None):
+    """保存済みフォルダのジャーナルの順にデッキを作る (さかのぼり保存は除く)"""
+    journal_path = os.path.join(folder, JOURNAL_FILENAME)
+    if not os.path.exists(journal_path):
+        raise OSError(f"ジャーナルが見つかりません: {journal_path}")
+    output = output or os.path.join(folder, f"slides{options.extension}")
+    builder = DeckBuilder(output, options)
+    with open(journal_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("type") != "saved" or record.get("retro"):
+                continue
+            path = os.path.join(folder, record["file"].replace("/", os.sep))
+            if os.path.exists(path):
+                info = {k: v for k, v in record.items() if k not in ("type", "file")}
+                builder.add(path, info)
+    return builder.finalize(), builder.page_count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存済みスライドからデッキを作る")
+    parser.add_argument("folder", help="保存フォルダ (session_journal.jsonl のあるフォルダ)")
+    parser.add_argument("--deck", default="pdf", help="デッキの指定 (例: pdf:width=1600,format=jpeg:85)")
+    parser.add_argument("-o", "--output", help="出力ファイル (既定: 保存フォルダ/slides.pdf)")
+    args = parser.parse_args(argv)
+    try:
+        options = parse_deck_spec(args.deck)
+    except ValueError as e:
+        parser.error(str(e))
+    if options is None:
+        parser.error("デッキ形式を指定してください")
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    path, pages = build_from_journal(args.folder, options, args.output)
+    if path is None:
+        print("デッキを作成できませんでした")
+        return 1
+    print(f"{path} ({pages} 枚)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
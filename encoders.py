@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""保存形式 (エンコーダ)
+
+指定形式 "名前" または "名前:値":
+    png[:0-9]          PNG (値は圧縮レベル。既定 3 = 従来と同じ)
+    png-fast           PNG 圧縮レベル1・行フィルタなし。ロスレスで高速 (後で再圧縮する前提)
+    webp-lossless      ロスレス WebP (小さいが遅い)
+    webp[:1-100]       非可逆 WebP (値は品質。既定 90)
+    jpeg[:1-100]       JPEG (値は品質。既定 90)
+    bmp                無圧縮。エンコードは最速だがファイルは最大
+"""
+import cv2
+
+from presets import ENCODER_PRESETS  # noqa: F401 (再エクスポート)
+
+
+class ImageEncoder:
+    """画像をファイル形式のバイト列にエンコードする"""
+
+    def __init__(self, name, extension, params=(), lossless=True, description=""):
+        self.name = name
+        self.extension = extension
+        self.params = list(params)
+        self.lossless = lossless
+        self.description = description
+
+    def encode(self, image_bgr):
+        """BGR 画像をエンコードしたバイト列 (numpy配列) を返す。失敗時は None"""
+        ok, buffer = cv2.imencode(self.extension, image_bgr, self.params)
+        return buffer if ok else None
+
+    def __repr__(self):
+        return f"ImageEncoder({self.name!r})"
+
+
+def _level(value, default, low, high, spec):
+    if value is None:
+        return default
+    try:
+        level = int(value)
+    except ValueError:
+        raise ValueError(f"保存形式の値が数値ではありません: '{spec}'") from None
+    if not low <= level <= high:
+        raise ValueError(f"保存形式の値は {low}〜{high} で指定してください: '{spec}'")
+    return level
+
+
+def create_encoder(spec="png"):
+    """指定文字列からエンコーダを生成する。不正な指定は ValueError"""
+    spec = (spec or "png").strip().lower()
+    name, _, value = spec.partition(":")
+    value = value or None
+
+    if name == "png":
+        level = _level(value, 3, 0, 9, spec)
+        return ImageEncoder(
+            f"png:{level}",
+            ".png",
+            [cv2.IMWRITE_PNG_COMPRESSION, level],
+            description=f"PNG (圧縮レベル {level})",
+        )
+    if name == "png-fast":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+        # 行フィルタの選択がエンコード時間の大半を占めるため無効にする
+        # (IMWRITE_PNG_FILTER は新しい OpenCV のみ。古い版では RLE で代用)
+        if hasattr(cv2, "IMWRITE_PNG_FILTER"):
+            params += [cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_NONE]
+        else:
+            params += [cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]
+        return ImageEncoder("png-fast", ".png", params, description="PNG 高速")
+    if name == "webp-lossless":
+        # OpenCV では品質に100を超える値を指定するとロスレスになる
+        return ImageEncoder(
+            "webp-lossless",
+            ".webp",
+            [cv2.IMWRITE_WEBP_QUALITY, 101],
+            description="WebP ロスレス",
+        )
+    if name == "webp":
+        quality = _level(value, 90, 1, 100, spec)
+        return ImageEncoder(
+            f"webp:{quality}",
+            ".webp",
+            [cv2.IMWRITE_WEBP_QUALITY, quality],
+            lossless=False,
+            description=f"WebP (品質 {quality})",
+        )
+    if name in ("jpeg", "jpg"):
+        quality = _level(value, 90, 1, 100, spec)
+        return ImageEncoder(
+            f"jpeg:{quality}",
+            ".jpg",
+            [cv2.IMWRITE_JPEG_QUALITY, quality],
+            lossless=False,
+            description=f"JPEG (品質 {quality})",
+        )
+    if name == "bmp":
+        return ImageEncoder("bmp", ".bmp", description="BMP (無圧縮)")
+    raise ValueError(
+        f"未対応の保存形式です: '{spec}' "
+        "(png[:0-9], png-fast, webp-lossless, webp[:品質], jpeg[:品質], bmp)"
+    )
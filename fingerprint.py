@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""スライド比較エンジン
+
+フル解像度のフレーム同士を毎回比較する代わりに、縮小した輝度サムネイルと
+知覚ハッシュ (aHash/dHash/pHash) からなるフィンガープリントだけを保持して
+「新しいスライドかどうか」を判定する。フィンガープリントで判定しきれない
+(曖昧な) 場合に限り、フル解像度の差分比較を行う。
+
+動画の圧縮ノイズやカーソルの点滅で誤検出しないよう、画素ごとの許容差・
+事前のぼかし・縮小画像のブロック単位比較 (block) や SSIM (ssim) も選べる。
+StableFrameGate と組み合わせると、変化したフレームが N ティック連続で
+静止してから保存する。
+
+エンジンの指定文字列は "名前" または "名前:キー=値,キー=値" (例: "full:tolerance=8,blur=3")。
+"""
+import logging
+
+import cv2
+import numpy as np
+
+from frame import Frame
+from presets import ENGINE_PRESETS  # noqa: F401 (再エクスポート)
+
+logger = logging.getLogger(__name__)
+
+THUMB_SIZE = (64, 36)  # (幅, 高さ) 16:9 のスライドを想定
+HASH_SIZE = 8  # 8x8 = 64bit ハッシュ
+HASH_METHODS = ("ahash", "dhash", "phash")
+ANALYSIS_SIZE = (320, 180)  # block / ssim エンジンが比較する縮小画像の (幅, 高さ)
+STABILITY_SIZE = (80, 45)  # StableFrameGate が静止を判定する縮小画像の (幅, 高さ)
+
+
+def to_gray(image_cv):
+    """Frame または BGR/BGRA/グレースケール画像をグレースケールに変換する
+
+    Frame の場合は変換結果がキャッシュされるため、同じフレームを何度比較しても
+    変換は1回だけになる。
+    """
+    if isinstance(image_cv, Frame):
+        return image_cv.gray()
+    if image_cv.ndim == 2:
+        return image_cv
+    if image_cv.shape[2] == 4:
+        return cv2.cvtColor(image_cv, cv2.COLOR_BGRA2GRAY)
+    return cv2.cvtColor(image_cv, cv2.COLOR_BGR2GRAY)
+
+
+def smooth(gray, blur):
+    """ノイズ除去用のぼかし (blur はカーネルサイズ。0 以下なら何もしない)"""
+    if blur <= 0:
+        return gray
+    size = blur | 1  # GaussianBlur のカーネルサイズは奇数
+    return cv2.GaussianBlur(gray, (size, size), 0)
+
+
+def full_frame_similarity(gray1, gray2, tolerance=0, out=None):
+    """フル解像度グレースケール画像の類似度 (差分が tolerance 以下の画素の割合) を返す
+
+    tolerance=0 なら従来の is_similar と同じ計算 (1階調でも違えば変化とみなす)。
+    サイズが異なる場合は小さい方に合わせる。out には差分の作業用配列を渡せる。
+    """
+    h1, w1 = gray1.shape[:2]
+    h2, w2 = gray2.shape[:2]
+    if h1 != h2 or w1 != w2:
+        if h1 * w1 < h2 * w2:
+            gray2 = cv2.resize(gray2, (w1, h1), interpolation=cv2.INTER_AREA)
+        else:
+            gray1 = cv2.resize(gray1, (w2, h2), interpolation=cv2.INTER_AREA)
+
+    total_pixels = gray1.size
+    if total_pixels == 0:
+        logger.warning("警告: 類似度計算中の画像サイズが0です。")
+        return 0.0
+    if out is not None and out.shape != gray1.shape:
+        out = None
+    diff = cv2.absdiff(gray1, gray2, dst=out)
+    if tolerance > 0:
+        # 比較結果の bool 配列を作らないよう、差分配列をその場で2値化する
+        cv2.threshold(diff, tolerance, 255, cv2.THRESH_BINARY, dst=diff)
+    non_zero_count = np.count_nonzero(diff)
+    return 1.0 - (non_zero_count / total_pixels)
+
+
+def _bits_to_int(bits):
+    """bool配列を整数ハッシュに詰める"""
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+def average_hash(thumb_gray):
+    """aHash: 8x8 に縮小し、平均より明るい画素を1とする"""
+    small = cv2.resize(
+        thumb_gray, (HASH_SIZE, HASH_SIZE), interpolation=cv2.INTER_AREA
+    )
+    return _bits_to_int(small > small.mean())
+
+
+def difference_hash(thumb_gray):
+    """dHash: 9x8 に縮小し、横方向の隣接画素の大小を1bitとする"""
+    small = cv2.resize(
+        thumb_gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA
+    )
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def perceptual_hash(thumb_gray):
+    """pHash: 32x32 のDCT低周波成分 8x8 を中央値で2値化する"""
+    small = cv2.resize(thumb_gray, (32, 32), interpolation=cv2.INTER_AREA)
+    dct = cv2.dct(np.float32(small))
+    low = dct[:HASH_SIZE, :HASH_SIZE]
+    # DC成分は明るさ全体を表すため中央値の計算から除外する
+    median = np.median(low.ravel()[1:])
+    return _bits_to_int(low > median)
+
+
+_HASH_FUNCS = {
+    "ahash": average_hash,
+    "dhash": difference_hash,
+    "phash": perceptual_hash,
+}
+
+
+def hamming_distance(hash1, hash2):
+    """2つの整数ハッシュのハミング距離"""
+    return bin(hash1 ^ hash2).count("1")
+
+
+class Fingerprint:
+    """1フレーム分のフィンガープリント
+
+    thumb: 縮小した輝度サムネイル (uint8, THUMB_SIZE)
+    hash_value: 知覚ハッシュ (64bit 整数)
+    shape: 元画像の (高さ, 幅)
+    detail: 曖昧な場合の比較に使う、縮小した輝度画像 (既定は縦横 1/4。4K で約 0.5 MB)
+    """
+
+    __slots__ = ("thumb", "hash_value", "shape", "detail")
+
+    def __init__(self, thumb, hash_value, shape, detail=None):
+        self.thumb = thumb
+        self.hash_value = hash_value
+        self.shape = shape
+        self.detail = detail
+
+    @property
+    def nbytes(self):
+        """保持しているデータのおおよそのバイト数"""
+        size = self.thumb.nbytes
+        if self.detail is not None:
+            size += self.detail.nbytes
+        return size
+
+
+class ComparisonEngine:
+    """比較エンジンの共通インターフェース
+
+    prepare(): キャプチャしたフレームから比較用の状態を作る
+    is_similar(): 現在フレームの状態と参照を比較する
+    to_reference(): 保存したフレームの状態を、次回以降の比較用参照に変換する
+    """
+
+    name = "base"
+
+    def __init__(self, threshold=0.95):
+        self.threshold = threshold
+
+    def prepare(self, image_cv):
+        raise NotImplementedError
+
+    def is_similar(self, current, reference):
+        raise NotImplementedError
+
+    def to_reference(self, current):
+        return current
+
+
+class FullFrameEngine(ComparisonEngine):
+    """従来方式: フル解像度のフレームを保持し、毎回全画素を比較する
+
+    tolerance: 変化とみなさない画素ごとの輝度差 (0 なら従来どおり1階調の差も数える)
+    blur: 比較前にかけるぼかしのカーネルサイズ (0 ならなし)
+    """
+
+    name = "full"
+
+    def __init__(self, threshold=0.95, tolerance=0, blur=0):
+        super().__init__(threshold)
+        self.tolerance = tolerance
+        self.blur = blur
+        self._diff = None  # 差分の作業用配列 (ティックごとに確保しない)
+
+    def prepare(self, image_cv):
+        if self.blur > 0:
+            # ぼかした輝度画像を参照として保持し、毎回ぼかし直さない
+            return smooth(to_gray(image_cv), self.blur)
+        return image_cv
+
+    def is_similar(self, current, reference):
+        gray1 = to_gray(current)
+        gray2 = to_gray(reference)
+        if self._diff is None or self._diff.shape != gray1.shape:
+            self._diff = np.empty_like(gray1)
+        similarity = full_frame_similarity(gray1, gray2, self.tolerance, self._diff)
+        return similarity >= self.threshold
+
+
+class FingerprintEngine(ComparisonEngine):
+    """縮小フィンガープリントによる比較エンジン
+
+    1. サムネイルがほぼ同一 (画素差の最大値が same_tolerance 以下) かつ
+       ハッシュ距離が same_hash_distance 以下 -> 同一スライド
+    2. ハッシュ距離が diff_hash_distance 以上、またはサムネイルの変化画素率が
+       diff_ratio 以上 -> 新しいスライド
+    3. それ以外 (曖昧) -> full_res_fallback が有効なら縦横 detail_scale 倍の輝度画像で
+       比較し (画素ごとの許容差は pixel_tolerance)、無効ならサムネイルの変化画素率で判定する
+
+    フル解像度の画像は参照として保持しない。4K では参照1枚あたり約 0.5 MB になる。
+    """
+
+    name = "fingerprint"
+
+    def __init__(
+        self,
+        threshold=0.95,
+        hash_method="dhash",
+        same_tolerance=3,
+        same_hash_distance=2,
+        diff_hash_distance=12,
+        diff_ratio=0.25,
+        full_res_fallback=True,
+        pixel_tolerance=0,
+        detail_scale=0.25,
+    ):
+        super().__init__(threshold)
+        if hash_method not in _HASH_FUNCS:
+            raise ValueError(
+                f"未対応のハッシュ方式です: {hash_method} (選択肢: {', '.join(HASH_METHODS)})"
+            )
+        self.hash_method = hash_method
+        self._hash_func = _HASH_FUNCS[hash_method]
+        self.same_tolerance = same_tolerance
+        self.same_hash_distance = same_hash_distance
+        self.diff_hash_distance = diff_hash_distance
+        self.diff_ratio = diff_ratio
+        self.full_res_fallback = full_res_fallback
+        self.pixel_tolerance = pixel_tolerance
+        if not 0.0 < detail_scale <= 1.0:
+            raise ValueError(f"detail_scale は 0 より大きく 1 以下で指定してください: {detail_scale}")
+        self.detail_scale = detail_scale
+        # 判定内訳 (ベンチマーク・デバッグ用)
+        self.stats = {"same": 0, "different": 0, "ambiguous": 0}
+
+    def fingerprint(self, image_cv):
+        """フレームからフィンガープリントを計算する
+
+        縦横 detail_scale 倍に縮小 (1/4 なら INTER_LINEAR で 2x2 画素の平均になる) して
+        からグレースケール化し、それをさらにサムネイルに縮小する。フル解像度の
+        グレースケール画像は作らず、フル解像度から直接 INTER_AREA で縮小するより速い。
+        """
+        data = image_cv.data if isinstance(image_cv, Frame) else image_cv
+        height, width = data.shape[:2]
+        size = (
+            max(THUMB_SIZE[0], int(round(width * self.detail_scale))),
+            max(THUMB_SIZE[1], int(round(height * self.detail_scale))),
+        )
+        small = cv2.resize(data, size, interpolation=cv2.INTER_LINEAR)
+        detail = image_cv.to_gray(small) if isinstance(image_cv, Frame) else to_gray(small)
+        thumb = cv2.resize(detail, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+        return Fingerprint(thumb, self._hash_func(thumb), (height, width), detail)
+
+    def prepare(self, image_cv):
+        return self.fingerprint(image_cv)
+
+    def to_reference(self, current):
+        detail = current.detail if self.full_res_fallback else None
+        return Fingerprint(current.thumb, current.hash_value, current.shape, detail)
+
+    def is_similar(self, current, reference):
+        distance = hamming_distance(current.hash_value, reference.hash_value)
+        thumb_diff = cv2.absdiff(current.thumb, reference.thumb)
+
+        if (
+            distance <= self.same_hash_distance
+            and int(thumb_diff.max()) <= self.same_tolerance
+        ):
+            self.stats["same"] += 1
+            return True
+
+        changed_ratio = np.count_nonzero(thumb_diff > self.same_tolerance) / float(
+            thumb_diff.size
+        )
+        if distance >= self.diff_hash_distance or changed_ratio >= self.diff_ratio:
+            self.stats["different"] += 1
+            return False
+
+        # 曖昧なケース
+        self.stats["ambiguous"] += 1
+        if self.full_res_fallback and reference.detail is not None and current.detail is not None:
+            similarity = full_frame_similarity(
+                current.detail, reference.detail, self.pixel_tolerance
+            )
+            return similarity >= self.threshold
+        return 1.0 - changed_ratio >= self.threshold
+
+
+class BlockEngine(ComparisonEngine):
+    """縮小画像をブロックに分割し、変化したブロックの数で判定するエンジン
+
+    フレームを ANALYSIS_SIZE のグレースケールに縮小 (blur でぼかし) してから比較する。
+    輝度差が tolerance を超える画素が block_ratio 以上あるブロックを「変化」とし、
+    変化していないブロックの割合が threshold 以上なら同一スライドとする。
+    縮小で圧縮ノイズが平均化され、カーソルのような小さな変化は1ブロック内に
+    収まるため、箇条書きの追加のような局所的な変化とは区別できる。
+    """
+
+    name = "block"
+
+    def __init__(
+        self, threshold=0.99, tolerance=24, blur=3, grid=(16, 9), block_ratio=0.04
+    ):
+        super().__init__(threshold)
+        self.tolerance = tolerance
+        self.blur = blur
+        self.grid = grid
+        self.block_ratio = block_ratio
+
+    def prepare(self, image_cv):
+        if isinstance(image_cv, Frame):
+            small = cv2.resize(image_cv.data, ANALYSIS_SIZE, interpolation=cv2.INTER_AREA)
+            small = image_cv.to_gray(small)
+        else:
+            small = to_gray(
+                cv2.resize(image_cv, ANALYSIS_SIZE, interpolation=cv2.INTER_AREA)
+            )
+        return smooth(small, self.blur)
+
+    def _blocks(self, values):
+        """画素ごとの値をブロックごとの平均 (grid の行x列) にする"""
+        columns, rows = self.grid
+        return cv2.resize(values, (columns, rows), interpolation=cv2.INTER_AREA)
+
+    def block_changes(self, current, reference):
+        """ブロックごとの変化フラグ (bool配列)"""
+        changed = (cv2.absdiff(current, reference) > self.tolerance).astype(np.float32)
+        return self._blocks(changed) >= self.block_ratio
+
+    def is_similar(self, current, reference):
+        changed = self.block_changes(current, reference)
+        return 1.0 - np.count_nonzero(changed) / changed.size >= self.threshold
+
+
+class SSIMEngine(BlockEngine):
+    """縮小画像の構造的類似度 (SSIM) をブロックごとに平均して判定するエンジン
+
+    ブロックの平均 SSIM が block_ssim 未満なら「変化」とする。輝度差ではなく
+    局所的な明るさ・コントラスト・構造の相関を見るため、全体の明るさの揺れや
+    圧縮ノイズに強い。
+    """
+
+    name = "ssim"
+
+    _C1 = (0.01 * 255) ** 2
+    _C2 = (0.03 * 255) ** 2
+
+    def __init__(self, threshold=0.99, blur=0, grid=(16, 9), block_ssim=0.85):
+        super().__init__(threshold, blur=blur, grid=grid)
+        self.block_ssim = block_ssim
+
+    def prepare(self, image_cv):
+        return np.float32(super().prepare(image_cv))
+
+    def ssim_map(self, x, y):
+        """画素ごとの SSIM (ガウス窓 11x11, sigma 1.5)"""
+
+        def window(image):
+            return cv2.GaussianBlur(image, (11, 11), 1.5)
+
+        mu_x = window(x)
+        mu_y = window(y)
+        mu_xx = mu_x * mu_x
+        mu_yy = mu_y * mu_y
+        mu_xy = mu_x * mu_y
+        sigma_xx = window(x * x) - mu_xx
+        sigma_yy = window(y * y) - mu_yy
+        sigma_xy = window(x * y) - mu_xy
+        return ((2 * mu_xy + self._C1) * (2 * sigma_xy + self._C2)) / (
+            (mu_xx + mu_yy + self._C1) * (sigma_xx + sigma_yy + self._C2)
+        )
+
+    def block_changes(self, current, reference):
+        return self._blocks(self.ssim_map(current, reference)) < self.block_ssim
+
+
+class StableFrameGate:
+    """新しいスライドを、N ティック連続で変化しなくなってから確定する
+
+    画面の切り替えアニメーションやフェード中のフレームを保存しないための
+    確認段階。前回保存したスライドと異なるフレームを「保留」とし、その後の
+    stable_ticks 回のフレームがすべて保留フレームと同じ画面であれば確定する。
+    途中で変化した場合は新しいフレームを保留し直す。stable_ticks=0 なら即確定。
+
+    静止の判定はセッションの比較エンジンではなく、STABILITY_SIZE の輝度画像で
+    輝度差が tolerance を超える画素の割合 (max_changed 以下なら静止) で行う。
+    1階調の差も変化とみなす full / fingerprint エンジンと組み合わせても、
+    圧縮ノイズやカーソルの点滅で保留し直し続けることはない。
+    それでも max_wait ティック (既定は stable_ticks の4倍) 確定しなければ、
+    その時点のフレームを確定する。
+    """
+
+    def __init__(self, stable_ticks=0, tolerance=12, max_changed=0.005, max_wait=None):
+        self.stable_ticks = stable_ticks
+        self.tolerance = tolerance
+        self.max_changed = max_changed
+        self.max_wait = max_wait or stable_ticks * 4
+        self.pending = None
+        self.stable_count = 0
+        self.waited = 0
+
+    def reset(self):
+        """保留中のフレームを破棄する (前回のスライドに戻った場合など)"""
+        self.pending = None
+        self.stable_count = 0
+        self.waited = 0
+
+    @staticmethod
+    def thumbnail(image_cv):
+        """静止判定用の縮小した輝度画像"""
+        if isinstance(image_cv, Frame):
+            small = cv2.resize(image_cv.data, STABILITY_SIZE, interpolation=cv2.INTER_AREA)
+            return image_cv.to_gray(small)
+        return to_gray(cv2.resize(image_cv, STABILITY_SIZE, interpolation=cv2.INTER_AREA))
+
+    def changed_ratio(self, thumb, reference):
+        """輝度差が tolerance を超える画素の割合"""
+        diff = cv2.absdiff(thumb, reference)
+        return np.count_nonzero(diff > self.tolerance) / float(diff.size)
+
+    def confirm(self, frame):
+        """前回のスライドと異なるフレームを渡す。保存すべきなら True"""
+        if self.stable_ticks <= 0:
+            return True
+        thumb = self.thumbnail(frame)
+        self.waited += 1
+        if self.pending is not None and self.changed_ratio(thumb, self.pending) <= self.max_changed:
+            self.stable_count += 1
+        else:
+            self.pending = thumb
+            self.stable_count = 0
+        if self.stable_count >= self.stable_ticks or self.waited > self.max_wait:
+            self.reset()
+            return True
+        return False
+
+
+COMPARISON_ENGINES = {
+    FullFrameEngine.name: FullFrameEngine,
+    FingerprintEngine.name: FingerprintEngine,
+    BlockEngine.name: BlockEngine,
+    SSIMEngine.name: SSIMEngine,
+}
+
+
+def _option_value(text):
+    """エンジン指定の値を int / float / bool / (a, b) に変換する"""
+    lowered = text.lower()
+    if lowered in ("true", "yes", "on"):
+        return True
+    if lowered in ("false", "no", "off"):
+        return False
+    if "x" in lowered:  # grid=16x9
+        return tuple(int(part) for part in lowered.split("x"))
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parse_engine_spec(spec):
+    """"名前:キー=値,..." を (名前, オプション辞書) に分解する。不正な指定は ValueError"""
+    spec = (spec or "fingerprint").strip()
+    name, _, option_text = spec.partition(":")
+    options = {}
+    for item in filter(None, (part.strip() for part in option_text.split(","))):
+        key, sep, value = item.partition("=")
+        if not sep or not key.strip():
+            raise ValueError(f"比較エンジンのオプションは キー=値 で指定してください: '{spec}'")
+        try:
+            options[key.strip()] = _option_value(value.strip())
+        except ValueError:
+            raise ValueError(
+                f"比較エンジンのオプションの値が不正です: '{item}' ({spec})"
+            ) from None
+    return name.strip().lower(), options
+
+
+def create_engine(name="fingerprint", **options):
+    """名前 (または "名前:キー=値,..." の指定文字列) から比較エンジンを生成する"""
+    name, spec_options = parse_engine_spec(name)
+    spec_options.update(options)
+    try:
+        engine_class = COMPARISON_ENGINES[name]
+    except KeyError:
+        raise ValueError(
+            f"未対応の比較エンジンです: {name} (選択肢: {', '.join(COMPARISON_ENGINES)})"
+        ) from None
+    try:
+        return engine_class(**spec_options)
+    except TypeError:
+        raise ValueError(
+            f"比較エンジン {name} に指定できないオプションが含まれています: "
+            f"{', '.join(spec_options)}"
+        ) from None
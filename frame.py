@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""キャプチャしたフレームの表現
+
+取得したバッファ (画面キャプチャなら RGB、OpenCV のデコード結果なら BGR) を
+そのまま保持し、グレースケール画像は最初に必要になったときに1回だけ計算して
+キャッシュする。BGR 画像は保存するときにだけ作る。
+
+pool (FramePool) を指定すると、変換結果の配列をプールから取得して使い回す。
+"""
+import cv2
+import numpy as np
+
+_GRAY_CODES = {
+    "BGR": cv2.COLOR_BGR2GRAY,
+    "RGB": cv2.COLOR_RGB2GRAY,
+    "BGRA": cv2.COLOR_BGRA2GRAY,
+    "RGBA": cv2.COLOR_RGBA2GRAY,
+}
+_BGR_CODES = {
+    "RGB": cv2.COLOR_RGB2BGR,
+    "BGRA": cv2.COLOR_BGRA2BGR,
+    "RGBA": cv2.COLOR_RGBA2BGR,
+}
+
+
+class Frame:
+    """1領域分のフレーム
+
+    data: 取得したままの画像バッファ (HxWxC uint8。切り出し領域ならビュー)
+    order: チャンネル順 ("RGB", "BGR", "RGBA", "BGRA", "GRAY")
+    pool: 変換結果の確保に使うバッファプール (None なら毎回確保する)
+    """
+
+    __slots__ = ("data", "order", "pool", "_gray", "_bgr")
+
+    def __init__(self, data, order="BGR", pool=None):
+        if order not in _GRAY_CODES and order != "GRAY":
+            raise ValueError(f"未対応のチャンネル順です: {order}")
+        self.data = data
+        self.order = order
+        self.pool = pool
+        self._gray = data if order == "GRAY" else None
+        self._bgr = data if order == "BGR" else None
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def size(self):
+        return self.data.size
+
+    @property
+    def nbytes(self):
+        """保持しているバッファの合計バイト数 (キャッシュを含む)"""
+        size = self.data.nbytes
+        if self._gray is not None and self._gray is not self.data:
+            size += self._gray.nbytes
+        if self._bgr is not None and self._bgr is not self.data:
+            size += self._bgr.nbytes
+        return size
+
+    def gray(self):
+        """グレースケール画像 (初回のみ変換し、以後はキャッシュを返す)"""
+        if self._gray is None:
+            self._gray = cv2.cvtColor(
+                self.data, _GRAY_CODES[self.order], dst=self._buffer(self.data.shape[:2])
+            )
+        return self._gray
+
+    def to_gray(self, image):
+        """このフレームと同じチャンネル順の画像 (縮小画像など) をグレースケールにする"""
+        if self.order == "GRAY":
+            return image
+        return cv2.cvtColor(image, _GRAY_CODES[self.order])
+
+    def bgr(self):
+        """保存用の BGR 画像 (必要になったときに1回だけ作る)"""
+        if self._bgr is None:
+            code = cv2.COLOR_GRAY2BGR if self.order == "GRAY" else _BGR_CODES[self.order]
+            self._bgr = cv2.cvtColor(
+                self.data, code, dst=self._buffer(self.data.shape[:2] + (3,))
+            )
+        return self._bgr
+
+    def _buffer(self, shape):
+        """変換先の配列 (プールがなければ None を返し、OpenCV に確保させる)"""
+        if self.pool is None:
+            return None
+        return self.pool.acquire(shape)
+
+    def release_cache(self):
+        """キャッシュした変換結果を破棄する"""
+        if self._gray is not self.data:
+            self._gray = None
+        if self._bgr is not self.data:
+            self._bgr = None
+
+
+def frame_from_pil(image, pool=None):
+    """PIL 画像をコピーを最小限にして Frame にする
+
+    RGB/RGBA 画像は convert() を呼ばず、np.asarray で1回だけバッファを取り出す
+    (読み取り専用の配列になる)。pool を指定した場合は、取り出したバッファを
+    プールの配列に写して手放す。さかのぼり保存などで保持されるフレームも
+    プールの上限に含まれ、上限に達していれば取り込む前に PoolExhaustedError になる。
+    """
+    if image.mode in ("RGB", "RGBA"):
+        order = image.mode
+    elif image.mode == "L":
+        order = "GRAY"
+    else:
+        image = image.convert("RGB")
+        order = "RGB"
+    data = np.asarray(image)
+    if pool is not None:
+        buffer = pool.acquire(data.shape, data.dtype)
+        np.copyto(buffer, data)
+        data = buffer
+    return Frame(data, order, pool)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""長時間セッション向けのメモリ管理
+
+FramePool: フレーム用バッファ (デコード先・グレースケール・BGR 変換先) を
+    形状ごとに使い回す。ティックごとに大きな配列を確保・解放しないため、
+    ヒープの断片化によるメモリの増加を防ぐ。
+FrameRingBuffer: 直近 N 秒のフレームを保持し、後から「さかのぼって保存」できる
+    ようにする。枚数とバイト数に上限を持つ。
+
+バッファの返却は明示的に行わない。プールが配列への唯一の参照を持っている
+(参照カウントが基準値に戻った) 配列を空きとみなす。numpy のビュー (領域の
+切り出しなど) や比較用の参照が残っている間は使用中のままになるため、
+使用中のバッファを上書きすることはない。
+"""
+import logging
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _free_refcount():
+    """プールのリストだけが参照している配列の、走査中の参照カウント"""
+    probe = [np.empty(1, dtype=np.uint8)]
+    for buffer in probe:
+        return sys.getrefcount(buffer)
+
+
+_FREE_REFS = _free_refcount()
+
+
+class PoolExhaustedError(MemoryError):
+    """メモリ上限のため新しいバッファを確保できない"""
+
+
+class FramePool:
+    """形状・型ごとに配列を使い回すバッファプール
+
+    max_bytes: プールが確保する配列の合計バイト数の上限 (None なら無制限)。
+        上限に達した場合は、空きバッファの解放と on_pressure に登録した
+        関数 (リングバッファの縮小など) を試し、それでも足りなければ
+        PoolExhaustedError を送出する。
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.allocated_bytes = 0
+        self.reused_count = 0
+        self.allocated_count = 0
+        self._buffers = {}  # (shape, dtype) -> [配列]
+        self._pressure_handlers = []
+        # 保存ワーカーの BGR 変換とキャプチャスレッドから同時に呼ばれる
+        self._lock = threading.Lock()
+
+    def on_pressure(self, handler):
+        """上限到達時に呼ぶ関数を登録する (handler() は解放を試みるだけでよい)"""
+        self._pressure_handlers.append(handler)
+
+    def acquire(self, shape, dtype=np.uint8):
+        """空いている配列を返す。なければ新しく確保する (内容は不定)"""
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        key = (shape, dtype.str)
+        with self._lock:
+            buffer = self._find_free(key)
+            if buffer is not None:
+                self.reused_count += 1
+                return buffer
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            if self.max_bytes is not None and self.allocated_bytes + nbytes > self.max_bytes:
+                self._trim_locked()
+        if self.max_bytes is not None and self.allocated_bytes + nbytes > self.max_bytes:
+            # リングバッファなどに保持しているフレームを手放してもらう
+            for handler in self._pressure_handlers:
+                handler()
+        with self._lock:
+            buffer = self._find_free(key)
+            if buffer is not None:
+                self.reused_count += 1
+                return buffer
+            if self.max_bytes is not None:
+                self._trim_locked()
+                if self.allocated_bytes + nbytes > self.max_bytes:
+                    raise PoolExhaustedError(
+                        f"フレームバッファの上限 ({self.max_bytes / 1e6:.0f} MB) に達しました "
+                        f"(使用中 {self.allocated_bytes / 1e6:.0f} MB, 要求 {nbytes / 1e6:.1f} MB)"
+                    )
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers.setdefault(key, []).append(buffer)
+            self.allocated_bytes += buffer.nbytes
+            self.allocated_count += 1
+            return buffer
+
+    def _find_free(self, key):
+        for buffer in self._buffers.get(key, ()):
+            if sys.getrefcount(buffer) <= _FREE_REFS:
+                return buffer
+        return None
+
+    def trim(self):
+        """空いているバッファを解放し、解放したバイト数を返す"""
+        with self._lock:
+            return self._trim_locked()
+
+    def _trim_locked(self):
+        freed = 0
+        for key in list(self._buffers):
+            kept = []
+            for buffer in self._buffers[key]:
+                if sys.getrefcount(buffer) <= _FREE_REFS:
+                    freed += buffer.nbytes
+                else:
+                    kept.append(buffer)
+            if kept:
+                self._buffers[key] = kept
+            else:
+                del self._buffers[key]
+        self.allocated_bytes -= freed
+        return freed
+
+    @property
+    def in_use_bytes(self):
+        """キャプチャ・保存・参照のいずれかで使用中のバイト数"""
+        with self._lock:
+            return sum(
+                buffer.nbytes
+                for buffers in self._buffers.values()
+                for buffer in buffers
+                if sys.getrefcount(buffer) > _FREE_REFS
+            )
+
+
+class FrameRingBuffer:
+    """直近 seconds 秒のフレームを保持するリングバッファ
+
+    push() には1ティック分の領域ごとのフレームのリストを渡す。追加する前に、
+    seconds 秒より古いフレームと、追加すると max_frames 枚または max_bytes を
+    超える分を古い順に捨てる (上限を超えてから減らすのではなく、上限内に収まる
+    分だけ受け入れる)。1ティック分だけで max_bytes を超える場合は保持しない。
+    保持中のフレームのバッファはプールに戻らないため、プールの上限到達時には
+    shrink() で手放す。
+    """
+
+    def __init__(self, seconds=10.0, max_frames=64, max_bytes=None):
+        self.seconds = seconds
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = deque()  # (時刻, ラベル, フレームのリスト, バイト数)
+        # 追加はキャプチャスレッド、取り出しは UI スレッドから行われる
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def push(self, frames, label, timestamp=None):
+        """フレームを追加する。上限のため保持しなかったら False"""
+        now = time.monotonic() if timestamp is None else timestamp
+        size = sum(frame.nbytes for frame in frames if frame is not None)
+        with self._lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                self._entries.clear()
+                self.nbytes = 0
+                return False
+            while self._entries and (
+                now - self._entries[0][0] > self.seconds
+                or len(self._entries) + 1 > self.max_frames
+                or (self.max_bytes is not None and self.nbytes + size > self.max_bytes)
+            ):
+                self._pop_oldest()
+            self._entries.append((now, label, list(frames), size))
+            self.nbytes += size
+            return True
+
+    def _pop_oldest(self):
+        entry = self._entries.popleft()
+        self.nbytes -= entry[3]
+
+    def snapshot(self):
+        """保持中の (ラベル, フレームのリスト) を古い順に返す"""
+        with self._lock:
+            return [(label, frames) for _, label, frames, _ in self._entries]
+
+    def shrink(self, keep=0):
+        """古いフレームを捨てて keep 枚にし、捨てた枚数を返す"""
+        with self._lock:
+            dropped = 0
+            while len(self._entries) > keep:
+                self._pop_oldest()
+                dropped += 1
+            return dropped
+
+    def clear(self):
+        return self.shrink(0)
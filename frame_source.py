@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""フレームソース
+
+キャプチャループに画像を供給する入力元。画面キャプチャ (ScreenSource) の他に、
+録画済みの動画ファイル (VideoFileSource) や画像フォルダ (ImageDirectorySource)
+から再生するバックエンドを持つ。再生系は実時間に合わせず、デコードできる
+速さでフレームを返す (realtime = False)。
+
+read() は領域ごとの Frame のリストを返す。一時的な取得失敗時は None を返し、
+入力の終端に達した場合は finished を True にして None を返す。
+pool (FramePool) を指定すると、デコード先や変換先のバッファを使い回す。
+"""
+import logging
+import os
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from frame import Frame, frame_from_pil
+from metrics import CaptureMetrics
+from regions import FULL_SCREEN, grab_regions
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".webp", ".tif", ".tiff")
+
+
+def crop_regions(frame, regions, origin=(0, 0), screen_bbox=None):
+    """フレームから各領域を切り出す (バッファはコピーせずビューを共有する)
+
+    origin: frame の左上が対応する仮想デスクトップ座標
+    screen_bbox: 画面全体の領域 (bbox が None) として切り出す矩形。None ならフレーム全体
+    """
+    if len(regions) == 1 and regions[0].bbox is None and screen_bbox is None:
+        return [frame]
+    height, width = frame.data.shape[:2]
+    ox, oy = origin
+    crops = []
+    for region in regions:
+        bbox = region.bbox or screen_bbox
+        if bbox is None:
+            crops.append(frame)
+            continue
+        left, top, right, bottom = bbox
+        view = frame.data[
+            max(0, top - oy):max(0, min(bottom - oy, height)),
+            max(0, left - ox):max(0, min(right - ox, width)),
+        ]
+        if view.shape[:2] != (bottom - top, right - left):
+            # 取得範囲の外にはみ出した領域 (モニター構成の変更など)。
+            # 同じ警告はログ側で間引かれる
+            logger.warning(
+                f"警告: 領域 {region.name} {bbox} の一部が取得範囲の外にあります "
+                f"(切り出せた大きさ: {view.shape[1]}x{view.shape[0]})"
+            )
+        crops.append(Frame(view, frame.order, frame.pool))
+    return crops
+
+
+class FrameSource:
+    """フレームソースの共通インターフェース"""
+
+    realtime = True  # True ならスケジューラの間隔でキャプチャする
+    description = ""
+
+    def __init__(self, regions=None, metrics=None, pool=None):
+        self.regions = regions or [FULL_SCREEN]
+        self.finished = False
+        self.frames_read = 0
+        # 取得 (grab) と変換 (convert) の処理時間の記録先
+        self.metrics = metrics or CaptureMetrics()
+        self.pool = pool
+
+    def read(self):
+        raise NotImplementedError
+
+    def timestamp_label(self):
+        """直近に読んだフレームの、ファイル名用タイムスタンプ"""
+        return datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ScreenSource(FrameSource):
+    """PIL.ImageGrab による画面キャプチャ"""
+
+    description = "画面"
+
+    def read(self):
+        with self.metrics.stage("grab"):
+            grabbed = grab_regions(self.regions)
+        if grabbed is None:
+            logger.error(
+                "エラー: ImageGrab.grab() が None を返しました。スクリーンショットを取得できませんでした。"
+            )
+            return None
+        screenshot, origin, screen_bbox = grabbed
+        # PIL -> NumPy はバッファの取り出し1回のみ。BGR への変換は保存時まで行わない
+        # (取り出したバッファはプールの配列に写し、保持するフレームをプールの上限に含める)
+        with self.metrics.stage("convert"):
+            frame = frame_from_pil(screenshot, self.pool)
+            frames = crop_regions(frame, self.regions, origin, screen_bbox)
+        self.frames_read += 1
+        return frames
+
+
+class VideoFileSource(FrameSource):
+    """cv2.VideoCapture で動画ファイルから再生する
+
+    sample_interval 秒ごとに1フレームをデコードし、間のフレームは
+    grab() で読み飛ばす (デコード結果を取り出さないため高速)。
+    """
+
+    realtime = False
+
+    def __init__(self, path, regions=None, sample_interval=1.0, metrics=None, pool=None):
+        super().__init__(regions, metrics, pool)
+        self.path = path
+        self.description = os.path.basename(path)
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise OSError(f"動画ファイルを開けませんでした: {path}")
+        fps = self.capture.get(cv2.CAP_PROP_FPS) or 0.0
+        if fps <= 0 or fps != fps:  # 取得できない場合や NaN
+            fps = 30.0
+        self.fps = fps
+        self.frame_step = max(1, int(round(sample_interval * fps)))
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        self.frame_shape = (
+            int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT) or 0),
+            int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH) or 0),
+            3,
+        )
+        self.position_ms = 0.0
+
+    def read(self):
+        if self.finished:
+            return None
+        with self.metrics.stage("grab"):
+            # 前回のサンプルから frame_step - 1 フレームを読み飛ばす
+            if self.frames_read:
+                for _ in range(self.frame_step - 1):
+                    if not self.capture.grab():
+                        self.finished = True
+                        return None
+            # プールの空きバッファに直接デコードする (サイズが違えば OpenCV が確保し直す)
+            buffer = None
+            if self.pool is not None and all(self.frame_shape):
+                buffer = self.pool.acquire(self.frame_shape)
+            ok, image_cv = self.capture.read(buffer)
+        if not ok or image_cv is None:
+            self.finished = True
+            return None
+        self.position_ms = self.capture.get(cv2.CAP_PROP_POS_MSEC)
+        self.frames_read += 1
+        return crop_regions(Frame(image_cv, "BGR", self.pool), self.regions)
+
+    def timestamp_label(self):
+        """動画内の再生位置 (時分秒_ミリ秒)"""
+        total_ms = int(self.position_ms)
+        seconds, ms = divmod(total_ms, 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours:02d}{minutes:02d}{seconds:02d}_{ms:03d}"
+
+    def close(self):
+        self.capture.release()
+
+
+class ImageDirectorySource(FrameSource):
+    """フォルダ内の画像をファイル名順に再生する"""
+
+    realtime = False
+
+    def __init__(self, path, regions=None, metrics=None, pool=None):
+        super().__init__(regions, metrics, pool)
+        self.path = path
+        self.description = os.path.basename(os.path.normpath(path))
+        self.files = sorted(
+            name
+            for name in os.listdir(path)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        self.frame_count = len(self.files)
+        self._index = 0
+        self._current_name = ""
+
+    def read(self):
+        while self._index < len(self.files):
+            name = self.files[self._index]
+            self._index += 1
+            with self.metrics.stage("grab"):
+                try:
+                    # 日本語を含むパスでも読めるよう cv2.imread ではなく imdecode を使う
+                    data = np.fromfile(os.path.join(self.path, name), dtype=np.uint8)
+                    image_cv = cv2.imdecode(data, cv2.IMREAD_COLOR)
+                except OSError as e:
+                    logger.warning(f"警告: 画像を読み込めなかったためスキップします: {name} ({e})")
+                    continue
+            if image_cv is None:
+                logger.warning(f"警告: 画像を読み込めなかったためスキップします: {name}")
+                continue
+            self._current_name = name
+            self.frames_read += 1
+            return crop_regions(Frame(image_cv, "BGR", self.pool), self.regions)
+        self.finished = True
+        return None
+
+    def timestamp_label(self):
+        """元画像のファイル名 (拡張子なし)"""
+        return os.path.splitext(self._current_name)[0]
+
+
+def create_frame_source(spec, regions=None, sample_interval=1.0, metrics=None, pool=None):
+    """入力指定からフレームソースを生成する
+
+    空文字列なら画面キャプチャ、フォルダなら画像フォルダ、それ以外は動画ファイル。
+    """
+    spec = (spec or "").strip()
+    if not spec:
+        return ScreenSource(regions, metrics, pool)
+    if os.path.isdir(spec):
+        return ImageDirectorySource(spec, regions, metrics, pool)
+    if os.path.isfile(spec):
+        return VideoFileSource(
+            spec, regions, sample_interval=sample_interval, metrics=metrics, pool=pool
+        )
+    raise OSError(f"入力ファイルまたはフォルダが見つかりません: {spec}")
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""クラッシュに強い保存とセッションジャーナル
+
+保存ワーカーは画像を一時ファイル (<保存名>.part) に書き込んでから
+SessionJournal.commit() に渡す。ジャーナルの同期スレッドは確定待ちの
+ファイルをまとめて次の順に処理する:
+
+1. 各一時ファイルを fsync する
+2. 保存名に rename する (同じフォルダ内なので原子的に置き換わる)
+3. フォルダを fsync する (rename を永続化する。Windows では不要なので省略)
+4. ジャーナル (session_journal.jsonl) に保存記録を追記して fsync する
+
+ジャーナルに記録があるファイルは内容まで書き込み済みであることが保証される。
+途中でクラッシュしても、保存名のファイルが途中までしか書かれていない状態には
+ならず、残るのは .part ファイルだけになる。fsync は sync_interval 秒ごと
+(または sync_batch 件たまったとき) にまとめて行うため、保存ワーカーも
+キャプチャスレッドも fsync を待たない。
+
+再起動時は recover() でジャーナルを読むだけで、保存済み枚数・最終保存ファイル・
+各ファイルのフィンガープリントとサイズを復元できる (画像の再読み込みや
+再ハッシュは行わない)。
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILENAME = "session_journal.jsonl"
+TEMP_SUFFIX = ".part"
+
+
+def temp_path_for(path):
+    """保存先 path に対応する書き込み中の一時ファイル名"""
+    return path + TEMP_SUFFIX
+
+
+def fsync_directory(path):
+    """フォルダのエントリ (rename の結果) を永続化する"""
+    if sys.platform == "win32":
+        # NTFS はメタデータをジャーナリングしており、フォルダを開いて fsync できない
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_file(path):
+    # Windows の _commit は書き込み可能なハンドルが必要
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _PendingCommit:
+    __slots__ = ("temp_path", "path", "record", "on_commit", "on_error")
+
+    def __init__(self, temp_path, path, record, on_commit, on_error):
+        self.temp_path = temp_path
+        self.path = path
+        self.record = record
+        self.on_commit = on_commit
+        self.on_error = on_error
+
+
+class SessionJournal:
+    """保存記録の追記専用ジャーナルと、まとめて行う fsync
+
+    folder: ジャーナルを置くフォルダ (保存記録のファイル名はここからの相対パス)
+    sync_interval: 確定待ちのファイルを同期する間隔 (秒)
+    sync_batch: この件数たまったら間隔を待たずに同期する
+    """
+
+    def __init__(self, folder, sync_interval=1.0, sync_batch=16, metrics=None):
+        self.folder = folder
+        self.path = os.path.join(folder, JOURNAL_FILENAME)
+        self.sync_interval = sync_interval
+        self.sync_batch = max(1, int(sync_batch))
+        self.metrics = metrics  # 同期 (sync) の処理時間の記録先
+        self.committed_count = 0
+        self.sync_count = 0
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._pending = []
+        self._events = []  # セッション開始/終了などの記録 (次の同期で書き込む)
+        self._syncing = 0  # 同期処理中の件数
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="JournalSync", daemon=True
+        )
+        self._thread.start()
+
+    def commit(self, temp_path, path, record, on_commit=None, on_error=None):
+        """書き込み済みの一時ファイルを確定待ちに積む (同期を待たずに戻る)
+
+        on_commit(path): rename とジャーナルへの記録が永続化された後に呼ばれる
+        on_error(): 同期または rename に失敗したときに呼ばれる
+        """
+        with self._cond:
+            if self._closed:
+                raise OSError(f"ジャーナルは閉じられています: {self.path}")
+            self._pending.append(_PendingCommit(temp_path, path, record, on_commit, on_error))
+            if len(self._pending) >= self.sync_batch:
+                self._cond.notify_all()
+
+    def log_event(self, event, **fields):
+        """セッションの開始/終了などを記録する (次の同期でまとめて書き込む)"""
+        record = {
+            "type": "session",
+            "event": event,
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+        }
+        record.update(fields)
+        with self._cond:
+            if self._closed:
+                return
+            self._events.append(record)
+
+    def flush(self, timeout=None):
+        """確定待ちをすぐに同期し、完了するまで待つ。完了したら True"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._pending or self._events or self._syncing:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """残りを同期してからジャーナルを閉じる"""
+        flushed = self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=1.0 if timeout is None else timeout)
+        if not self._thread.is_alive():
+            self._file.close()
+        return flushed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not (self._pending or self._events or self._closed):
+                    self._cond.wait(self.sync_interval)
+                if self._closed and not (self._pending or self._events):
+                    return
+                batch, self._pending = self._pending, []
+                events, self._events = self._events, []
+                self._syncing = len(batch) + len(events)
+            try:
+                if batch or events:
+                    self._sync(batch, events)
+            finally:
+                with self._cond:
+                    self._syncing = 0
+                    self._cond.notify_all()
+
+    def _sync(self, batch, events):
+        start = time.perf_counter()
+        committed = []
+        folders = set()
+        for item in batch:
+            try:
+                _fsync_file(item.temp_path)
+                os.replace(item.temp_path, item.path)
+                folders.add(os.path.dirname(item.path))
+                committed.append(item)
+            except OSError as e:
+                logger.exception(
+                    f"エラー (保存の確定): {type(e).__name__} - {e}\n - 保存試行パス: {item.path}"
+                )
+                if item.on_error:
+                    item.on_error()
+        lines = [json.dumps(record, ensure_ascii=False) + "\n" for record in events]
+        try:
+            for folder in folders:
+                fsync_directory(folder)
+            for item in committed:
+                record = dict(item.record)
+                record["file"] = os.path.relpath(item.path, self.folder).replace(os.sep, "/")
+                lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.write("".join(lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except OSError as e:
+            # ファイル自体は保存名で書き込み済み。ジャーナルだけが欠ける
+            logger.exception(
+                f"エラー (ジャーナル): {type(e).__name__} - {e}\n - ジャーナル: {self.path}"
+            )
+        self.sync_count += 1
+        self.committed_count += len(committed)
+        if self.metrics is not None:
+            self.metrics.record("sync", (time.perf_counter() - start) * 1000.0)
+        for item in committed:
+            if item.on_commit:
+                item.on_commit(item.path)
+
+
+class JournalState:
+    """ジャーナルから復元した保存状態
+
+    saved: 保存記録 (ファイルの相対パス -> 記録) を保存順に並べた辞書
+    """
+
+    def __init__(self):
+        self.saved = {}
+        self.total_bytes = 0
+        self.sessions = 0
+        self.removed_temp_files = 0
+        self.missing_files = 0
+
+    @property
+    def saved_count(self):
+        return len(self.saved)
+
+    @property
+    def last_saved_filename(self):
+        if not self.saved:
+            return ""
+        return os.path.basename(next(reversed(self.saved)))
+
+
+def recover(folder):
+    """ジャーナルを読み込んで保存状態を復元する
+
+    書き込み途中で残った .part ファイルを削除し、ジャーナルにあるが
+    フォルダから消えているファイルは除外する。フォルダ内の画像の読み込みや
+    再ハッシュは行わない (フォルダ一覧の取得のみ)。
+    """
+    state = JournalState()
+    listings = {}
+
+    def exists(relative):
+        directory, name = os.path.split(relative.replace("/", os.sep))
+        if directory not in listings:
+            try:
+                listings[directory] = set(os.listdir(os.path.join(folder, directory)))
+            except OSError:
+                listings[directory] = set()
+        return name in listings[directory]
+
+    path = os.path.join(folder, JOURNAL_FILENAME)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    kind = record["type"]
+                except (ValueError, KeyError, TypeError):
+                    # 追記中のクラッシュで最後の行が途中までしかない場合など
+                    logger.warning(
+                        f"警告: ジャーナルの {line_number} 行目を読み込めないためスキップします: {path}"
+                    )
+                    continue
+                if kind == "session" and record.get("event") == "start":
+                    state.sessions += 1
+                elif kind == "saved" and "file" in record:
+                    state.saved.pop(record["file"], None)
+                    state.saved[record["file"]] = record
+
+    for relative in list(state.saved):
+        if not exists(relative):
+            del state.saved[relative]
+            state.missing_files += 1
+    state.total_bytes = sum(record.get("bytes", 0) for record in state.saved.values())
+
+    # 書き込み途中の一時ファイル (確定前にクラッシュしたもの) を片付ける
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if name.endswith(TEMP_SUFFIX):
+                try:
+                    os.remove(os.path.join(root, name))
+                    state.removed_temp_files += 1
+                except OSError as e:
+                    logger.warning(
+                        f"警告: 書き込み途中の一時ファイルを削除できませんでした: {name} ({e})"
+                    )
+    if state.saved or state.removed_temp_files:
+        logger.info(
+            f"ジャーナルから復元しました: 保存済み {state.saved_count} 枚, "
+            f"一時ファイル削除 {state.removed_temp_files} 件, 欠落 {state.missing_files} 件 ({folder})"
+        )
+    return state
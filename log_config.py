@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""ノンブロッキングなログ出力
+
+キャプチャスレッドや保存ワーカーはログ記録をキューに積むだけにし、ファイルと
+コンソールへの書き込みは QueueListener のスレッドで行う。ネットワーク上の
+ホームフォルダなど書き込みが遅い環境でも、キャプチャ処理が I/O で止まらない。
+
+- ファイルはサイズでローテーションする (既定 5 MB x 3 世代)
+- 呼び出し箇所ごとに件数を制限する (既定 10 秒あたり 20 件)。超えた分は捨て、
+  次に出力する記録に省略した件数を付ける
+- 同じ警告・エラーが繰り返される場合は dedup_window 秒に1回だけ出力する。
+  スタックトレースは同じエラーの初回にだけ出力する
+- キューが満杯のときは記録を捨てて件数を数える (呼び出し側を待たせない)
+- structured=True なら1行1記録の JSON で出力する。extra={...} の値も項目になる
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(threadName)s - %(message)s"
+
+# LogRecord の標準の属性 (これ以外は extra で渡された値として JSON に含める)
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_listener = None
+_queue_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1記録の JSON 形式"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["traceback"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """呼び出し箇所ごとの件数制限と、繰り返される警告・エラーの重複除去
+
+    記録を出力する側ではなく、記録を作ったスレッドで判定するため、
+    捨てる記録はキューにも積まれない。
+    """
+
+    def __init__(self, rate_limit=20, rate_period=10.0, dedup_window=300.0, max_keys=512):
+        super().__init__()
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.dedup_window = dedup_window
+        self.max_keys = max_keys
+        self.suppressed_count = 0
+        self._lock = threading.Lock()
+        self._sites = OrderedDict()  # 呼び出し箇所 -> [期間の開始, 件数, 省略した件数]
+        self._repeats = OrderedDict()  # (呼び出し箇所, メッセージ) -> [最終出力時刻, 省略した件数]
+
+    def filter(self, record):
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            if record.levelno >= logging.WARNING:
+                key = (site, record.getMessage())
+                repeat = self._repeats.get(key)
+                if repeat is not None:
+                    self._repeats.move_to_end(key)
+                    if now - repeat[0] < self.dedup_window:
+                        repeat[1] += 1
+                        self.suppressed_count += 1
+                        return False
+                    # スタックトレースは初回に出力済み
+                    record.exc_info = None
+                    record.exc_text = None
+                    if repeat[1]:
+                        self._annotate(record, f"同じメッセージ {repeat[1]} 件を省略")
+                    repeat[0] = now
+                    repeat[1] = 0
+                else:
+                    self._remember(self._repeats, key, [now, 0])
+
+            state = self._sites.get(site)
+            if state is None:
+                state = self._remember(self._sites, site, [now, 0, 0])
+            else:
+                self._sites.move_to_end(site)
+            if now - state[0] >= self.rate_period:
+                state[0] = now
+                state[1] = 0
+            if state[1] >= self.rate_limit:
+                state[2] += 1
+                self.suppressed_count += 1
+                return False
+            state[1] += 1
+            if state[2]:
+                self._annotate(record, f"件数制限により {state[2]} 件を省略")
+                state[2] = 0
+        return True
+
+    def _remember(self, table, key, value):
+        table[key] = value
+        if len(table) > self.max_keys:
+            table.popitem(last=False)
+        return value
+
+    @staticmethod
+    def _annotate(record, note):
+        record.msg = f"{record.getMessage()} ({note})"
+        record.args = None
+        record.suppressed = note
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯なら待たずに記録を捨てる QueueHandler"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped_count = 0
+
+    def prepare(self, record):
+        # 出力側のフォーマッタ (テキスト / JSON) が使えるよう、メッセージと
+        # スタックトレースの文字列化だけをここで行う
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_count += 1
+
+
+def setup_logging(
+    log_file,
+    level=logging.INFO,
+    structured=False,
+    max_bytes=5 * 1024 * 1024,
+    backup_count=3,
+    queue_size=10000,
+    console=True,
+):
+    """ルートロガーをキュー経由の出力に切り替える。2回目以降の呼び出しは何もしない"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return _listener
+    formatter = JsonFormatter() if structured else logging.Formatter(LOG_FORMAT)
+    handlers = [
+        # 最初の記録まで開かず、ウィンドウ表示を待たせない
+        logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=max_bytes,
+            backupCount=backup_count,
+            encoding="utf-8",
+            delay=True,
+        )
+    ]
+    if console:
+        handlers.append(logging.StreamHandler())  # コンソールにも出力 (デバッグ用)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    _queue_handler.addFilter(RateLimitFilter())
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(_queue_handler)
+    _listener = logging.handlers.QueueListener(
+        _queue_handler.queue, *handlers, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """キューに残った記録を書き出してから出力スレッドを止める"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+def log_stats():
+    """件数制限・重複除去で省略した件数と、キュー満杯で捨てた件数"""
+    if _queue_handler is None:
+        return {"log_suppressed": 0, "log_dropped": 0}
+    suppressed = sum(f.suppressed_count for f in _queue_handler.filters)
+    return {"log_suppressed": suppressed, "log_dropped": _queue_handler.dropped_count}
@@ -2,46 +2,106 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
 import threading
-import time
-from datetime import datetime
+import multiprocessing
+import sys
 import os
+import json
 import logging  # logging モジュールをインポート
+import time
 import traceback  # スタックトレース取得のため
 
-import cv2
-from PIL import Image, ImageGrab, UnidentifiedImageError
-import numpy as np
+# 起動時に読み込むのは標準ライブラリと軽量なモジュールだけにする
+# (OpenCV / numpy / Pillow を使うモジュールは load_capture_modules() で遅延読み込み)
+from log_config import setup_logging, stop_logging
+from presets import DECK_PRESETS, ENCODER_PRESETS, ENGINE_PRESETS
 
 # --- ロギング設定 ---
 log_filename = "slide_capture_app.log"
-log_format = "%(asctime)s - %(levelname)s - %(threadName)s - %(message)s"
-logging.basicConfig(
-    level=logging.INFO,
-    format=log_format,
-    handlers=[
-        logging.FileHandler(log_filename, encoding="utf-8"),  # ファイル出力
-        logging.StreamHandler(),  # コンソールにも出力 (デバッグ用)
-    ],
-)
 logger = logging.getLogger(__name__)
 
 
+def configure_logging():
+    """ログの出力先 (ファイルとコンソール) を設定する
+
+    親プロセスの起動時にだけ呼ぶ。import 時に設定すると、spawn で起動する
+    ワーカープロセス (一括抽出・ベンチマーク) がこのモジュールを読み込み直した
+    ときにも同じログファイルの RotatingFileHandler を開いてしまう。
+    ファイルとコンソールへの書き込みは別スレッドで行い、キャプチャスレッドを待たせない。
+    SLIDE_CAPTURE_LOG_FORMAT=json なら1行1記録の JSON で出力する。
+    """
+    setup_logging(
+        log_filename,
+        structured=os.environ.get("SLIDE_CAPTURE_LOG_FORMAT", "").lower() == "json",
+    )
+
+
+_capture_modules_lock = threading.Lock()
+_capture_modules = None  # 読み込んだ session モジュール
+capture_modules_loaded_at = None  # 読み込みが完了した時刻 (time.time())
+
+
+def load_capture_modules():
+    """画像処理系のモジュールを読み込み、session モジュールを返す
+
+    凍結したexeでは OpenCV / numpy の読み込みに数秒かかるため、ウィンドウ表示後に
+    バックグラウンドで、または最初の start_capture で読み込む。2回目以降は
+    読み込み済みのモジュールを返すだけ。
+    """
+    global _capture_modules, capture_modules_loaded_at
+    with _capture_modules_lock:
+        if _capture_modules is None:
+            start = time.perf_counter()
+            import session
+
+            _capture_modules = session
+            capture_modules_loaded_at = time.time()
+            logger.info(
+                f"画像処理モジュールを読み込みました ({(time.perf_counter() - start) * 1000:.0f} ms)"
+            )
+        return _capture_modules
+
+
 class SlideCaptureApp:
     def __init__(self, root):
         self.root = root
         self.root.title("スライドキャプチャ")
         # UIの高さを少し増やしてエラーメッセージ表示スペースを確保
-        self.root.geometry("400x200")
-
-        self.is_capturing = False
-        self.capture_thread = None
-        self.last_image = None
-        self.saved_count = 0
-        self.last_saved_filename = ""
+        self.root.geometry("400x500")
+
+        # 名前付きセッションの管理 (画面キャプチャは全セッションで1回の取得を共有する)
+        # 最初の start_capture で作る (画像処理モジュールの読み込み後)
+        self.manager = None
+        self.selected_session = None  # 操作・表示の対象のセッション名
+        self._manager_lock = threading.Lock()
+        self._status_scheduled = False
+        # 停止処理のスレッド (保存・デッキの完成を待つ間も UI を止めない)
+        self._stop_threads = []
+        self._closing = False  # 停止処理の完了後にウィンドウを閉じる
+        self.control_server = None  # 制御 API (SLIDE_CAPTURE_API_PORT を指定したとき)
+        self.show_stats = tk.BooleanVar(value=False)
+        self.session_name = tk.StringVar()  # 空欄なら保存フォルダ名
         self.save_folder_name = tk.StringVar()
-        self.error_occurred_in_thread = False  # スレッド内エラーフラグ
+        self.capture_regions = tk.StringVar()  # 空欄なら画面全体
+        self.source_spec = tk.StringVar()  # 空欄なら画面キャプチャ
+        self.encoder_spec = tk.StringVar(value="png:3")  # 保存形式 (セッションごと)
+        self.engine_spec = tk.StringVar(value="fingerprint")  # 検出方式 (比較エンジン)
+        # 変化後、このティック数だけ静止してから保存する (0 なら即保存)
+        self.stable_ticks = tk.StringVar(value="0")
+        self.deck_spec = tk.StringVar(value="なし")  # 出力デッキ (なし / pdf / zip)
+        # メモリ使用量の上限 (MB, 0 で無効)。SLIDE_CAPTURE_MEMORY_LIMIT_MB で初期値を変えられる
+        self.memory_limit = tk.StringVar(
+            value=os.environ.get("SLIDE_CAPTURE_MEMORY_LIMIT_MB", "1024")
+        )
 
         # --- UI要素の作成 ---
+        name_frame = ttk.Frame(root, padding=(10, 10, 10, 0))
+        name_frame.pack(fill=tk.X)
+        name_label = ttk.Label(name_frame, text="セッション名:")
+        name_label.pack(side=tk.LEFT, padx=(0, 5))
+        # 空欄なら保存フォルダ名。同時に複数のセッションを開始できる
+        self.name_entry = ttk.Entry(name_frame, textvariable=self.session_name, width=35)
+        self.name_entry.pack(side=tk.LEFT, expand=True, fill=tk.X)
+
         folder_frame = ttk.Frame(root, padding="10")
         folder_frame.pack(fill=tk.X)
         folder_label = ttk.Label(folder_frame, text="保存フォルダ名:")
@@ -51,6 +111,66 @@ class SlideCaptureApp:
         )
         self.folder_entry.pack(side=tk.LEFT, expand=True, fill=tk.X)
 
+        region_frame = ttk.Frame(root, padding=(10, 0, 10, 0))
+        region_frame.pack(fill=tk.X)
+        region_label = ttk.Label(region_frame, text="キャプチャ領域:")
+        region_label.pack(side=tk.LEFT, padx=(0, 5))
+        # 例: slide=0,0,1920,1080; sub=monitor2 (空欄なら画面全体)
+        self.region_entry = ttk.Entry(
+            region_frame, textvariable=self.capture_regions, width=35
+        )
+        self.region_entry.pack(side=tk.LEFT, expand=True, fill=tk.X)
+
+        source_frame = ttk.Frame(root, padding=(10, 10, 10, 0))
+        source_frame.pack(fill=tk.X)
+        source_label = ttk.Label(source_frame, text="入力 (動画/フォルダ):")
+        source_label.pack(side=tk.LEFT, padx=(0, 5))
+        # 空欄なら画面キャプチャ。動画ファイルまたは画像フォルダのパスを指定すると再生
+        self.source_entry = ttk.Entry(
+            source_frame, textvariable=self.source_spec, width=30
+        )
+        self.source_entry.pack(side=tk.LEFT, expand=True, fill=tk.X)
+
+        detector_frame = ttk.Frame(root, padding=(10, 10, 10, 0))
+        detector_frame.pack(fill=tk.X)
+        detector_label = ttk.Label(detector_frame, text="検出方式:")
+        detector_label.pack(side=tk.LEFT, padx=(0, 5))
+        # 例: block, ssim, full:tolerance=8,blur=3 (任意の指定も入力可能)
+        self.engine_combo = ttk.Combobox(
+            detector_frame,
+            textvariable=self.engine_spec,
+            values=ENGINE_PRESETS,
+            width=22,
+        )
+        self.engine_combo.pack(side=tk.LEFT, expand=True, fill=tk.X)
+        self.stable_spin = ttk.Spinbox(
+            detector_frame, from_=0, to=10, textvariable=self.stable_ticks, width=4
+        )
+        self.stable_spin.pack(side=tk.RIGHT)
+        stable_label = ttk.Label(detector_frame, text="安定確認(回):")
+        stable_label.pack(side=tk.RIGHT, padx=(10, 5))
+
+        deck_frame = ttk.Frame(root, padding=(10, 10, 10, 0))
+        deck_frame.pack(fill=tk.X)
+        deck_label = ttk.Label(deck_frame, text="出力デッキ:")
+        deck_label.pack(side=tk.LEFT, padx=(0, 5))
+        # 例: pdf, zip, pdf:width=1600,format=jpeg:85 (停止時に完成する)
+        self.deck_combo = ttk.Combobox(
+            deck_frame, textvariable=self.deck_spec, values=DECK_PRESETS, width=30
+        )
+        self.deck_combo.pack(side=tk.LEFT, expand=True, fill=tk.X)
+        self.memory_spin = ttk.Spinbox(
+            deck_frame,
+            from_=0,
+            to=65536,
+            increment=256,
+            textvariable=self.memory_limit,
+            width=6,
+        )
+        self.memory_spin.pack(side=tk.RIGHT)
+        memory_label = ttk.Label(deck_frame, text="メモリ上限(MB):")
+        memory_label.pack(side=tk.RIGHT, padx=(10, 5))
+
         button_frame = ttk.Frame(root, padding="10")
         button_frame.pack(fill=tk.X)
         self.start_button = ttk.Button(
@@ -61,6 +181,58 @@ class SlideCaptureApp:
             button_frame, text="終了", command=self.stop_capture, state=tk.DISABLED
         )
         self.stop_button.pack(side=tk.LEFT, padx=5)
+        self.retro_button = ttk.Button(
+            button_frame,
+            text="直前を保存",
+            command=self.save_recent_frames,
+            state=tk.DISABLED,
+        )
+        self.retro_button.pack(side=tk.LEFT, padx=5)
+        self.stats_check = ttk.Checkbutton(
+            button_frame,
+            text="詳細統計",
+            variable=self.show_stats,
+            command=self.toggle_stats_panel,
+        )
+        self.stats_check.pack(side=tk.LEFT, padx=5)
+        self.encoder_combo = ttk.Combobox(
+            button_frame,
+            textvariable=self.encoder_spec,
+            values=ENCODER_PRESETS,
+            width=14,
+        )
+        self.encoder_combo.pack(side=tk.RIGHT)
+        encoder_label = ttk.Label(button_frame, text="保存形式:")
+        encoder_label.pack(side=tk.RIGHT, padx=(0, 5))
+
+        # セッション一覧 (選択したセッションを「終了」「直前を保存」の対象にする)
+        session_frame = ttk.Frame(root, padding=(10, 0, 10, 0))
+        session_frame.pack(fill=tk.X)
+        self.session_tree = ttk.Treeview(
+            session_frame,
+            columns=("state", "saved", "last"),
+            height=4,
+            selectmode="browse",
+        )
+        self.session_tree.heading("#0", text="セッション")
+        self.session_tree.heading("state", text="状態")
+        self.session_tree.heading("saved", text="保存")
+        self.session_tree.heading("last", text="最終保存")
+        self.session_tree.column("#0", width=90, stretch=False)
+        self.session_tree.column("state", width=70, stretch=False)
+        self.session_tree.column("saved", width=45, stretch=False, anchor=tk.E)
+        self.session_tree.column("last", width=150)
+        self.session_tree.pack(fill=tk.X)
+        self.session_tree.bind("<<TreeviewSelect>>", self.on_session_selected)
+        self.session_tree.bind("<Delete>", lambda e: self.remove_session())
+        # 停止済みのセッションを一覧から外す (保存したファイルは消さない)
+        self.remove_button = ttk.Button(
+            session_frame,
+            text="一覧から削除",
+            command=self.remove_session,
+            state=tk.DISABLED,
+        )
+        self.remove_button.pack(anchor=tk.E, pady=(5, 0))
 
         status_frame = ttk.Frame(root, padding="10")
         status_frame.pack(fill=tk.BOTH, expand=True)
@@ -68,89 +240,251 @@ class SlideCaptureApp:
         self.status_label = ttk.Label(
             status_frame, text="待機中...", anchor=tk.W, justify=tk.LEFT, wraplength=380
         )
-        self.status_label.pack(fill=tk.BOTH, expand=True)
+        self.status_label.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        # 詳細統計パネル (チェック時のみ status_label の右に表示)
+        self.stats_label = ttk.Label(
+            status_frame, text="", anchor=tk.NW, justify=tk.LEFT, font=("Courier", 9)
+        )
 
-        self.root.bind("<Escape>", lambda e: self.stop_capture())
+        # Escape はすべてのセッションを停止する
+        self.root.bind("<Escape>", lambda e: self.stop_all_sessions())
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
         logger.info("アプリケーションを初期化しました。")
+        # ウィンドウの描画 (アイドル処理) が済んでから画像処理モジュールを先読みする
+        self.root.after_idle(self.preload_capture_modules)
+        api_port = os.environ.get("SLIDE_CAPTURE_API_PORT")
+        if api_port:
+            try:
+                port = int(api_port)
+            except ValueError:
+                logger.error(
+                    f"エラー (制御 API): SLIDE_CAPTURE_API_PORT は整数で指定してください: {api_port!r}"
+                )
+            else:
+                self.start_control_api(port, os.environ.get("SLIDE_CAPTURE_API_TOKEN"))
+
+    def preload_capture_modules(self):
+        """画像処理モジュールをバックグラウンドで読み込み、最初の開始を速くする"""
+        threading.Thread(
+            target=load_capture_modules, name="PreloadThread", daemon=True
+        ).start()
+
+    def ensure_manager(self):
+        """SessionManager を返す (なければ画像処理モジュールを読み込んで作る)
+
+        制御 API のスレッドからも呼ばれる。
+        """
+        capture = load_capture_modules()
+        with self._manager_lock:
+            if self.manager is None:
+                self.manager = capture.SessionManager()
+            return self.manager
+
+    def start_control_api(self, port, token=None):
+        """制御 API を専用スレッドで開始する (Tk のメインループは待たせない)"""
+        from control_api import ControlServer
+
+        try:
+            self.control_server = ControlServer(
+                self.ensure_manager, port=port, token=token
+            ).start_in_thread()
+        except OSError as e:
+            logger.error(f"制御 API を開始できませんでした: {e}")
+            return
+        # API から開始・停止したセッションも表示されるよう、定期更新を続ける
+        self.update_status()
+
+    @property
+    def current_session(self):
+        """操作・表示の対象のセッション (なければ None)"""
+        if self.manager is None or self.selected_session is None:
+            return None
+        return self.manager.get(self.selected_session)
+
+    @property
+    def is_stopping(self):
+        """停止処理のスレッドが実行中か"""
+        self._stop_threads = [thread for thread in self._stop_threads if thread.is_alive()]
+        return bool(self._stop_threads)
+
+    @property
+    def is_capturing(self):
+        """いずれかのセッションがキャプチャ中か"""
+        return bool(self.manager and self.manager.active_sessions)
+
+    def toggle_stats_panel(self):
+        """詳細統計パネルの表示/非表示を切り替える"""
+        if self.show_stats.get():
+            self.root.geometry("680x500")
+            self.stats_label.pack(side=tk.RIGHT, fill=tk.Y, padx=(10, 0))
+            self.update_stats_panel()
+        else:
+            self.stats_label.pack_forget()
+            self.root.geometry("400x500")
+
+    def on_session_selected(self, event=None):
+        selection = self.session_tree.selection()
+        if selection:
+            self.selected_session = selection[0]
+        self.update_status()
+
+    def update_stats_panel(self):
+        """詳細統計パネルの表示を更新する (選択中のセッションと共有の画面取得)"""
+        if not self.show_stats.get():
+            return
+        session = self.current_session
+        if session is None or session.metrics is None:
+            self.stats_label.config(text="(キャプチャ開始後に表示)")
+            return
+        extra = session.metrics_extra()
+        lines = [f"[{session.name}]", session.metrics.summary_lines(extra)]
+        loop = session.loop
+        if loop is not None:
+            grab = loop.metrics.snapshot()["stages"].get("grab")
+            if grab:
+                lines.append(
+                    f"取得 (共有 {len(loop.sessions)} セッション) "
+                    f"{grab['p50_ms']:.1f} / {grab['p95_ms']:.1f} ms"
+                )
+        self.stats_label.config(text="\n".join(lines))
+
+    def update_session_list(self):
+        """セッション一覧の表示を更新する"""
+        if self.manager is None:
+            return
+        state_labels = {
+            "capturing": "キャプチャ中",
+            "stopping": "停止中",
+            "stopped": "停止",
+            "idle": "待機",
+        }
+        existing = set(self.session_tree.get_children())
+        sessions = self.manager.snapshot()
+        for session in sessions:
+            name = session.name
+            status = session.status()
+            values = (
+                state_labels.get(status["state"], status["state"])
+                + (" (エラー)" if status["error"] else ""),
+                status["saved_count"],
+                status["last_saved_filename"],
+            )
+            if name in existing:
+                self.session_tree.item(name, values=values)
+                existing.discard(name)
+            else:
+                self.session_tree.insert("", tk.END, iid=name, text=name, values=values)
+        for name in existing:
+            self.session_tree.delete(name)
+        if any(session.name == self.selected_session for session in sessions):
+            if self.session_tree.selection() != (self.selected_session,):
+                self.session_tree.selection_set(self.selected_session)
+        active = self.current_session is not None and self.current_session.is_capturing
+        self.stop_button.config(state=tk.NORMAL if active else tk.DISABLED)
+        self.retro_button.config(state=tk.NORMAL if active else tk.DISABLED)
+        removable = self.current_session is not None and self.current_session.state == "stopped"
+        self.remove_button.config(state=tk.NORMAL if removable else tk.DISABLED)
 
     def update_status(self):
-        """ステータスラベルを更新する"""
-        if self.is_capturing:
-            status_text = f"キャプチャ中...\n保存枚数: {self.saved_count}\n最終保存: {self.last_saved_filename}"
-            if self.error_occurred_in_thread:
+        """セッション一覧と、選択中のセッションのステータスラベルを更新する"""
+        self.update_session_list()
+        self.update_stats_panel()
+        session = self.current_session
+        if session is None:
+            self.status_label.config(text="待機中...", foreground="black")
+        else:
+            status = session.status()
+            if session.is_capturing:
+                status_text = f"[{session.name}] キャプチャ中...\n保存枚数: {status['saved_count']}"
+                if status["folder_total"] != status["saved_count"]:
+                    status_text += f" (フォルダ累計 {status['folder_total']})"
+                status_text += f"\n最終保存: {status['last_saved_filename']}"
+                status_text += f"\n保存待ち: {status['queue_depth']} 件 / エンコード: {status['avg_encode_ms']:.0f} ms"
+                if status["dropped"]:
+                    status_text += f" / 破棄: {status['dropped']} 件"
+                if status["repeat_count"]:
+                    status_text += f"\n既出スライド (保存せず参照): {status['repeat_count']} 件"
+                if status["retro_count"]:
+                    status_text += f"\nさかのぼり保存: {status['retro_count']} 枚"
+            elif status["state"] == "stopping":
+                status_text = (
+                    f"[{session.name}] 停止中... (保存待ちのフレームとデッキを書き込んでいます)\n"
+                    f"保存枚数: {status['saved_count']} / 保存待ち: {status['queue_depth']} 件"
+                )
+            else:
+                status_text = f"[{session.name}] 停止しました。\n合計保存枚数: {status['saved_count']}"
+                if status["folder_total"] != status["saved_count"]:
+                    status_text += f" (フォルダ累計 {status['folder_total']})"
+                if status["last_saved_filename"]:
+                    status_text += f"\n最終保存: {status['last_saved_filename']}"
+                if status.get("deck", {}).get("pages"):
+                    status_text += f"\nデッキ: {status['deck']['file']} ({status['deck']['pages']} 枚)"
+            if status["error"]:
                 # エラー発生時はログファイル参照を促すメッセージを追加
                 status_text += f"\n警告: エラー発生。詳細はログファイル\n({log_filename})を確認してください。"
                 self.status_label.config(foreground="red")  # エラー時は赤文字
             else:
                 self.status_label.config(foreground="black")  # 通常時は黒文字
             self.status_label.config(text=status_text)
-            # is_capturing が True の間だけ再スケジュール
-            if self.is_capturing:
-                self.root.after(1000, self.update_status)
-        else:
-            final_status = f"停止しました。\n合計保存枚数: {self.saved_count}"
-            if self.last_saved_filename:
-                final_status += f"\n最終保存: {self.last_saved_filename}"
-            if self.error_occurred_in_thread:
-                final_status += f"\n警告: エラー発生。詳細はログファイル\n({log_filename})を確認してください。"
-                self.status_label.config(foreground="red")
-            else:
-                self.status_label.config(foreground="black")
-            self.status_label.config(text=final_status)
+        # キャプチャ中のセッションがある間だけ1秒ごとに更新する
+        # (再生ソースの終端に達したセッションはキャプチャループ側で停止する)
+        # 制御 API の動作中は、API からの開始に備えて常に更新する
+        # 停止処理の実行中は、完了して最終結果を表示するまで更新する
+        if (
+            self.is_capturing or self.control_server or self.is_stopping
+        ) and not self._status_scheduled:
+            self._status_scheduled = True
+            self.root.after(1000, self._scheduled_update_status)
+
+    def _scheduled_update_status(self):
+        self._status_scheduled = False
+        self.update_status()
 
     def start_capture(self):
-        """キャプチャ処理を開始する"""
-        if self.is_capturing:
-            return
-
-        folder_name_input = self.save_folder_name.get().strip()
-        if not folder_name_input:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            folder_name = f"saved_screenshots_{timestamp}"
-            self.save_folder_name.set(folder_name)
+        """フォームの設定で新しいキャプチャセッションを開始する"""
+        if capture_modules_loaded_at is None:
+            # 先読みが終わっていなければ、ここで読み込みの完了を待つ
+            self.status_label.config(text="画像処理モジュールを読み込んでいます...")
+            self.root.update_idletasks()
+        self.ensure_manager()
+        capture = load_capture_modules()
+
+        folder_name, modified = capture.sanitize_folder_name(self.save_folder_name.get())
+        if not self.save_folder_name.get().strip():
             logger.info(f"フォルダ名が未入力のため、デフォルト名を設定: {folder_name}")
-        else:
-            # ファイル名として不適切な文字を置換 (簡易的な対策)
-            invalid_chars = '<>:"/\\|?*'
-            folder_name = "".join(
-                c if c not in invalid_chars else "_" for c in folder_name_input
-            )
-            if folder_name != folder_name_input:
-                self.save_folder_name.set(folder_name)
-                warning_msg = f"フォルダ名に使用できない文字が含まれていたため、'{folder_name}' に修正しました。"
-                logger.warning(warning_msg)
-                messagebox.showwarning("フォルダ名修正", warning_msg)
+        self.save_folder_name.set(folder_name)
+        if modified:
+            warning_msg = f"フォルダ名に使用できない文字が含まれていたため、'{folder_name}' に修正しました。"
+            logger.warning(warning_msg)
+            messagebox.showwarning("フォルダ名修正", warning_msg)
 
         try:
-            self.capture_save_path = os.path.abspath(folder_name)
-            logger.info(f"保存先フォルダの絶対パス: {self.capture_save_path}")
-
-            if not os.path.exists(self.capture_save_path):
-                logger.info(
-                    f"フォルダが存在しないため作成します: {self.capture_save_path}"
-                )
-                os.makedirs(self.capture_save_path, exist_ok=True)
-                logger.info(f"フォルダを作成しました: {self.capture_save_path}")
-            elif not os.path.isdir(self.capture_save_path):
-                error_msg = (
-                    f"指定されたパスはフォルダではありません: {self.capture_save_path}"
-                )
-                logger.error(error_msg)
-                messagebox.showerror("エラー", error_msg)
-                return
-            # 書き込み権限チェック (Windows用簡易チェック)
-            elif not os.access(self.capture_save_path, os.W_OK):
-                error_msg = f"指定されたフォルダへの書き込み権限がありません:\n{self.capture_save_path}\n別のフォルダを指定するか、権限を確認してください。"
-                logger.error(error_msg)
-                messagebox.showerror("権限エラー", error_msg)
-                return
-            else:
-                logger.info(
-                    f"保存先フォルダへの書き込み権限を確認しました: {self.capture_save_path}"
-                )
+            # 実行中のループにも反映し、フレームなどの予算はこのセッションから反映する
+            self.manager.set_memory_limit(self.memory_limit.get().strip())
+        except ValueError:
+            messagebox.showerror(
+                "メモリ上限エラー",
+                f"メモリ上限(MB) は 0 以上の整数で指定してください: {self.memory_limit.get()!r}",
+            )
+            return
 
+        session = self.manager.new_session(
+            name=self.session_name.get().strip() or None,
+            folder=folder_name,
+            regions=self.capture_regions.get(),
+            source=self.source_spec.get(),
+            encoder=self.encoder_spec.get(),
+            engine=self.engine_spec.get(),
+            stable_ticks=self.stable_ticks.get(),
+            deck=self.deck_spec.get(),
+        )
+        try:
+            self.manager.start_session(session)
+        except capture.SessionError as e:
+            logger.error(f"[{session.name}] {e.title}: {e}")
+            messagebox.showerror(e.title, str(e))
+            return
         except OSError as e:
             error_detail = (
                 f"フォルダの作成/アクセス中にOSエラーが発生しました。\n"
@@ -179,221 +513,138 @@ class SlideCaptureApp:
             )
             return
 
-        # エラーフラグをリセット
-        self.error_occurred_in_thread = False
-        self.status_label.config(foreground="black")  # ステータス色をリセット
-
-        self.is_capturing = True
-        self.start_button.config(state=tk.DISABLED)
-        self.stop_button.config(state=tk.NORMAL)
-        self.folder_entry.config(state=tk.DISABLED)
-        self.saved_count = 0
-        self.last_saved_filename = ""
-        self.last_image = None
-
-        # スレッドを開始
-        self.capture_thread = threading.Thread(
-            target=self.capture_loop, name="CaptureThread", daemon=True
-        )
-        self.capture_thread.start()
+        self.selected_session = session.name
+        # 次のセッションは別の名前・フォルダで開始する
+        self.session_name.set("")
         self.update_status()  # 定期的なステータス更新を開始
-        logger.info(f"キャプチャを開始しました。保存先: {self.capture_save_path}")
 
     def stop_capture(self):
-        """キャプチャ処理を停止する"""
-        if not self.is_capturing:
+        """選択中のセッションを停止する"""
+        session = self.current_session
+        if session is None or not session.is_capturing:
             return
+        self.stop_in_background(self.manager.stop_session, session.name)
 
-        logger.info("キャプチャ停止処理を開始します。")
-        self.is_capturing = False
-        # スレッドが終了するのを少し待つ
-        if self.capture_thread and self.capture_thread.is_alive():
-            logger.info("キャプチャループの終了を待っています...")
-            self.capture_thread.join(timeout=1.5)  # 少し長めに待つ
-            if self.capture_thread.is_alive():
-                logger.warning("警告: キャプチャスレッドが時間内に終了しませんでした。")
-
-        self.start_button.config(state=tk.NORMAL)
-        self.stop_button.config(state=tk.DISABLED)
-        self.folder_entry.config(state=tk.NORMAL)
-        logger.info("キャプチャを停止しました。")
-        # 停止後にもう一度ステータスを更新して最終結果を表示
-        # is_capturingがFalseなのでupdate_statusは再スケジュールされない
+    def stop_all_sessions(self):
+        """すべてのセッションを停止する"""
+        if not self.is_capturing:
+            return
+        logger.info("すべてのセッションを停止します。")
+        self.stop_in_background(self.manager.stop_all)
+
+    def stop_in_background(self, func, *args):
+        """停止処理を別スレッドで実行する
+
+        停止は保存待ちのフレームの書き込み (最大 save_flush_timeout 秒) と
+        デッキの完成 (最大 deck_finalize_timeout 秒) を待つため、Tk のスレッドでは
+        行わない。実行中は「停止中」と表示し、完了は定期更新で反映する。
+        """
+        thread = threading.Thread(target=func, args=args, name="StopSessionThread", daemon=True)
+        thread.start()
+        self._stop_threads.append(thread)
+        # スレッド側で状態が「停止中」になってから表示を更新する
         self.root.after(100, self.update_status)
+        return thread
 
-    def capture_loop(self):
-        """定期的にスクリーンショットを取得し、比較・保存するループ"""
-        logger.info("キャプチャループを開始します。")
-        while self.is_capturing:
-            try:
-                # 1. スクリーンショット取得
-                screenshot = ImageGrab.grab()
-                if screenshot is None:
-                    logger.error(
-                        "エラー: ImageGrab.grab() が None を返しました。スクリーンショットを取得できませんでした。"
-                    )
-                    self.error_occurred_in_thread = True
-                    time.sleep(2.0)  # 少し待ってリトライ
-                    continue
-
-                # 2. 画像形式変換 (PIL -> OpenCV)
-                current_image_pil = screenshot.convert("RGB")
-                current_image_cv = np.array(current_image_pil)
-                current_image_cv = cv2.cvtColor(current_image_cv, cv2.COLOR_RGB2BGR)
-
-                if current_image_cv is None or current_image_cv.size == 0:
-                    logger.error(
-                        "エラー: 画像データの変換に失敗しました (Noneまたはサイズ0)。"
-                    )
-                    self.error_occurred_in_thread = True
-                    time.sleep(2.0)
-                    continue
-
-                # 3. 前回の画像と比較
-                if self.last_image is None:
-                    logger.info("最初の画像を取得しました。保存します。")
-                    self.save_image(current_image_cv)
-                    self.last_image = current_image_cv
-                else:
-                    if not self.is_similar(current_image_cv, self.last_image):
-                        logger.info(
-                            "新しい画像または類似していない画像を検出しました。保存します。"
-                        )
-                        self.save_image(current_image_cv)
-                        self.last_image = current_image_cv
-                    else:
-                        # logger.debug("類似画像のためスキップ") # DEBUGレベルに変更
-                        pass
-
-            except (OSError, UnidentifiedImageError) as e:
-                logger.exception(f"エラー (キャプチャ/変換): {type(e).__name__} - {e}")
-                self.error_occurred_in_thread = True
-                time.sleep(5.0)
-            except cv2.error as e:
-                logger.exception(f"エラー (OpenCV): {type(e).__name__} - {e}")
-                self.error_occurred_in_thread = True
-                time.sleep(5.0)
-            except Exception as e:
-                logger.exception(
-                    f"エラー (キャプチャループ): 予期せぬエラーが発生しました - {type(e).__name__}: {e}"
-                )
-                self.error_occurred_in_thread = True
-                time.sleep(5.0)
-
-            # 次のキャプチャまでの待機時間
-            wait_start_time = time.time()
-            while self.is_capturing and time.time() - wait_start_time < 2.0:
-                time.sleep(0.1)
-
-        logger.info("キャプチャループが終了しました。")
-
-    def is_similar(self, img1_cv, img2_cv, threshold=0.95):
-        """2つの画像の類似度を計算する (差分ベースの簡易比較)"""
-        try:
-            gray1 = cv2.cvtColor(img1_cv, cv2.COLOR_BGR2GRAY)
-            gray2 = cv2.cvtColor(img2_cv, cv2.COLOR_BGR2GRAY)
-            h1, w1 = gray1.shape
-            h2, w2 = gray2.shape
-
-            if h1 != h2 or w1 != w2:
-                # logger.debug(f"画像サイズが異なるためリサイズします: ({w1}x{h1}) vs ({w2}x{h2})")
-                if h1 * w1 < h2 * w2:
-                    gray2 = cv2.resize(gray2, (w1, h1), interpolation=cv2.INTER_AREA)
-                else:
-                    gray1 = cv2.resize(gray1, (w2, h2), interpolation=cv2.INTER_AREA)
-
-            diff = cv2.absdiff(gray1, gray2)
-            non_zero_count = np.count_nonzero(diff)
-            total_pixels = gray1.size
-            if total_pixels == 0:
-                logger.warning("警告: 類似度計算中の画像サイズが0です。")
-                return False
-
-            similarity = 1.0 - (non_zero_count / total_pixels)
-            # logger.debug(f"類似度: {similarity:.4f}")
-            return similarity >= threshold
-
-        except cv2.error as e:
-            logger.exception(f"エラー (類似度計算 - OpenCV): {type(e).__name__} - {e}")
-            self.error_occurred_in_thread = True
-            return False
-        except Exception as e:
-            logger.exception(
-                f"エラー (類似度計算): 予期せぬエラー - {type(e).__name__}: {e}"
-            )
-            self.error_occurred_in_thread = True
-            return False
-
-    def save_image(self, image_cv):
-        """画像をファイルに保存する。エラー発生時はログに記録。"""
-        save_path = None
-        try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
-            filename = f"screenshot_{timestamp}.png"
-            save_path = os.path.join(self.capture_save_path, filename)
-
-            if image_cv is None or image_cv.size == 0:
-                logger.warning(
-                    f"警告: 保存しようとした画像データが無効です (Noneまたはサイズ0)。パス: {save_path}"
-                )
-                self.error_occurred_in_thread = True
-                return
-
-            success = cv2.imwrite(save_path, image_cv, [cv2.IMWRITE_PNG_COMPRESSION, 3])
-
-            if success:
-                self.saved_count += 1
-                self.last_saved_filename = os.path.basename(save_path)
-                logger.info(f"画像を保存しました: {save_path}")
-            else:
-                # imwriteがFalseを返した場合
-                error_msg = (
-                    f"エラー (保存): cv2.imwrite が False を返しました。ファイル書き込みに失敗した可能性があります。\n"
-                    f" - 保存試行パス: {save_path}\n"
-                    f" - 画像サイズ: {image_cv.shape if image_cv is not None else 'None'}\n"
-                    f" - 考えられる原因: 書き込み権限不足、ディスク容量不足、パス名の問題、画像データ破損など"
-                )
-                logger.error(error_msg)
-                self.error_occurred_in_thread = True
+    def remove_session(self):
+        """選択中の停止済みセッションを一覧から外す (保存したファイルは残す)"""
+        session = self.current_session
+        if session is None or not self.manager.remove_session(session.name):
+            return
+        logger.info(f"[{session.name}] セッションを一覧から削除しました。")
+        self.selected_session = None
+        self.update_status()
 
-        except cv2.error as e:
-            logger.exception(
-                f"エラー (保存 - OpenCV): {type(e).__name__} - {e}\n - 保存試行パス: {save_path}"
-            )
-            self.error_occurred_in_thread = True
-        except OSError as e:
-            logger.exception(
-                f"エラー (保存 - OS): {type(e).__name__} - {e}\n - 保存試行パス: {save_path}"
-            )
-            self.error_occurred_in_thread = True
-        except Exception as e:
-            logger.exception(
-                f"エラー (保存): 予期せぬエラー - {type(e).__name__}: {e}\n - 保存試行パス: {save_path}"
-            )
-            self.error_occurred_in_thread = True
+    def save_recent_frames(self):
+        """選択中のセッションの直近のフレームを保存する"""
+        session = self.current_session
+        if session is not None:
+            session.save_recent_frames()
 
     def on_closing(self):
         """ウィンドウが閉じられたときの処理"""
+        if self._closing:
+            return  # 停止処理の完了を待っている
         if self.is_capturing:
             if messagebox.askokcancel(
                 "確認", "キャプチャ処理が実行中です。\n本当に終了しますか？"
             ):
                 logger.info("ユーザー操作により終了します...")
-                self.stop_capture()
-                self.root.destroy()
-                logger.info("アプリケーションを終了しました。")
+                self.stop_in_background(self.manager.stop_all)
             else:
                 logger.info("終了操作がキャンセルされました。")
                 return
-        else:
-            logger.info("アプリケーションを終了しました。")
-            self.root.destroy()
+        self.close_when_stopped()
+
+    def close_when_stopped(self):
+        """停止処理がすべて終わってからウィンドウを閉じる (待つ間も UI は応答する)"""
+        self._closing = True
+        if self.is_stopping:
+            for button in (self.start_button, self.stop_button, self.retro_button):
+                button.config(state=tk.DISABLED)
+            self.root.after(200, self.close_when_stopped)
+            return
+        if self.control_server:
+            self.control_server.stop()
+        logger.info("アプリケーションを終了しました。")
+        self.root.destroy()
+
+
+def startup_probe(app, save_folder, source=""):
+    """起動時間の計測用: ウィンドウ表示後すぐにキャプチャを開始し、最初のフレームで終了する
+
+    benchmark.py startup が "main.py startup-probe 保存フォルダ [入力]" で起動し、
+    各時点の time.time() を JSON で標準出力に書く。
+    """
+    app.root.update_idletasks()
+    result = {"window": time.time()}
+    app.save_folder_name.set(save_folder)
+    app.source_spec.set(source)
+    app.start_capture()
+    session = app.current_session
+    if session is None or not session.is_capturing:
+        print(json.dumps({"error": "キャプチャを開始できませんでした"}), flush=True)
+        app.root.destroy()
+        return
+
+    def wait_first_frame():
+        if session.metrics.counters["frames"] == 0 and session.is_capturing:
+            app.root.after(5, wait_first_frame)
+            return
+        result["first_capture"] = time.time()
+        result["modules"] = capture_modules_loaded_at
+        app.manager.stop_all()
+        print(json.dumps(result), flush=True)
+        app.root.destroy()
+
+    wait_first_frame()
 
 
 if __name__ == "__main__":
+    # 凍結したexeでもプロセスプール (一括抽出モード) を使えるようにする
+    multiprocessing.freeze_support()
+    configure_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        # GUIを起動せずに録画済みファイルからスライドを一括抽出する
+        from batch import main as batch_main
+
+        sys.exit(batch_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        # GUIなしで制御 API だけを動かす (python control_api.py などから操作する)
+        from control_api import serve_main
+
+        exit_code = serve_main(sys.argv[2:])
+        stop_logging()
+        sys.exit(exit_code)
+
     # Tkinterのルートウィンドウを作成
     root = tk.Tk()
     # アプリケーションクラスのインスタンスを作成
     app = SlideCaptureApp(root)
+    if len(sys.argv) > 1 and sys.argv[1] == "startup-probe":
+        # 起動時間の計測 (python benchmark.py startup から起動される)
+        root.after_idle(startup_probe, app, *sys.argv[2:4])
     # Tkinterのイベントループを開始
     root.mainloop()
+    # キューに残ったログを書き出してから終了する
+    stop_logging()
@@ -1,5 +1,25 @@
 # -*- mode: python ; coding: utf-8 -*-
 
+# OpenCV は GUI (highgui) を使わないため opencv-python-headless で十分 (Qt を同梱しない)。
+# 遅延読み込みしているモジュールも関数内の import 文から検出される。
+excludes = [
+    'matplotlib',
+    'scipy',
+    'pandas',
+    'IPython',
+    'PyQt5',
+    'PySide2',
+    'PySide6',
+    'pytest',
+    'tkinter.test',
+    'numpy.f2py',
+    'numpy.distutils',
+    'PIL.ImageQt',
+    'PIL.ImageTk',
+    'distutils',
+    'setuptools',
+]
+
 
 a = Analysis(
     ['main.py'],
@@ -10,9 +30,9 @@ a = Analysis(
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
-    excludes=[],
+    excludes=excludes,
     noarchive=False,
-    optimize=0,
+    optimize=1,
 )
 pyz = PYZ(a.pure)
 
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""キャプチャ処理の性能計測とエクスポート
+
+段階ごと (grab, convert, compare, encode, write, sync) の処理時間を直近 window 件
+保持し、パーセンタイルを計算する。記録は deque への追加だけなので、
+キャプチャスレッドや保存ワーカーから低コストで呼べる。集計はエクスポート時や
+ステータス更新時 (1秒ごと) にだけ行う。
+
+エクスポート形式:
+    jsonl  1行1スナップショットの JSON Lines (追記)
+    prom   Prometheus のテキスト形式 (毎回置き換え。node_exporter の textfile 用)
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("grab", "convert", "compare", "encode", "write", "sync")
+EXPORT_FORMATS = ("jsonl", "prom")
+
+
+def current_rss():
+    """現在の常駐メモリ (bytes)。取得できない場合は 0"""
+    if sys.platform == "win32":
+        counters = _win32_memory_counters()
+        return counters.WorkingSetSize if counters else 0
+    try:
+        with open("/proc/self/statm", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def peak_rss():
+    """プロセス開始以降の常駐メモリの最大値 (bytes)。取得できない場合は 0"""
+    if sys.platform == "win32":
+        counters = _win32_memory_counters()
+        return counters.PeakWorkingSetSize if counters else 0
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux は KB、macOS は bytes 単位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _win32_memory_counters():
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(
+        process, ctypes.byref(counters), counters.cb
+    ):
+        return None
+    return counters
+
+
+def percentile(sorted_values, fraction):
+    """ソート済みリストのパーセンタイル (最近傍法)"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class _StageTimer:
+    """with 文で1段階の処理時間を記録する"""
+
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, (time.perf_counter() - self.start) * 1000.0)
+        return False
+
+
+class CaptureMetrics:
+    """段階ごとの処理時間・カウンタ・メモリ最大値の集計"""
+
+    def __init__(self, window=500):
+        self.window = window
+        self.started_at = time.time()
+        self._samples = {stage: deque(maxlen=window) for stage in STAGES}
+        self._totals = {stage: 0 for stage in STAGES}
+        self._lock = threading.Lock()
+        self.counters = {
+            "frames": 0,  # 取得したフレーム数
+            "skipped": 0,  # 前回と類似のため保存しなかったフレーム数
+            "saved": 0,  # 保存キューに積んだフレーム数
+            "repeats": 0,  # 既出スライドとして参照記録したフレーム数
+            "errors": 0,
+            "memory_pressure": 0,  # メモリ上限を超えて保持データを解放した回数
+        }
+        self.rss_high_water = 0
+
+    def stage(self, name):
+        """with metrics.stage("grab"): ... の形で処理時間を記録する"""
+        return _StageTimer(self, name)
+
+    def record(self, stage, ms):
+        samples = self._samples.get(stage)
+        if samples is None:
+            samples = self._samples.setdefault(stage, deque(maxlen=self.window))
+            self._totals.setdefault(stage, 0)
+        samples.append(ms)
+        self._totals[stage] += 1
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self, extra=None):
+        """現在の集計値を辞書で返す"""
+        rss = current_rss()
+        self.rss_high_water = max(self.rss_high_water, rss, peak_rss())
+        stages = {}
+        for stage, samples in list(self._samples.items()):
+            values = sorted(samples)
+            if not values:
+                continue
+            stages[stage] = {
+                "count": self._totals[stage],
+                "p50_ms": round(percentile(values, 0.50), 3),
+                "p95_ms": round(percentile(values, 0.95), 3),
+                "p99_ms": round(percentile(values, 0.99), 3),
+                "max_ms": round(values[-1], 3),
+            }
+        with self._lock:
+            counters = dict(self.counters)
+        snapshot = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "uptime_s": round(time.time() - self.started_at, 1),
+            "stages": stages,
+            "counters": counters,
+            "rss_bytes": rss,
+            "rss_high_water_bytes": self.rss_high_water,
+        }
+        if extra:
+            snapshot.update(extra)
+        return snapshot
+
+    def summary_lines(self, extra=None):
+        """統計パネル用の複数行テキスト"""
+        snapshot = self.snapshot(extra)
+        lines = ["段階      p50 / p95 ms"]
+        for stage in STAGES:
+            stats = snapshot["stages"].get(stage)
+            if stats:
+                lines.append(f"{stage:<8} {stats['p50_ms']:>6.1f} / {stats['p95_ms']:.1f}")
+        counters = snapshot["counters"]
+        lines.append(
+            f"取得 {counters['frames']} / 類似スキップ {counters['skipped']}"
+        )
+        lines.append(f"保存 {counters['saved']} / 既出 {counters['repeats']}")
+        if snapshot.get("dropped"):
+            lines.append(f"破棄 {snapshot['dropped']}")
+        if "pool_bytes" in snapshot:
+            lines.append(
+                f"バッファ {snapshot['pool_bytes'] / 1e6:.0f} MB / 直近 {snapshot.get('recent_frames', 0)} 枚"
+            )
+        if snapshot.get("log_suppressed") or snapshot.get("log_dropped"):
+            lines.append(
+                f"ログ省略 {snapshot.get('log_suppressed', 0)} / 破棄 {snapshot.get('log_dropped', 0)}"
+            )
+        lines.append(
+            f"メモリ {snapshot['rss_bytes'] / 1e6:.0f} MB (最大 {snapshot['rss_high_water_bytes'] / 1e6:.0f} MB)"
+        )
+        return "\n".join(lines)
+
+
+def to_prometheus(snapshot, prefix="slide_capture"):
+    """スナップショットを Prometheus のテキスト形式にする"""
+    lines = []
+    lines.append(f"# TYPE {prefix}_stage_ms gauge")
+    for stage, stats in snapshot["stages"].items():
+        for key in ("p50", "p95", "p99"):
+            quantile = int(key[1:]) / 100.0
+            lines.append(
+                f'{prefix}_stage_ms{{stage="{stage}",quantile="{quantile}"}} {stats[key + "_ms"]}'
+            )
+    lines.append(f"# TYPE {prefix}_stage_total counter")
+    for stage, stats in snapshot["stages"].items():
+        lines.append(f'{prefix}_stage_total{{stage="{stage}"}} {stats["count"]}')
+    for name, value in snapshot["counters"].items():
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        lines.append(f"{prefix}_{name}_total {value}")
+    for name in ("queue_depth", "dropped", "pool_bytes", "recent_frames"):
+        if name in snapshot:
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {snapshot[name]}")
+    for name in ("log_suppressed", "log_dropped"):
+        if name in snapshot:
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {snapshot[name]}")
+    lines.append(f"# TYPE {prefix}_rss_bytes gauge")
+    lines.append(f"{prefix}_rss_bytes {snapshot['rss_bytes']}")
+    lines.append(f"# TYPE {prefix}_rss_high_water_bytes gauge")
+    lines.append(f"{prefix}_rss_high_water_bytes {snapshot['rss_high_water_bytes']}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """一定間隔でスナップショットをファイルに書き出すスレッド
+
+    extra_func: スナップショットに追加する値 (保存キューの深さなど) を返す関数
+    """
+
+    def __init__(self, metrics, path, export_format="jsonl", interval=10.0, extra_func=None):
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(
+                f"未対応のエクスポート形式です: {export_format} (選択肢: {', '.join(EXPORT_FORMATS)})"
+            )
+        self.metrics = metrics
+        self.path = path
+        self.export_format = export_format
+        self.interval = interval
+        self.extra_func = extra_func
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="MetricsExporter", daemon=True
+        )
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """エクスポートを止め、最後のスナップショットを書き出す"""
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=2.0)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.export()
+        self.export()
+
+    def export(self):
+        try:
+            extra = self.extra_func() if self.extra_func else None
+            snapshot = self.metrics.snapshot(extra)
+            if self.export_format == "jsonl":
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(snapshot, ensure_ascii=False) + "\n")
+            else:
+                # 読み手が書きかけのファイルを見ないよう、置き換えで更新する
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(to_prometheus(snapshot))
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(
+                f"警告: 性能統計を書き出せませんでした: {type(e).__name__} - {e} ({self.path})"
+            )
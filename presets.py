@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""UIの選択肢 (任意の指定も入力可能)
+
+ウィンドウを表示するだけなら OpenCV / numpy を読み込まずに済むよう、
+選択肢の定義はこの軽量なモジュールに置く。各モジュールからも再エクスポートする。
+"""
+
+# 保存形式 (encoders.create_encoder の指定)
+ENCODER_PRESETS = (
+    "png:3",
+    "png:9",
+    "png-fast",
+    "webp-lossless",
+    "webp:90",
+    "jpeg:90",
+    "bmp",
+)
+
+# 検出方式 (fingerprint.create_engine の指定)
+ENGINE_PRESETS = (
+    "fingerprint",
+    "full",
+    "full:tolerance=8,blur=3",
+    "block",
+    "ssim",
+)
+
+# 出力デッキ (deck.parse_deck_spec の指定)
+DECK_PRESETS = ("なし", "pdf", "pdf:width=1920,format=jpeg:85", "zip")
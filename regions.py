@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""キャプチャ領域 (ROI) とモニターの指定
+
+領域の指定形式 (";" 区切りで複数指定可):
+    名前=左,上,右,下     仮想デスクトップ座標の矩形 (例: slide=0,0,1920,1080)
+    名前=monitor2         2番目のモニター全体 (番号は1から)
+
+領域ごとに前回フレームの状態と保存先サブフォルダ (領域名) を持つ。
+"""
+import contextlib
+import logging
+import sys
+from collections import OrderedDict
+
+from PIL import ImageGrab
+
+logger = logging.getLogger(__name__)
+
+INVALID_NAME_CHARS = '<>:"/\\|?*'
+
+
+class CaptureRegion:
+    """キャプチャ対象の矩形領域。bbox が None の場合は画面全体"""
+
+    __slots__ = ("name", "bbox")
+
+    def __init__(self, name, bbox=None):
+        self.name = name
+        self.bbox = bbox
+
+    @property
+    def area(self):
+        if self.bbox is None:
+            return None
+        left, top, right, bottom = self.bbox
+        return (right - left) * (bottom - top)
+
+    def __repr__(self):
+        return f"CaptureRegion({self.name!r}, {self.bbox!r})"
+
+
+FULL_SCREEN = CaptureRegion("screen", None)
+
+
+@contextlib.contextmanager
+def _physical_pixels(user32):
+    """このスレッドの座標を物理ピクセル (Per-Monitor DPI) にする
+
+    ImageGrab.grab(all_screens=True) の座標系に合わせるため。
+    """
+    set_context = getattr(user32, "SetThreadDpiAwarenessContext", None)
+    previous = set_context(-3) if set_context else None  # DPI_AWARENESS_CONTEXT_PER_MONITOR_AWARE
+    try:
+        yield
+    finally:
+        if previous:
+            set_context(previous)
+
+
+def primary_screen_bbox():
+    """プライマリモニターの仮想デスクトップ上の矩形 (Windowsのみ。他は None)
+
+    ImageGrab.grab() が取得する範囲で、左上は常に (0, 0)。
+    """
+    if sys.platform != "win32":
+        return None
+
+    import ctypes
+
+    user32 = ctypes.windll.user32
+    with _physical_pixels(user32):
+        # SM_CXSCREEN, SM_CYSCREEN
+        return (0, 0, user32.GetSystemMetrics(0), user32.GetSystemMetrics(1))
+
+
+def list_monitors():
+    """接続されているモニターの矩形 (左, 上, 右, 下) を列挙する (Windowsのみ)"""
+    if sys.platform != "win32":
+        return []
+
+    import ctypes
+    from ctypes import wintypes
+
+    class MONITORINFO(ctypes.Structure):
+        _fields_ = [
+            ("cbSize", wintypes.DWORD),
+            ("rcMonitor", wintypes.RECT),
+            ("rcWork", wintypes.RECT),
+            ("dwFlags", wintypes.DWORD),
+        ]
+
+    user32 = ctypes.windll.user32
+    monitors = []
+    MonitorEnumProc = ctypes.WINFUNCTYPE(
+        ctypes.c_int,
+        wintypes.HMONITOR,
+        wintypes.HDC,
+        ctypes.POINTER(wintypes.RECT),
+        wintypes.LPARAM,
+    )
+
+    def callback(hmonitor, hdc, lprect, lparam):
+        info = MONITORINFO()
+        info.cbSize = ctypes.sizeof(MONITORINFO)
+        if user32.GetMonitorInfoW(hmonitor, ctypes.byref(info)):
+            rect = info.rcMonitor
+            monitors.append((rect.left, rect.top, rect.right, rect.bottom))
+        return 1
+
+    with _physical_pixels(user32):
+        user32.EnumDisplayMonitors(None, None, MonitorEnumProc(callback), 0)
+    return monitors
+
+
+def parse_regions(text, monitors=None):
+    """領域指定文字列を CaptureRegion のリストに変換する
+
+    空文字列の場合は画面全体 (FULL_SCREEN) のみを返す。
+    不正な指定は ValueError を送出する。
+    """
+    text = (text or "").strip()
+    if not text:
+        return [FULL_SCREEN]
+
+    regions = []
+    names = set()
+    for index, item in enumerate(filter(None, (p.strip() for p in text.split(";")))):
+        if "=" in item:
+            name, spec = (part.strip() for part in item.split("=", 1))
+        else:
+            name, spec = f"region{index + 1}", item
+        if not name or any(c in INVALID_NAME_CHARS for c in name):
+            raise ValueError(f"領域名が不正です: '{name}'")
+        if name in names:
+            raise ValueError(f"領域名が重複しています: '{name}'")
+        names.add(name)
+
+        if spec.lower().startswith("monitor"):
+            if monitors is None:
+                monitors = list_monitors()
+            try:
+                number = int(spec[len("monitor"):])
+            except ValueError:
+                raise ValueError(f"モニター番号が不正です: '{spec}'") from None
+            if not 1 <= number <= len(monitors):
+                raise ValueError(
+                    f"モニター{number}が見つかりません (検出数: {len(monitors)})"
+                )
+            bbox = tuple(monitors[number - 1])
+        else:
+            try:
+                bbox = tuple(int(v) for v in spec.split(","))
+            except ValueError:
+                raise ValueError(f"領域の座標が不正です: '{spec}'") from None
+            if len(bbox) != 4:
+                raise ValueError(f"領域は 左,上,右,下 の4値で指定してください: '{spec}'")
+        left, top, right, bottom = bbox
+        if right <= left or bottom <= top:
+            raise ValueError(f"領域の幅または高さが0以下です: '{spec}'")
+        regions.append(CaptureRegion(name, bbox))
+    return regions
+
+
+def union_bbox(regions):
+    """複数領域をすべて含む最小の矩形"""
+    return (
+        min(r.bbox[0] for r in regions),
+        min(r.bbox[1] for r in regions),
+        max(r.bbox[2] for r in regions),
+        max(r.bbox[3] for r in regions),
+    )
+
+
+def grab_regions(regions):
+    """全領域を含む矩形を1回だけ取得し、(PIL.Image, 取得範囲の左上座標, 画面全体の矩形) を返す
+
+    PIL の ImageGrab は画面全体を取得してから bbox で切り出すため、
+    領域ごとに grab を呼ばず、各領域はこの画像から切り出す。
+    画面全体の矩形は、画面全体の領域 (bbox が None) を切り出す仮想デスクトップ上の
+    範囲で、None なら取得した画像全体が画面全体にあたる。
+    取得に失敗した場合は None を返す。
+    """
+    rects = [region for region in regions if region.bbox is not None]
+    if not rects:
+        screenshot = ImageGrab.grab()
+        return None if screenshot is None else (screenshot, (0, 0), None)
+
+    screen_bbox = None
+    bboxes = [region.bbox for region in rects]
+    if len(rects) < len(regions):
+        # 画面全体と矩形の領域が混在する場合 (複数セッション): 矩形が別のモニターや
+        # 負の座標にあっても切り出せるよう、プライマリモニターと全矩形を含む範囲を
+        # 仮想デスクトップから取得する
+        screen_bbox = primary_screen_bbox()
+        if screen_bbox is None:
+            # 仮想デスクトップの座標がわからない環境では画面全体を取得する
+            screenshot = ImageGrab.grab(all_screens=True)
+            return None if screenshot is None else (screenshot, (0, 0), None)
+        bboxes.append(screen_bbox)
+    union = union_bbox([CaptureRegion("", bbox) for bbox in bboxes])
+    screenshot = ImageGrab.grab(bbox=union, all_screens=True)
+    if screenshot is None:
+        return None
+    return screenshot, (union[0], union[1]), screen_bbox
+
+
+class RegionState:
+    """領域ごとの比較状態と保存先"""
+
+    __slots__ = ("region", "save_path", "last_reference", "index", "gate", "index_references")
+
+    def __init__(self, region, save_path, index=None, gate=None):
+        self.region = region
+        self.save_path = save_path
+        self.last_reference = None
+        self.index = index  # 保存済みスライドの永続インデックス (SlideIndex)
+        self.gate = gate  # 新しいスライドの安定確認 (StableFrameGate)
+        # インデックスの候補を確認するために読み込んだ保存画像の参照 (ファイル名 -> 参照)
+        self.index_references = OrderedDict()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""非同期保存パイプライン
+
+キャプチャスレッドはフレームを有界キューに積むだけにし、エンコードと
+書き込みは専用のワーカースレッド群で行う。cv2.imencode はエンコード中に
+GILを解放するため、スレッドでも並列に処理できる。
+
+書き込みは一時ファイル (.part) に行い、rename で保存名に置き換える。
+journal (SessionJournal) を指定すると、fsync と rename はジャーナルの同期
+スレッドがまとめて行い、保存記録をジャーナルに残す。
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import cv2
+
+from encoders import create_encoder
+from frame import Frame
+from journal import temp_path_for
+from metrics import CaptureMetrics
+
+logger = logging.getLogger(__name__)
+
+POLICY_BLOCK = "block"  # キューが満杯ならキャプチャスレッドを待たせる
+POLICY_DROP_OLDEST = "drop_oldest"  # キューが満杯なら最も古い未保存フレームを捨てる
+SAVE_POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST)
+
+_STOP = object()  # ワーカー終了用の番兵
+
+
+class SaveJob:
+    """保存待ちの1フレーム"""
+
+    __slots__ = ("seq", "path", "image", "callback", "meta", "captured_at", "enqueued_at")
+
+    def __init__(self, seq, path, image, callback=None, meta=None):
+        self.seq = seq
+        self.path = path
+        self.image = image
+        self.callback = callback
+        self.meta = meta  # ジャーナルの保存記録に加える値 (フィンガープリントなど)
+        self.captured_at = datetime.now()
+        self.enqueued_at = time.perf_counter()
+
+
+class SaveWorkerPool:
+    """有界キューとワーカースレッドによる保存処理
+
+    on_saved(path, info): 保存成功時にワーカースレッド (ジャーナル使用時は同期スレッド) から
+        呼ばれる。info は保存順 (seq) とバイト数に submit() の meta を加えた辞書
+    on_error(): 保存失敗時にワーカースレッドから呼ばれる
+    journal: 保存を確定・記録する SessionJournal (None なら rename のみで fsync しない)
+    """
+
+    def __init__(
+        self,
+        workers=2,
+        max_queue=8,
+        policy=POLICY_BLOCK,
+        encoder=None,
+        on_saved=None,
+        on_error=None,
+        metrics=None,
+        journal=None,
+    ):
+        if policy not in SAVE_POLICIES:
+            raise ValueError(
+                f"未対応の保存ポリシーです: {policy} (選択肢: {', '.join(SAVE_POLICIES)})"
+            )
+        self.workers = max(1, int(workers))
+        self.policy = policy
+        self.encoder = encoder or create_encoder("png:3")
+        # 変換 (convert)・エンコード (encode)・書き込み (write) の処理時間の記録先
+        self.metrics = metrics or CaptureMetrics()
+        self.on_saved = on_saved
+        self.on_error = on_error
+        self.journal = journal
+
+        self._queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._latest_seq = -1
+        self._threads = []
+        self._closed = False
+
+        # 統計情報 (_lock で保護)
+        self.saved_count = 0
+        self.failed_count = 0
+        self.dropped_count = 0
+        self.last_saved_filename = ""
+        self.last_encode_ms = 0.0
+        self.avg_encode_ms = 0.0  # 指数移動平均
+        self.total_bytes = 0
+
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker, name=f"SaveWorker-{i + 1}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def queue_depth(self):
+        """保存待ちのフレーム数"""
+        return self._queue.qsize()
+
+    def submit(self, path, image_cv, callback=None, meta=None):
+        """フレームを保存キューに積む。積めた場合は True を返す
+
+        callback(path): このフレームの保存に成功したときにワーカースレッドから呼ばれる
+        meta: ジャーナルの保存記録に加える値の辞書
+        """
+        if self._closed:
+            logger.warning(f"警告: 保存パイプライン停止後の保存要求を無視しました: {path}")
+            return False
+
+        with self._lock:
+            job = SaveJob(self._seq, path, image_cv, callback, meta)
+            self._seq += 1
+
+        if self.policy == POLICY_BLOCK:
+            self._queue.put(job)
+            return True
+
+        while True:
+            try:
+                self._queue.put_nowait(job)
+                return True
+            except queue.Full:
+                try:
+                    dropped = self._queue.get_nowait()
+                except queue.Empty:
+                    continue
+                self._queue.task_done()
+                with self._lock:
+                    self.dropped_count += 1
+                logger.warning(
+                    f"警告: 保存キューが満杯のため古いフレームを破棄しました: {dropped.path}"
+                )
+
+    def flush(self, timeout=None):
+        """キュー内のフレームがすべて書き込まれ、確定するまで待つ。完了したら True"""
+        if timeout is None:
+            self._queue.join()
+            return self.journal.flush() if self.journal else True
+        # Queue.join はタイムアウトを指定できないため、未完了タスク数を監視する
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        if self.journal:
+            return self.journal.flush(max(0.0, deadline - time.monotonic()))
+        return True
+
+    def shutdown(self, timeout=None):
+        """残りのフレームを書き込んでからワーカーを終了する"""
+        if self._closed:
+            return True
+        self._closed = True
+        flushed = self.flush(timeout)
+        if not flushed:
+            logger.warning(
+                f"警告: 保存待ちのフレームが残っています ({self.queue_depth} 件)。"
+            )
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+        return flushed
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                self._write(job)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, job):
+        """1フレームをエンコードしてファイルに書き込む。エラー発生時はログに記録。"""
+        save_path = job.path
+        image_cv = job.image
+        try:
+            if isinstance(image_cv, Frame):
+                # 保存用の BGR 画像はキャプチャスレッドではなくここで作る
+                with self.metrics.stage("convert"):
+                    image_cv = image_cv.bgr()
+            start = time.perf_counter()
+            buffer = self.encoder.encode(image_cv)
+            encode_ms = (time.perf_counter() - start) * 1000.0
+            self.metrics.record("encode", encode_ms)
+            # 確定待ちの間にフレームのバッファを保持しない
+            job.image = None
+
+            if buffer is not None:
+                # imwrite と違い、非ASCIIのパスにも書き込める
+                # 途中でクラッシュしても保存名のファイルが壊れないよう、一時ファイルに書く
+                temp_path = temp_path_for(save_path)
+                with self.metrics.stage("write"):
+                    with open(temp_path, "wb") as f:
+                        f.write(buffer)
+                with self._lock:
+                    self.last_encode_ms = encode_ms
+                    if self.avg_encode_ms == 0.0:
+                        self.avg_encode_ms = encode_ms
+                    else:
+                        self.avg_encode_ms = 0.8 * self.avg_encode_ms + 0.2 * encode_ms
+                size = int(buffer.size)
+                if self.journal:
+                    record = {
+                        "type": "saved",
+                        "time": job.captured_at.isoformat(timespec="milliseconds"),
+                        "bytes": size,
+                        "format": self.encoder.name,
+                    }
+                    if job.meta:
+                        record.update(job.meta)
+                    # fsync と rename は同期スレッドがまとめて行う
+                    self.journal.commit(
+                        temp_path,
+                        save_path,
+                        record,
+                        on_commit=lambda path: self._on_committed(job, size, encode_ms),
+                        on_error=self._record_failure,
+                    )
+                else:
+                    os.replace(temp_path, save_path)
+                    self._on_committed(job, size, encode_ms)
+            else:
+                # imencodeが失敗した場合
+                error_msg = (
+                    f"エラー (保存): cv2.imencode ({self.encoder.name}) が失敗しました。\n"
+                    f" - 保存試行パス: {save_path}\n"
+                    f" - 画像サイズ: {image_cv.shape if image_cv is not None else 'None'}\n"
+                    f" - 考えられる原因: 保存形式に未対応のOpenCVビルド、画像データ破損など"
+                )
+                logger.error(error_msg)
+                self._record_failure()
+
+        except cv2.error as e:
+            logger.exception(
+                f"エラー (保存 - OpenCV): {type(e).__name__} - {e}\n - 保存試行パス: {save_path}"
+            )
+            self._record_failure()
+        except OSError as e:
+            logger.exception(
+                f"エラー (保存 - OS): {type(e).__name__} - {e}\n - 保存試行パス: {save_path}"
+            )
+            self._remove_temp(save_path)
+            self._record_failure()
+        except Exception as e:
+            logger.exception(
+                f"エラー (保存): 予期せぬエラー - {type(e).__name__}: {e}\n - 保存試行パス: {save_path}"
+            )
+            self._record_failure()
+
+    def _on_committed(self, job, size, encode_ms):
+        """保存名への置き換えが完了したフレームを集計し、コールバックを呼ぶ"""
+        save_path = job.path
+        with self._lock:
+            self.saved_count += 1
+            self.total_bytes += size
+            # 完了順ではなくキャプチャ順で最新のファイル名を保持する
+            if job.seq > self._latest_seq:
+                self._latest_seq = job.seq
+                self.last_saved_filename = os.path.basename(save_path)
+        logger.info(
+            f"画像を保存しました: {save_path} ({encode_ms:.0f} ms)",
+            extra={"event": "saved", "path": save_path, "bytes": size, "encode_ms": round(encode_ms, 1)},
+        )
+        if job.callback:
+            job.callback(save_path)
+        if self.on_saved:
+            info = {"seq": job.seq, "bytes": size}
+            if job.meta:
+                info.update(job.meta)
+            self.on_saved(save_path, info)
+
+    def _remove_temp(self, save_path):
+        """書き込みに失敗した一時ファイルを削除する"""
+        try:
+            os.remove(temp_path_for(save_path))
+        except OSError:
+            pass
+
+    def _record_failure(self):
+        with self._lock:
+            self.failed_count += 1
+        if self.on_error:
+            self.on_error()
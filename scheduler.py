@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""適応型キャプチャスケジューラ
+
+画面に変化があった直後はキャプチャ間隔を最小値まで縮め、静止している間は
+指数的に間隔を伸ばす (min_interval〜max_interval の範囲)。待機は
+threading.Event で行うため、停止要求があれば即座に起床する。
+"""
+import threading
+
+
+class AdaptiveScheduler:
+    """変化の有無に応じてキャプチャ間隔を調整するスケジューラ"""
+
+    def __init__(
+        self,
+        min_interval=0.5,
+        max_interval=4.0,
+        initial_interval=None,
+        backoff=1.5,
+        stop_event=None,
+    ):
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError(
+                f"キャプチャ間隔の範囲が不正です: min={min_interval}, max={max_interval}"
+            )
+        if backoff < 1.0:
+            raise ValueError(f"バックオフ係数は1.0以上を指定してください: {backoff}")
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        if initial_interval is None:
+            initial_interval = min_interval
+        self.interval = min(max(initial_interval, min_interval), max_interval)
+
+    def record(self, changed):
+        """キャプチャ結果を反映し、次のキャプチャまでの間隔 (秒) を返す"""
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return self.interval
+
+    def wait(self, timeout=None):
+        """次のキャプチャまで待つ。停止要求があれば True を返す"""
+        if timeout is None:
+            timeout = self.interval
+        return self.stop_event.wait(timeout)
+
+    def stop(self):
+        """待機中のキャプチャスレッドを即座に起こす"""
+        self.stop_event.set()
+
+    @property
+    def stopped(self):
+        return self.stop_event.is_set()
+
+
+class FixedScheduler(AdaptiveScheduler):
+    """従来と同じ固定間隔のスケジューラ (比較用)"""
+
+    def __init__(self, interval=2.0, stop_event=None):
+        super().__init__(
+            min_interval=interval,
+            max_interval=interval,
+            initial_interval=interval,
+            backoff=1.0,
+            stop_event=stop_event,
+        )
@@ -0,0 +1,1031 @@
+# -*- coding: utf-8 -*-
+"""名前付きキャプチャセッションと、画面取得を共有するキャプチャループ
+
+CaptureSession: 1つの発表 (保存先フォルダ) 分の状態。領域ごとの比較状態、
+    保存パイプライン、ジャーナル、デッキ、性能統計を持つ。
+CaptureLoop: 1つのフレームソースを読むキャプチャスレッド。画面キャプチャの
+    ループはすべてのセッションで共有し、全セッションの領域を含む範囲を
+    1ティックに1回だけ取得してセッションごとに切り出す。セッションが増えても
+    取得 (grab) のコストは増えない。動画/画像フォルダを再生するセッションは
+    それぞれ専用のループを持つ。
+SessionManager: セッションの開始・停止とループへの割り当てを行う。Tk に
+    依存しないため、GUI の他に制御 API やヘッドレス実行からも使える。
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import cv2
+import numpy as np
+from PIL import UnidentifiedImageError
+
+from deck import DeckBuilder, deck_filename, parse_deck_spec
+from encoders import create_encoder
+from fingerprint import Fingerprint, StableFrameGate, create_engine
+from frame import Frame
+from frame_pool import FramePool, FrameRingBuffer
+from frame_source import ScreenSource, create_frame_source
+from journal import SessionJournal, recover
+from log_config import log_stats
+from metrics import CaptureMetrics, MetricsExporter, current_rss
+from regions import RegionState, parse_regions
+from save_pipeline import POLICY_BLOCK, SaveWorkerPool
+from scheduler import AdaptiveScheduler
+from slide_index import SlideIndex, slide_key
+
+logger = logging.getLogger(__name__)
+
+INVALID_FOLDER_CHARS = '<>:"/\\|?*'
+# 既出スライドの確認用に保持する、保存画像から作った参照の数 (領域ごと)
+INDEX_REFERENCE_CACHE = 4
+
+STATE_IDLE = "idle"
+STATE_CAPTURING = "capturing"
+STATE_STOPPING = "stopping"
+STATE_STOPPED = "stopped"
+# CaptureLoop._tick の戻り値: フレームを取得できなかった (少し待ってリトライする)
+_READ_FAILED = "read_failed"
+
+
+def reference_nbytes(reference):
+    """比較エンジンの参照 (画像の配列または Fingerprint) のバイト数"""
+    return getattr(reference, "nbytes", 0)
+
+
+class SessionError(Exception):
+    """セッションを開始できない理由 (title はダイアログの見出し)"""
+
+    def __init__(self, title, message):
+        super().__init__(message)
+        self.title = title
+
+
+def sanitize_folder_name(text):
+    """保存フォルダ名を決める。(フォルダ名, 不適切な文字を置換したか) を返す
+
+    空欄なら日時入りの既定名にする。
+    """
+    text = (text or "").strip()
+    if not text:
+        return f"saved_screenshots_{datetime.now().strftime('%Y%m%d_%H%M%S')}", False
+    # ファイル名として不適切な文字を置換 (簡易的な対策)
+    folder_name = "".join(c if c not in INVALID_FOLDER_CHARS else "_" for c in text)
+    return folder_name, folder_name != text
+
+
+class CaptureSession:
+    """名前付きのキャプチャセッション
+
+    open() で入力の指定を検証して保存先・保存パイプラインなどを用意し、
+    キャプチャループから process() で1ティック分のフレームを受け取る。
+    close() で保存待ちのフレームを書き込み、ジャーナルとデッキを完成させる。
+    """
+
+    def __init__(
+        self,
+        name,
+        folder,
+        regions="",
+        source="",
+        encoder="png:3",
+        engine="fingerprint",
+        stable_ticks=0,
+        deck="",
+    ):
+        self.name = name
+        self.folder = folder  # 保存フォルダ名 (カレントフォルダからの相対パスも可)
+        self.regions_spec = regions  # 空欄なら画面全体
+        self.source_spec = source  # 空欄なら画面キャプチャ
+        self.encoder_spec = encoder
+        self.engine_spec = engine
+        self.stable_ticks = stable_ticks
+        self.deck_spec = deck
+        # 保存済みスライドのインデックスで、過去のスライドへの戻りも重複保存しない
+        self.use_slide_index = True
+        self.replay_sample_interval = 1.0  # 動画再生時のサンプリング間隔 (秒)
+        self.save_workers = 2  # エンコード/書き込みスレッド数
+        self.save_queue_size = 8  # 保存待ちキューの上限
+        self.save_policy = POLICY_BLOCK  # キュー満杯時の動作 (block / drop_oldest)
+        self.save_flush_timeout = 30.0  # 停止時に保存完了を待つ最大秒数
+        self.journal_sync_interval = 1.0  # 確定待ちのファイルを同期する間隔 (秒)
+        self.metrics_format = "jsonl"  # jsonl または prom (Prometheus テキスト形式)
+        self.metrics_interval = 10.0  # 書き出し間隔 (秒)
+        self.retro_seconds = 10.0  # さかのぼり保存で保持する秒数
+        self.deck_finalize_timeout = 60.0  # 停止時にデッキの完成を待つ最大秒数
+        # 保存を確定させてから次のティックを処理する。実時間より速く読む入力 (動画の
+        # 再生など) で、直後のフレームを保存前のスライドと既出照合できるようにする
+        self.sync_saves = False
+
+        self.state = STATE_IDLE
+        self.save_path = None  # 保存フォルダの絶対パス
+        self.regions = []
+        self.region_states = []
+        self.comparator = None
+        self.encoder = None
+        self.deck_options = None
+        self.save_pool = None
+        self.journal = None
+        self.recovered = None  # 前回までのセッションの保存状態 (JournalState)
+        self.decks = {}  # 保存先フォルダ -> DeckBuilder
+        self.metrics = None
+        self.metrics_exporter = None
+        self.recent_frames = None  # さかのぼり保存用の直近フレーム (FrameRingBuffer)
+        # 既出確認用の参照 (index_references) の合計バイト数の上限 (None なら件数のみで制限)
+        self.reference_max_bytes = None
+        self.retro_count = 0  # さかのぼり保存した枚数
+        self.loop = None  # このセッションにフレームを渡す CaptureLoop
+        self.error_occurred = False  # スレッド内エラーフラグ
+        self.started_at = None
+        self.stopped_at = None
+        self._saved_listeners = []
+
+    @property
+    def is_capturing(self):
+        return self.state == STATE_CAPTURING
+
+    @property
+    def shares_screen(self):
+        """共有の画面キャプチャループを使うか (入力の指定がなければ画面キャプチャ)"""
+        return not (self.source_spec or "").strip()
+
+    @property
+    def saved_count(self):
+        """保存済み枚数 (保存ワーカーが書き込みを完了した枚数)"""
+        return self.save_pool.saved_count if self.save_pool else 0
+
+    @property
+    def last_saved_filename(self):
+        """キャプチャ順で最新の保存済みファイル名 (今回まだなければ前回までの最新)"""
+        if self.save_pool and self.save_pool.last_saved_filename:
+            return self.save_pool.last_saved_filename
+        return self.recovered.last_saved_filename if self.recovered else ""
+
+    def add_saved_listener(self, listener):
+        """listener(session, path, info) を保存確定のたびに (保存ワーカーのスレッドから) 呼ぶ"""
+        self._saved_listeners.append(listener)
+
+    def validate(self):
+        """入力の指定を検証する。不正な指定は SessionError"""
+        try:
+            self.regions = parse_regions(self.regions_spec)
+        except ValueError as e:
+            raise SessionError(
+                "領域指定エラー",
+                f"キャプチャ領域の指定が不正です:\n{e}\n"
+                "形式: 名前=左,上,右,下 または 名前=monitor番号 (; 区切り)",
+            ) from None
+        try:
+            self.encoder = create_encoder(self.encoder_spec)
+        except ValueError as e:
+            raise SessionError("保存形式エラー", str(e)) from None
+        try:
+            self.comparator = create_engine(self.engine_spec)
+            self.stable_ticks = int(self.stable_ticks)
+            if self.stable_ticks < 0:
+                raise ValueError("安定確認の回数は0以上で指定してください")
+        except ValueError as e:
+            raise SessionError("検出方式エラー", str(e)) from None
+        try:
+            self.deck_options = parse_deck_spec(self.deck_spec)
+        except ValueError as e:
+            raise SessionError("出力デッキエラー", str(e)) from None
+        logger.info(
+            f"[{self.name}] キャプチャ領域: {self.regions} 保存形式: {self.encoder.description} "
+            f"検出方式: {self.engine_spec} (安定確認 {self.stable_ticks} 回)"
+        )
+
+    def open(self, min_capture_interval=0.5, retro_max_bytes=None, reference_max_bytes=None):
+        """保存先フォルダと保存パイプラインを用意する。失敗したら SessionError / OSError
+
+        retro_max_bytes: さかのぼり保存用に保持するフレームの合計バイト数の上限
+        reference_max_bytes: 既出確認用に保持する参照の合計バイト数の上限 (全領域の合計)
+        """
+        self.reference_max_bytes = reference_max_bytes
+        self.save_path = os.path.abspath(self.folder)
+        logger.info(f"[{self.name}] 保存先フォルダの絶対パス: {self.save_path}")
+        if not os.path.exists(self.save_path):
+            logger.info(f"フォルダが存在しないため作成します: {self.save_path}")
+            os.makedirs(self.save_path, exist_ok=True)
+        elif not os.path.isdir(self.save_path):
+            raise SessionError(
+                "エラー", f"指定されたパスはフォルダではありません: {self.save_path}"
+            )
+        # 書き込み権限チェック (Windows用簡易チェック)
+        elif not os.access(self.save_path, os.W_OK):
+            raise SessionError(
+                "権限エラー",
+                f"指定されたフォルダへの書き込み権限がありません:\n{self.save_path}\n"
+                "別のフォルダを指定するか、権限を確認してください。",
+            )
+
+        # 前回までの保存記録を読み込み、書き込み途中で残った一時ファイルを片付ける
+        self.recovered = recover(self.save_path)
+
+        # 領域ごとの保存先サブフォルダ (画面全体の場合は保存先フォルダ直下)
+        self.region_states = []
+        for region in self.regions:
+            if region.bbox is None:
+                region_path = self.save_path
+            else:
+                region_path = os.path.join(self.save_path, region.name)
+                os.makedirs(region_path, exist_ok=True)
+            index = None
+            if self.use_slide_index:
+                index = SlideIndex(region_path)
+                index.load()
+            gate = StableFrameGate(self.stable_ticks)
+            self.region_states.append(RegionState(region, region_path, index, gate))
+
+        self.metrics = CaptureMetrics()
+        self.recent_frames = FrameRingBuffer(
+            seconds=self.retro_seconds,
+            max_frames=int(self.retro_seconds / min_capture_interval) + 1,
+            max_bytes=retro_max_bytes,
+        )
+        self.retro_count = 0
+        self.error_occurred = False
+        self.journal = SessionJournal(
+            self.save_path,
+            sync_interval=self.journal_sync_interval,
+            metrics=self.metrics,
+        )
+        self.decks = {}
+        if self.deck_options:
+            filename = deck_filename(self.deck_options)
+            for state in self.region_states:
+                try:
+                    self.decks[state.save_path] = DeckBuilder(
+                        os.path.join(state.save_path, filename),
+                        self.deck_options,
+                        on_error=self._on_save_error,
+                    )
+                except OSError as e:
+                    logger.exception(
+                        f"エラー (デッキ): {type(e).__name__} - {e}\n - 保存先: {state.save_path}"
+                    )
+                    self.error_occurred = True
+        self.save_pool = SaveWorkerPool(
+            workers=self.save_workers,
+            max_queue=self.save_queue_size,
+            policy=self.save_policy,
+            encoder=self.encoder,
+            on_saved=self._on_saved,
+            on_error=self._on_save_error,
+            metrics=self.metrics,
+            journal=self.journal,
+        )
+        metrics_path = os.path.join(self.save_path, f"capture_metrics.{self.metrics_format}")
+        self.metrics_exporter = MetricsExporter(
+            self.metrics,
+            metrics_path,
+            export_format=self.metrics_format,
+            interval=self.metrics_interval,
+            extra_func=self.metrics_extra,
+        ).start()
+
+    def begin(self, source_description):
+        self.state = STATE_CAPTURING
+        self.started_at = time.time()
+        self.stopped_at = None
+        self.journal.log_event(
+            "start",
+            session=self.name,
+            source=source_description,
+            engine=self.engine_spec,
+            format=self.encoder.name,
+            regions=[st.region.name for st in self.region_states],
+        )
+        logger.info(
+            f"[{self.name}] キャプチャを開始しました。入力: {source_description} 保存先: {self.save_path}"
+        )
+
+    def metrics_extra(self):
+        """統計スナップショットに加える保存キュー・共有ループ・ログ出力の状態"""
+        if not self.save_pool:
+            return None
+        extra = {
+            "session": self.name,
+            "queue_depth": self.save_pool.queue_depth,
+            "dropped": self.save_pool.dropped_count,
+            "recent_frames": len(self.recent_frames) if self.recent_frames else 0,
+            "reference_bytes": self.reference_bytes,
+        }
+        if self.loop:
+            extra["pool_bytes"] = self.loop.pool.allocated_bytes
+            extra["loop_sessions"] = len(self.loop.sessions)
+            grab = self.loop.metrics.snapshot()["stages"].get("grab")
+            if grab:
+                extra["shared_grab"] = grab
+        extra.update(log_stats())
+        return extra
+
+    def process(self, frames, label):
+        """1ティック分の領域ごとのフレームを処理する。変化があったら True"""
+        self.metrics.count("frames")
+        self.recent_frames.push(frames, label)
+        saved = self.metrics.counters["saved"]
+        changed = False
+        for state, frame in zip(self.region_states, frames):
+            if self.process_frame(state, frame, label):
+                changed = True
+        if self.sync_saves and self.metrics.counters["saved"] != saved:
+            # 保存とインデックスへの登録が済むまで待つ
+            if not self.save_pool.flush(self.save_flush_timeout):
+                logger.warning(f"[{self.name}] 警告: 保存の確定が時間内に完了しませんでした。")
+        return changed
+
+    def process_frame(self, state, frame, label=None):
+        """1領域分のフレームを前回と比較し、新しいスライドなら保存する。保存したら True"""
+        # 有効な画像か確認 (BGR への変換は保存ワーカーが必要なときだけ行う)
+        if frame is None or frame.size == 0:
+            logger.error(
+                f"エラー: 画像データの変換に失敗しました (Noneまたはサイズ0)。領域: {state.region.name}"
+            )
+            self.error_occurred = True
+            return False
+
+        # 前回の画像と比較 (フィンガープリント同士で比較)
+        with self.metrics.stage("compare"):
+            current = self.comparator.prepare(frame)
+            similar = state.last_reference is not None and self.is_similar(
+                current, state.last_reference
+            )
+            pending = False
+            if similar:
+                state.gate.reset()
+            else:
+                # 切り替えアニメーション中などは、静止するまで保存を保留する
+                pending = not state.gate.confirm(frame)
+        if pending:
+            # 保留中は変化中として扱い、キャプチャ間隔を短く保つ
+            return True
+        if state.last_reference is None:
+            logger.info(f"[{self.name}] 最初の画像を取得しました。保存します。領域: {state.region.name}")
+        elif not similar:
+            logger.info(
+                f"[{self.name}] 新しい画像または類似していない画像を検出しました。保存します。領域: {state.region.name}"
+            )
+        else:
+            self.metrics.count("skipped")
+            return False
+
+        # 過去に保存したすべてのスライドと照合 (前のスライドへの戻りやセッション再開)
+        # 検索キーはジャーナルの保存記録にも残す
+        key = slide_key(current if isinstance(current, Fingerprint) else frame)
+        meta = {"label": label, "region": state.region.name}
+        meta.update(key.to_record())
+        callback = None
+        if state.index is not None:
+            index = state.index
+            # ハッシュが近いだけでは既出としない (箇条書きの追加などを見逃さない)
+            repeated = index.lookup(
+                key, lambda filename: self.confirm_repeat(state, current, filename)
+            )
+            if repeated:
+                logger.info(
+                    f"[{self.name}] 既出のスライドのため保存せず参照として記録します: {repeated} 領域: {state.region.name}"
+                )
+                index.add_repeat(key, repeated)
+                state.last_reference = self.comparator.to_reference(current)
+                self.metrics.count("repeats")
+                return True
+            # 保存に成功したらインデックスに登録する
+            callback = lambda path: index.add(key, os.path.basename(path))
+
+        self.save_image(frame, state.save_path, label, callback, meta)
+        state.last_reference = self.comparator.to_reference(current)
+        self.metrics.count("saved")
+        return True
+
+    def confirm_repeat(self, state, current, filename):
+        """インデックスの候補 filename の保存画像と現在フレームを比較エンジンで比較する
+
+        読み込んだ画像の参照は直近 INDEX_REFERENCE_CACHE 件、かつ合計が
+        reference_max_bytes を領域数で割ったバイト数に収まる分だけ保持する
+        (フル解像度の参照は 4K で1件約 25 MB になる)。
+        画像を読み込めない場合は既出とみなさない (保存する)。
+        """
+        reference = state.index_references.get(filename)
+        if reference is None:
+            path = os.path.join(state.save_path, filename)
+            try:
+                # 日本語を含むパスでも読めるよう cv2.imread ではなく imdecode を使う
+                image = cv2.imdecode(np.fromfile(path, dtype=np.uint8), cv2.IMREAD_COLOR)
+            except OSError as e:
+                logger.warning(f"警告: 既出候補の画像を読み込めません: {path} ({e})")
+                return False
+            if image is None:
+                logger.warning(f"警告: 既出候補の画像を読み込めません: {path}")
+                return False
+            reference = self.comparator.to_reference(self.comparator.prepare(Frame(image, "BGR")))
+            similar = self.is_similar(current, reference)
+            # 比較で作られた作業用の画像 (輝度画像など) も含めた大きさで数える
+            self._cache_reference(state, filename, reference)
+            return similar
+        state.index_references.move_to_end(filename)
+        return self.is_similar(current, reference)
+
+    def _cache_reference(self, state, filename, reference):
+        """参照を保持し、件数かバイト数の上限を超えたら古いものから手放す
+
+        1件で上限を超える参照は保持しない (比較には使うが、次回は読み直す)。
+        """
+        budget = None
+        if self.reference_max_bytes is not None:
+            budget = self.reference_max_bytes // max(1, len(self.region_states))
+            if reference_nbytes(reference) > budget:
+                return
+        state.index_references[filename] = reference
+        while len(state.index_references) > INDEX_REFERENCE_CACHE or (
+            budget is not None
+            and sum(reference_nbytes(r) for r in state.index_references.values()) > budget
+        ):
+            state.index_references.popitem(last=False)
+
+    @property
+    def reference_bytes(self):
+        """既出確認用に保持している参照の合計バイト数"""
+        return sum(
+            reference_nbytes(reference)
+            for state in self.region_states
+            for reference in list(state.index_references.values())
+        )
+
+    def is_similar(self, current, reference):
+        """現在フレームと参照の類似度を比較エンジンで判定する"""
+        try:
+            return self.comparator.is_similar(current, reference)
+
+        except cv2.error as e:
+            logger.exception(f"エラー (類似度計算 - OpenCV): {type(e).__name__} - {e}")
+            self.error_occurred = True
+            return False
+        except Exception as e:
+            logger.exception(
+                f"エラー (類似度計算): 予期せぬエラー - {type(e).__name__}: {e}"
+            )
+            self.error_occurred = True
+            return False
+
+    def save_image(self, image_cv, save_dir=None, label=None, callback=None, meta=None):
+        """画像を保存キューに積む。書き込みは保存ワーカーが行う。"""
+        save_path = None
+        try:
+            # ファイル名のタイムスタンプはキャプチャ時刻 (再生時は動画内の位置など) とする
+            timestamp = label or datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+            filename = f"screenshot_{timestamp}{self.save_pool.encoder.extension}"
+            save_path = os.path.join(save_dir or self.save_path, filename)
+
+            if image_cv is None or image_cv.size == 0:
+                logger.warning(
+                    f"警告: 保存しようとした画像データが無効です (Noneまたはサイズ0)。パス: {save_path}"
+                )
+                self.error_occurred = True
+                return
+
+            self.save_pool.submit(save_path, image_cv, callback, meta)
+
+        except Exception as e:
+            logger.exception(
+                f"エラー (保存): 予期せぬエラー - {type(e).__name__}: {e}\n - 保存試行パス: {save_path}"
+            )
+            self.error_occurred = True
+
+    def release_memory(self):
+        """さかのぼり保存用のフレームと比較用の詳細画像を解放する"""
+        self.recent_frames.clear()
+        for state in self.region_states:
+            state.index_references.clear()
+            # フィンガープリント方式の参照は縮小した詳細画像なしでも比較できる
+            if isinstance(state.last_reference, Fingerprint):
+                state.last_reference.detail = None
+
+    def save_recent_frames(self):
+        """直近 retro_seconds 秒のフレームを、領域ごとの retro_<時刻> フォルダに保存する"""
+        if not self.is_capturing or not self.recent_frames:
+            return False
+        entries = self.recent_frames.snapshot()
+        if not entries:
+            return False
+        folder_name = f"retro_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        # 保存キューが満杯だと待たされるため、呼び出し元 (UI スレッドなど) では行わない
+        threading.Thread(
+            target=self._save_recent_frames,
+            args=(entries, folder_name),
+            name="RetroSaveThread",
+            daemon=True,
+        ).start()
+        return True
+
+    def _save_recent_frames(self, entries, folder_name):
+        # キャプチャスレッドの比較エンジンとは作業用配列を共有しない
+        comparator = create_engine(self.engine_spec)
+        saved = 0
+        try:
+            for region_number, state in enumerate(self.region_states):
+                save_dir = os.path.join(state.save_path, folder_name)
+                os.makedirs(save_dir, exist_ok=True)
+                reference = None
+                for label, frames in entries:
+                    frame = frames[region_number]
+                    current = comparator.prepare(frame)
+                    # 静止中の同じ画面は1枚だけ保存する
+                    if reference is not None and comparator.is_similar(current, reference):
+                        continue
+                    reference = comparator.to_reference(current)
+                    self.save_image(
+                        frame, save_dir, label, meta={"label": label, "retro": True}
+                    )
+                    saved += 1
+            self.retro_count += saved
+            logger.info(
+                f"[{self.name}] 直前 {self.retro_seconds:.0f} 秒のフレームを {saved} 枚保存します: {folder_name}"
+            )
+        except (OSError, cv2.error) as e:
+            logger.exception(f"エラー (さかのぼり保存): {type(e).__name__} - {e}")
+            self.error_occurred = True
+        except Exception as e:
+            logger.exception(
+                f"エラー (さかのぼり保存): 予期せぬエラー - {type(e).__name__}: {e}"
+            )
+            self.error_occurred = True
+
+    def close(self):
+        """保存待ちのフレームを書き込み、ジャーナルとデッキを完成させる"""
+        if self.state in (STATE_STOPPED, STATE_IDLE):
+            return
+        self.state = STATE_STOPPING
+        # 保存待ちのフレームをすべて書き込んでから停止する
+        if self.save_pool:
+            logger.info(
+                f"[{self.name}] 保存待ちのフレームを書き込んでいます ({self.save_pool.queue_depth} 件)..."
+            )
+            if not self.save_pool.shutdown(timeout=self.save_flush_timeout):
+                self.error_occurred = True
+        if self.journal:
+            self.journal.log_event(
+                "stop", session=self.name, saved=self.saved_count, bytes=self.save_pool.total_bytes
+            )
+            if not self.journal.close(timeout=self.save_flush_timeout):
+                logger.warning("警告: ジャーナルの同期が時間内に完了しませんでした。")
+                self.error_occurred = True
+            self.journal = None
+        # 保存が確定したスライドをすべて書き込んでからデッキを完成させる
+        for deck in self.decks.values():
+            logger.info(f"デッキを仕上げています: {deck.path} ({deck.page_count} 枚書き込み済み)")
+            if deck.finalize(timeout=self.deck_finalize_timeout) is None and deck.page_count:
+                self.error_occurred = True
+        for state in self.region_states:
+            if state.index:
+                state.index.close()
+            # 参照として保持していたフレームを手放す
+            state.last_reference = None
+            state.index_references.clear()
+        if self.metrics_exporter:
+            self.metrics_exporter.stop()
+            self.metrics_exporter = None
+        if self.recent_frames:
+            self.recent_frames.clear()
+        self.loop = None
+        self.stopped_at = time.time()
+        self.state = STATE_STOPPED
+        logger.info(f"[{self.name}] キャプチャを停止しました。保存枚数: {self.saved_count}")
+
+    def status(self):
+        """現在の状態を辞書で返す (UI 表示や制御 API 用)"""
+        status = {
+            "name": self.name,
+            "state": self.state,
+            "folder": self.save_path or self.folder,
+            "source": self.source_spec or "",
+            "saved_count": self.saved_count,
+            "folder_total": (self.recovered.saved_count if self.recovered else 0)
+            + self.saved_count,
+            "last_saved_filename": self.last_saved_filename,
+            "error": self.error_occurred,
+            "retro_count": self.retro_count,
+            "repeat_count": sum(
+                st.index.repeat_count for st in self.region_states if st.index
+            ),
+        }
+        if self.save_pool:
+            status["queue_depth"] = self.save_pool.queue_depth
+            status["avg_encode_ms"] = round(self.save_pool.avg_encode_ms, 1)
+            status["dropped"] = self.save_pool.dropped_count
+        if self.decks:
+            status["deck"] = {
+                "file": os.path.basename(next(iter(self.decks.values())).path),
+                "pages": sum(deck.page_count for deck in self.decks.values()),
+            }
+        return status
+
+    def _on_saved(self, path, info):
+        """保存が確定したスライドを保存先フォルダのデッキに追加し、通知する"""
+        deck = self.decks.get(os.path.dirname(path))
+        if deck and not info.get("retro"):
+            deck.add(path, info)
+        for listener in self._saved_listeners:
+            try:
+                listener(self, path, info)
+            except Exception as e:
+                logger.exception(f"エラー (保存通知): {type(e).__name__}: {e}")
+
+    def _on_save_error(self):
+        """保存ワーカーでエラーが発生したときに呼ばれる"""
+        self.error_occurred = True
+
+
+class CaptureLoop:
+    """1つのフレームソースからフレームを読み、セッションに配るキャプチャスレッド
+
+    ソースの領域は、参加しているセッションの領域を順に並べたものにする。
+    read() が返す領域ごとのフレームを、セッションごとの領域数で分けて渡す。
+    """
+
+    def __init__(self, source, scheduler, pool, metrics, memory_limit_mb=1024, on_finished=None):
+        self.source = source
+        self.scheduler = scheduler
+        self.pool = pool
+        # 取得 (grab) と変換 (convert) の処理時間。全セッションで共有する
+        self.metrics = metrics
+        self.memory_limit_mb = memory_limit_mb
+        self.on_finished = on_finished  # on_finished(loop): 入力の終端でループが終わったとき
+        self.sessions = []
+        self.thread = None
+        self._memory_pressure = False
+        # 処理中のティックとセッションの追加・削除を排他する
+        self._tick_lock = threading.Lock()
+        # バッファが足りなくなったら、さかのぼり保存用のフレームを先に手放す
+        pool.on_pressure(self._clear_recent_frames)
+
+    def add(self, session):
+        with self._tick_lock:
+            self.sessions.append(session)
+            session.loop = self
+            self._update_regions()
+
+    def remove(self, session):
+        """セッションを外す。処理中のティックがあれば終わるまで待つ"""
+        with self._tick_lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+            self._update_regions()
+            return len(self.sessions)
+
+    def _update_regions(self):
+        if self.sessions:
+            self.source.regions = [r for s in self.sessions for r in s.regions]
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="CaptureThread", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=1.5):
+        """ループを止める。スレッドが時間内に終わったら True"""
+        self.scheduler.stop()
+        if self.thread and self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+            if self.thread.is_alive():
+                logger.warning("警告: キャプチャスレッドが時間内に終了しませんでした。")
+                return False
+        self.source.close()
+        return True
+
+    def run(self):
+        """定期的にフレームを取得し、セッションごとに比較・保存するループ"""
+        logger.info(f"キャプチャループを開始します。入力: {self.source.description}")
+        finished = False
+        while not self.scheduler.stopped:
+            changed = False
+            retry_after = None  # エラー後に待つ秒数
+            with self._tick_lock:
+                sessions = list(self.sessions)
+                if not sessions:
+                    break
+                try:
+                    changed = self._tick(sessions)
+                    finished = changed is None
+                    if changed is _READ_FAILED:
+                        changed = False
+                        retry_after = 2.0  # 少し待ってリトライ
+                except MemoryError as e:
+                    self._record_error(sessions, logger.error, "エラー (メモリ不足)", e)
+                    self.release_memory()
+                    retry_after = 2.0
+                except (OSError, UnidentifiedImageError) as e:
+                    self._record_error(sessions, logger.exception, "エラー (キャプチャ/変換)", e)
+                    retry_after = 5.0
+                except cv2.error as e:
+                    self._record_error(sessions, logger.exception, "エラー (OpenCV)", e)
+                    retry_after = 5.0
+                except Exception as e:
+                    self._record_error(
+                        sessions,
+                        logger.exception,
+                        "エラー (キャプチャループ): 予期せぬエラーが発生しました",
+                        e,
+                    )
+                    retry_after = 5.0
+            if finished:
+                break
+            if retry_after is not None:
+                # ロックの外で待ち、待機中もセッションの追加・削除を止めない
+                self.scheduler.wait(retry_after)
+                continue
+            # 次のキャプチャまで待機 (変化の有無で間隔を調整、停止要求で即座に起床)
+            # 再生ソースは待機せず、デコードできる速さで処理する
+            self.scheduler.record(bool(changed))
+            if self.source.realtime:
+                self.scheduler.wait()
+
+        logger.info("キャプチャループが終了しました。")
+        if finished and self.on_finished:
+            self.on_finished(self)
+
+    def _tick(self, sessions):
+        """1ティック分を処理する。変化があれば True、入力の終端なら None、取得の失敗なら _READ_FAILED"""
+        # 全セッションの領域を含む範囲を1回だけ取得する
+        frames = self.source.read()
+        if frames is None:
+            if self.source.finished:
+                logger.info(f"入力の終端に達しました ({self.source.frames_read} フレーム)。")
+                return None
+            for session in sessions:
+                session.error_occurred = True
+                session.metrics.count("errors")
+            return _READ_FAILED
+
+        self.metrics.count("frames")
+        label = self.source.timestamp_label()
+        changed = False
+        offset = 0
+        for session in sessions:
+            count = len(session.regions)
+            if session.process(frames[offset:offset + count], label):
+                changed = True
+            offset += count
+        # 待機中・エラー後にフレームのバッファを保持しない (プールへ戻す)
+        frames = None
+        self.check_memory_limit()
+        return changed
+
+    def _record_error(self, sessions, log, message, error):
+        log(
+            f"{message} - {type(error).__name__}: {error}",
+            extra={"event": "capture_error", "error": type(error).__name__},
+        )
+        for session in sessions:
+            session.error_occurred = True
+            session.metrics.count("errors")
+
+    def check_memory_limit(self):
+        """メモリ使用量が上限を超えていれば、保持しているデータを手放す"""
+        if not self.memory_limit_mb:
+            return
+        rss = current_rss()
+        if rss <= self.memory_limit_mb * 1024 * 1024:
+            self._memory_pressure = False
+            return
+        freed = self.release_memory()
+        if not self._memory_pressure:
+            # 上限を超えている間は1回だけ記録する
+            logger.warning(
+                f"警告: メモリ使用量 {rss / 1e6:.0f} MB が上限 {self.memory_limit_mb} MB を超えたため、"
+                f"直近フレームと比較用の詳細画像を解放しました ({freed / 1e6:.0f} MB)。"
+            )
+            for session in self.sessions:
+                session.metrics.count("memory_pressure")
+        self._memory_pressure = True
+
+    def release_memory(self):
+        """各セッションの保持データと空きバッファを解放し、解放したバイト数を返す"""
+        for session in list(self.sessions):
+            session.release_memory()
+        return self.pool.trim()
+
+    def _clear_recent_frames(self):
+        for session in list(self.sessions):
+            session.recent_frames.clear()
+
+
+class SessionManager:
+    """名前付きセッションの開始・停止と、キャプチャループへの割り当て
+
+    画面キャプチャのセッションはすべて1つの共有ループに参加する。
+    listeners に登録した関数は listener(event, session) の形で
+    "started" / "stopped" のときに呼ばれる。
+    """
+
+    def __init__(self):
+        self.sessions = OrderedDict()  # 名前 -> CaptureSession (停止済みも含む)
+        # キャプチャ間隔 (秒)。変化直後は最小値、静止中は最大値まで指数的に伸ばす
+        self.min_capture_interval = 0.5
+        self.max_capture_interval = 4.0
+        # プロセスのメモリ使用量の上限 (MB, 0 で無効)。超えたら直近フレームなどを手放す
+        # 各ループのフレームバッファは上限の 1/4、セッションごとのさかのぼり保存用の
+        # フレームと既出確認用の参照はそれぞれ 1/8 までに抑え、上限を超える前に
+        # 新しいフレームの受け入れや参照の保持を止める
+        self.memory_limit_mb = 1024
+        self.replay_sample_interval = 1.0
+        # 一覧に残す停止済みセッションの数。超えたら古いものから外す
+        # (長時間の運用で停止済みセッションの領域状態や統計を持ち続けない)
+        self.max_stopped_sessions = 8
+        self.screen_loop = None
+        self.listeners = []
+        self._lock = threading.RLock()
+
+    def snapshot(self):
+        """全セッション (停止済みも含む) のリスト
+
+        sessions は制御 API のスレッドなどから変更されるため、他のスレッド
+        (Tk のメインループなど) で一覧を走査するときはこちらを使う。
+        """
+        with self._lock:
+            return list(self.sessions.values())
+
+    @property
+    def active_sessions(self):
+        return [s for s in self.snapshot() if s.is_capturing]
+
+    def get(self, name):
+        return self.sessions.get(name)
+
+    def new_session(self, name=None, folder="", **options):
+        """設定からセッションを作る (まだ開始しない)。名前を省略したらフォルダ名にする"""
+        folder, _ = sanitize_folder_name(folder)
+        return CaptureSession(name or os.path.basename(folder), folder, **options)
+
+    def start_session(self, session, source=None):
+        """セッションを検証・準備してキャプチャループに参加させる。失敗したら SessionError / OSError
+
+        source: 入力の指定の代わりに使う FrameSource (ベンチマークの合成ソースなど)。
+            このセッション専用のループで読む
+        """
+        with self._lock:
+            existing = self.sessions.get(session.name)
+            if existing is not None and existing.state in (STATE_CAPTURING, STATE_STOPPING):
+                raise SessionError(
+                    "セッションエラー", f"同じ名前のセッションが実行中です: {session.name}"
+                )
+            folder = os.path.abspath(session.folder)
+            for other in self.active_sessions:
+                if other.save_path == folder:
+                    raise SessionError(
+                        "セッションエラー",
+                        f"保存フォルダがセッション '{other.name}' と重複しています: {folder}",
+                    )
+            session.validate()
+            session.replay_sample_interval = self.replay_sample_interval
+            loop = None
+            if source is not None:
+                if source.pool is None:
+                    source.pool = self._frame_pool()
+                source.regions = session.regions
+                loop = self._new_loop(source, source.pool, source.metrics)
+            elif not session.shares_screen:
+                # 再生ソースは先に開き、開けなければ保存フォルダなどを用意しない
+                loop = self._replay_loop(session)
+            budget = self._session_budget()
+            try:
+                session.open(self.min_capture_interval, budget, budget)
+            except Exception:
+                if loop:
+                    loop.source.close()
+                raise
+            if loop is None:
+                loop = self._shared_screen_loop()
+            session.sync_saves = not loop.source.realtime
+            self.sessions[session.name] = session
+            self.sessions.move_to_end(session.name)
+            session.begin(loop.source.description)
+            loop.add(session)
+            if loop.thread is None or not loop.thread.is_alive():
+                loop.start()
+        self._notify("started", session)
+        return session
+
+    def stop_session(self, name):
+        """セッションを止め、保存待ちのフレームとデッキを書き終えるまで待つ"""
+        with self._lock:
+            session = self.sessions.get(name)
+            if session is None or session.state != STATE_CAPTURING:
+                return session
+            session.state = STATE_STOPPING
+            logger.info(f"[{name}] キャプチャ停止処理を開始します。")
+            loop = session.loop
+        if loop is not None:
+            # 処理中のティックの終了は、manager のロックを持たずに待つ
+            # (待つ間も UI や制御 API からの状態取得・開始を止めない)
+            loop.remove(session)
+            with self._lock:
+                idle = not loop.sessions
+                if idle and loop is self.screen_loop:
+                    self.screen_loop = None
+            if idle:
+                loop.stop()
+        session.close()
+        self._notify("stopped", session)
+        self._prune_stopped()
+        return session
+
+    def stop_all(self):
+        for session in self.active_sessions:
+            self.stop_session(session.name)
+
+    def remove_session(self, name):
+        """停止済みのセッションを一覧から外す"""
+        with self._lock:
+            session = self.sessions.get(name)
+            if session is not None and session.state in (STATE_STOPPED, STATE_IDLE):
+                del self.sessions[name]
+                return True
+            return False
+
+    def _prune_stopped(self):
+        """停止済みのセッションを max_stopped_sessions 件まで減らす (古い順に外す)"""
+        with self._lock:
+            stopped = [
+                name for name, session in self.sessions.items()
+                if session.state in (STATE_STOPPED, STATE_IDLE)
+            ]
+            for name in stopped[:max(0, len(stopped) - self.max_stopped_sessions)]:
+                del self.sessions[name]
+
+    def _new_loop(self, source, pool, metrics):
+        return CaptureLoop(
+            source,
+            AdaptiveScheduler(
+                min_interval=self.min_capture_interval,
+                max_interval=self.max_capture_interval,
+            ),
+            pool,
+            metrics,
+            memory_limit_mb=self.memory_limit_mb,
+            on_finished=self._on_loop_finished,
+        )
+
+    def set_memory_limit(self, limit_mb):
+        """メモリ使用量の上限 (MB, 0 で無効) を変える。負の値なら ValueError
+
+        実行中のループの上限にもすぐ反映する。フレームバッファ・さかのぼり保存・
+        参照の予算は、次に開始するセッションから反映する。
+        """
+        limit_mb = int(limit_mb)
+        if limit_mb < 0:
+            raise ValueError(f"メモリ上限は 0 以上で指定してください: {limit_mb}")
+        with self._lock:
+            self.memory_limit_mb = limit_mb
+            loops = {session.loop for session in self.sessions.values() if session.loop}
+        for loop in loops:
+            loop.memory_limit_mb = limit_mb
+
+    def _session_budget(self):
+        """セッションごとのさかのぼり保存用フレーム・参照それぞれのバイト数の上限"""
+        return self.memory_limit_mb * 1024 * 1024 // 8 if self.memory_limit_mb else None
+
+    def _frame_pool(self):
+        budget = self.memory_limit_mb * 1024 * 1024 // 4 if self.memory_limit_mb else None
+        return FramePool(max_bytes=budget)
+
+    def _shared_screen_loop(self):
+        if self.screen_loop is None or not (
+            self.screen_loop.thread and self.screen_loop.thread.is_alive()
+        ):
+            metrics = CaptureMetrics()
+            pool = self._frame_pool()
+            self.screen_loop = self._new_loop(ScreenSource(metrics=metrics, pool=pool), pool, metrics)
+        return self.screen_loop
+
+    def _replay_loop(self, session):
+        metrics = CaptureMetrics()
+        pool = self._frame_pool()
+        try:
+            source = create_frame_source(
+                session.source_spec,
+                session.regions,
+                sample_interval=session.replay_sample_interval,
+                metrics=metrics,
+                pool=pool,
+            )
+        except OSError as e:
+            raise SessionError("入力エラー", f"入力を開けませんでした:\n{e}") from None
+        return self._new_loop(source, pool, metrics)
+
+    def _on_loop_finished(self, loop):
+        """再生ソースの終端に達したループのセッションを停止する (ループのスレッドから呼ばれる)"""
+        for session in list(loop.sessions):
+            logger.info(f"[{session.name}] 入力の終端に達したため、キャプチャを停止します。")
+            self.stop_session(session.name)
+
+    def _notify(self, event, session):
+        for listener in list(self.listeners):
+            try:
+                listener(event, session)
+            except Exception as e:
+                logger.exception(f"エラー (セッション通知): {type(e).__name__}: {e}")
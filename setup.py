@@ -34,8 +34,15 @@ executables = [
 #   zip_exclude_packages: zipファイルから除外するパッケージ (例: tkinter)
 build_exe_options = {
     "packages": ["tkinter", "cv2", "numpy"], # Pillowを削除し、cx_Freezeの自動検出に期待
-    "includes": [],
-    "excludes": ["tkinter.test", "tkinter.tix", "distutils"], # unittestを除外リストから削除
+    # 遅延読み込みしているモジュール (main.load_capture_modules)
+    "includes": ["session", "control_api", "deck", "encoders", "fingerprint", "frame_pool", "frame_source", "regions", "save_pipeline", "slide_index"],
+    # OpenCV は GUI を使わないため opencv-python-headless で十分 (Qt を同梱しない)
+    "excludes": [
+        "tkinter.test", "tkinter.tix", "distutils", # unittestを除外リストから削除
+        "matplotlib", "scipy", "pandas", "IPython", "PyQt5", "PySide2", "PySide6",
+        "pytest", "numpy.f2py", "numpy.distutils", "PIL.ImageQt", "PIL.ImageTk", "setuptools",
+    ],
+    "optimize": 1,
     "include_files": [icon_path] if os.path.exists(icon_path) else [], # 環境固有のパス指定を削除
     "zip_include_packages": ["*"],
     "zip_exclude_packages": ["tkinter"], # tkinterはzipに含めない方が良い場合がある
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""保存済みスライドの永続インデックス
+
+キャプチャフォルダ内の slide_index.jsonl に、保存したスライドの知覚ハッシュと
+ファイル名を1行ずつ追記する。start_capture 時に読み込み、新しいフレームを
+過去に保存した全スライドと照合する。プレゼンターが前のスライドに戻った場合や、
+同じフォルダでセッションを再開した場合は、PNG を保存せず参照として記録する。
+
+照合は3段階:
+1. 64bit dHash のハミング距離でマルチインデックスハッシュを検索し、候補を絞り込む
+2. 候補を 256bit dHash (16x16) の距離で確認する
+3. lookup() に confirm を渡した場合は、候補の保存画像をセッションの比較エンジンで
+   比較して確定する。箇条書きを1行追加したスライドのように、ハッシュでは
+   元のスライドと区別できない変化を既出扱いにしないため
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+import cv2
+
+from fingerprint import Fingerprint, FingerprintEngine, difference_hash
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILENAME = "slide_index.jsonl"
+
+try:
+    _popcount = int.bit_count  # Python 3.10 以降
+except AttributeError:
+
+    def _popcount(value):
+        return bin(value).count("1")
+
+
+def hamming(a, b):
+    return _popcount(a ^ b)
+
+
+def fine_hash(thumb_gray):
+    """照合確認用の 256bit dHash (17x16 に縮小して横方向の大小を比較)"""
+    small = cv2.resize(thumb_gray, (17, 16), interpolation=cv2.INTER_AREA)
+    value = 0
+    for bit in (small[:, 1:] > small[:, :-1]).ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+class SlideKey:
+    """インデックスの検索キー (64bit の粗いハッシュと 256bit の確認用ハッシュ)"""
+
+    __slots__ = ("coarse", "fine")
+
+    def __init__(self, coarse, fine):
+        self.coarse = coarse
+        self.fine = fine
+
+    def to_record(self):
+        """インデックスやジャーナルに書き込む16進表記"""
+        return {"coarse": f"{self.coarse:016x}", "fine": f"{self.fine:064x}"}
+
+
+_fingerprinter = None
+
+
+def slide_key(current):
+    """比較エンジンの状態 (Fingerprint) またはフレームから検索キーを作る"""
+    global _fingerprinter
+    if isinstance(current, Fingerprint):
+        thumb = current.thumb
+    else:
+        if _fingerprinter is None:
+            _fingerprinter = FingerprintEngine()
+        thumb = _fingerprinter.fingerprint(current).thumb
+    return SlideKey(difference_hash(thumb), fine_hash(thumb))
+
+
+class MultiIndexHashTable:
+    """ハミング距離検索用のマルチインデックスハッシュ
+
+    64bit のハッシュを radius + 1 個のブロックに分割し、ブロックごとの辞書に
+    登録する。距離 radius 以内のハッシュは鳩の巣原理により少なくとも1つの
+    ブロックが完全一致するため、各辞書を引くだけで候補を漏れなく集められる。
+    BK木と異なり、検索量が登録数にほぼ比例しない。
+    """
+
+    def __init__(self, radius, bits=64):
+        self.radius = radius
+        self.size = 0
+        blocks = radius + 1
+        widths = [bits // blocks + (1 if i < bits % blocks else 0) for i in range(blocks)]
+        self._blocks = []  # (シフト量, マスク)
+        shift = 0
+        for width in widths:
+            self._blocks.append((shift, (1 << width) - 1))
+            shift += width
+        self._tables = [{} for _ in self._blocks]
+
+    def add(self, key, value):
+        entry = (key, value)
+        for (shift, mask), table in zip(self._blocks, self._tables):
+            table.setdefault((key >> shift) & mask, []).append(entry)
+        self.size += 1
+
+    def search(self, key):
+        """距離 radius 以内の (距離, 値) を列挙する"""
+        results = []
+        seen = set()
+        for (shift, mask), table in zip(self._blocks, self._tables):
+            for entry in table.get((key >> shift) & mask, ()):
+                if id(entry) in seen:
+                    continue
+                seen.add(id(entry))
+                distance = hamming(key, entry[0])
+                if distance <= self.radius:
+                    results.append((distance, entry[1]))
+        return results
+
+
+class SlideIndex:
+    """キャプチャフォルダごとの保存済みスライドインデックス
+
+    coarse_radius: 候補とする 64bit ハッシュの距離
+    fine_radius: 同一スライドとみなす 256bit ハッシュの距離
+    """
+
+    def __init__(self, folder, coarse_radius=4, fine_radius=10):
+        self.folder = folder
+        self.path = os.path.join(folder, INDEX_FILENAME)
+        self.coarse_radius = coarse_radius
+        self.fine_radius = fine_radius
+        self.table = MultiIndexHashTable(coarse_radius)
+        self.repeat_count = 0
+        # 登録は保存ワーカー、検索はキャプチャスレッドから行われる
+        self._lock = threading.Lock()
+        self._file = None
+
+    def __len__(self):
+        return self.table.size
+
+    def load(self):
+        """インデックスファイルを読み込む。壊れた行はスキップする"""
+        if not os.path.exists(self.path):
+            return 0
+        loaded = 0
+        with open(self.path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    if record.get("type", "slide") != "slide":
+                        continue
+                    key = SlideKey(int(record["coarse"], 16), int(record["fine"], 16))
+                    filename = record["file"]
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(
+                        f"警告: スライドインデックスの {line_number} 行目を読み込めないためスキップします: {self.path}"
+                    )
+                    continue
+                self.table.add(key.coarse, (key.fine, filename))
+                loaded += 1
+        logger.info(f"スライドインデックスを読み込みました: {loaded} 件 ({self.path})")
+        return loaded
+
+    def candidates(self, key):
+        """確認用ハッシュの距離が fine_radius 以内のファイル名を距離の近い順に返す"""
+        with self._lock:
+            entries = self.table.search(key.coarse)
+        matches = {}
+        for _, (fine, filename) in entries:
+            distance = hamming(key.fine, fine)
+            if distance <= self.fine_radius and distance < matches.get(filename, distance + 1):
+                matches[filename] = distance
+        return sorted(matches, key=matches.get)
+
+    def lookup(self, key, confirm=None):
+        """過去に保存した同じスライドのファイル名を返す (なければ None)
+
+        confirm(filename) を渡すと、ハッシュが近い候補のうち confirm が True を
+        返した最初の候補を返す。
+        """
+        for filename in self.candidates(key):
+            if confirm is None or confirm(filename):
+                return filename
+        return None
+
+    def add(self, key, filename):
+        """保存したスライドを登録する"""
+        with self._lock:
+            self.table.add(key.coarse, (key.fine, filename))
+        record = {"type": "slide"}
+        record.update(key.to_record())
+        record["file"] = filename
+        record["time"] = datetime.now().isoformat(timespec="milliseconds")
+        self._append(record)
+
+    def add_repeat(self, key, filename):
+        """既出スライドの再表示を参照として記録する"""
+        with self._lock:
+            self.repeat_count += 1
+        self._append(
+            {
+                "type": "repeat",
+                "coarse": f"{key.coarse:016x}",
+                "ref": filename,
+                "time": datetime.now().isoformat(timespec="milliseconds"),
+            }
+        )
+
+    def _append(self, record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
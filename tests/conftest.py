@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""テスト共通: リポジトリ直下のモジュールを import できるようにし、合成スライドを作る"""
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def draw_slide(bullets, title="Quarterly results", size=(1280, 720)):
+    """見出しと bullets 行の箇条書きからなる BGR のスライド画像"""
+    width, height = size
+    image = np.full((height, width, 3), 255, np.uint8)
+    cv2.rectangle(image, (0, 0), (width, height * 11 // 72), (120, 60, 20), -1)
+    cv2.putText(image, title, (40, 80), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 4)
+    for i in range(bullets):
+        y = 200 + i * 90
+        cv2.circle(image, (70, y - 12), 8, (0, 0, 0), -1)
+        cv2.putText(
+            image, f"Bullet point {i + 1} text here", (100, y),
+            cv2.FONT_HERSHEY_SIMPLEX, 1.3, (0, 0, 0), 3,
+        )
+    return image
+
+
+def wait_until(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("時間内に条件を満たしませんでした")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def run_session(tmp_path):
+    """CaptureSession に画像を1ティックずつ渡し、停止後のセッションを返す"""
+    from frame import Frame
+    from session import CaptureSession
+
+    def run(images, folder="out", **options):
+        session = CaptureSession("test", str(tmp_path / folder), **options)
+        session.journal_sync_interval = 0.05  # 保存の確定を待つ時間を短くする
+        session.validate()
+        session.open()
+        session.begin("test")
+        try:
+            for tick, image in enumerate(images):
+                session.process([Frame(image, "BGR")], f"{tick:06d}")
+                # 次のティックの照合に間に合うよう、保存とインデックス登録を待つ
+                wait_until(lambda: session.saved_count == session.metrics.counters["saved"])
+        finally:
+            session.close()
+        return session
+
+    return run
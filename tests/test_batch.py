@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""一括抽出が GUI と同じ判定 (CaptureSession) で保存するか"""
+import json
+import os
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+
+import batch
+from batch import DONE_MARKER, extract_slides
+from conftest import draw_slide
+
+
+def write_frames(folder, images):
+    os.makedirs(folder)
+    for i, image in enumerate(images):
+        cv2.imwrite(os.path.join(folder, f"frame_{i:03d}.png"), image)
+
+
+def test_batch_uses_slide_index(tmp_path):
+    # 箇条書きの追加は保存し、前のスライドへの戻りは既出として保存しない
+    frames = str(tmp_path / "frames")
+    write_frames(frames, [draw_slide(1), draw_slide(2), draw_slide(2, "Agenda"), draw_slide(2)])
+    output = str(tmp_path / "out")
+    result = extract_slides(frames, output, engine_name="block")
+    assert result["error"] is None
+    assert result["frames"] == 4
+    assert result["slides"] == 3
+    assert result["repeats"] == 1
+    saved = [name for name in os.listdir(output) if name.startswith("screenshot_")]
+    assert len(saved) == 3
+    with open(os.path.join(output, DONE_MARKER), encoding="utf-8") as f:
+        assert json.load(f)["slides"] == 3
+
+
+def test_batch_regions(tmp_path):
+    frames = str(tmp_path / "frames")
+    write_frames(frames, [draw_slide(1), draw_slide(2), draw_slide(3), draw_slide(3, "Agenda")])
+    output = str(tmp_path / "out")
+    # 見出し帯だけを見る領域では本文の変化を、本文の領域では見出しの変化を無視する
+    result = extract_slides(
+        frames, output, engine_name="block", regions="title=0,0,1280,110;body=0,110,1280,720"
+    )
+    assert result["error"] is None
+
+    def saved_in(region):
+        return [name for name in os.listdir(os.path.join(output, region)) if name.startswith("screenshot_")]
+
+    assert len(saved_in("title")) == 2
+    assert len(saved_in("body")) == 3
+    assert result["slides"] == 5
+
+
+def test_batch_reads_folder_with_japanese_name(tmp_path):
+    frames = tmp_path / "講義スライド"
+    frames.mkdir()
+    for i, count in enumerate((1, 2)):
+        cv2.imencode(".png", draw_slide(count))[1].tofile(str(frames / f"画面_{i}.png"))
+    result = extract_slides(str(frames), str(tmp_path / "out"), engine_name="block")
+    assert result["error"] is None
+    assert result["frames"] == 2
+    assert result["slides"] == 2
+
+
+def test_batch_rejects_bad_regions(tmp_path):
+    frames = str(tmp_path / "frames")
+    write_frames(frames, [draw_slide(1)])
+    result = extract_slides(frames, str(tmp_path / "out"), regions="bad")
+    assert result["error"]
+    assert not os.path.exists(os.path.join(str(tmp_path / "out"), DONE_MARKER))
+
+
+def test_unfinished_input_restarts_from_scratch(tmp_path):
+    # 中断した入力を再実行しても、前回の保存を既出として扱わず同じ結果になる
+    frames = str(tmp_path / "frames")
+    write_frames(frames, [draw_slide(1), draw_slide(2), draw_slide(3)])
+    output = str(tmp_path / "out")
+    first = extract_slides(frames, output, engine_name="block")
+    os.remove(os.path.join(output, DONE_MARKER))  # 完了前に中断したことにする
+    second = extract_slides(frames, output, engine_name="block")
+    assert first["slides"] == second["slides"] == 3
+    assert second["repeats"] == 0
+    assert len([name for name in os.listdir(output) if name.startswith("screenshot_")]) == 3
+
+
+class BrokenExecutor:
+    """すべての入力でワーカーが異常終了したことにするプロセスプールの代わり"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def submit(self, func, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("worker died"))
+        return future
+
+
+def test_worker_crash_is_recorded_and_summary_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "ProcessPoolExecutor", BrokenExecutor)
+    frames = str(tmp_path / "frames")
+    write_frames(frames, [draw_slide(1)])
+    output = str(tmp_path / "out")
+    assert batch.main([frames, frames, "-o", output]) == 1
+    with open(os.path.join(output, batch.SUMMARY_FILENAME), encoding="utf-8") as f:
+        summary = json.load(f)
+    assert summary["failed"] == 2
+    assert all("BrokenProcessPool" in result["error"] for result in summary["results"])
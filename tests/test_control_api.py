@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import socket
+import threading
+
+import cv2
+import pytest
+
+from conftest import draw_slide, wait_until
+from control_api import ControlClient, ControlError, ControlServer
+from session import CaptureSession, SessionManager
+
+
+@pytest.fixture
+def slides_dir(tmp_path):
+    folder = tmp_path / "slides"
+    folder.mkdir()
+    for number, bullets in enumerate([1, 1, 3, 3, 5]):
+        cv2.imwrite(str(folder / f"{number:03d}.png"), draw_slide(bullets, title=f"Slide {bullets}"))
+    return folder
+
+
+@pytest.fixture
+def server():
+    manager = SessionManager()
+    server = ControlServer(lambda: manager, port=0).start_in_thread()
+    yield server, manager
+    server.stop()
+    manager.stop_all()
+
+
+def collect_events(client, events, until="stopped"):
+    for event in client.events(timeout=10):
+        events.append(event)
+        if event["event"] == until:
+            return
+
+
+def test_events_for_session_started_outside_api(server, slides_dir, tmp_path):
+    # GUI から開始したセッションの保存も、/events だけを購読するクライアントに届く
+    server, manager = server
+    client = ControlClient(port=server.port)
+    events = []
+    listener = threading.Thread(target=collect_events, args=(client, events))
+    listener.start()
+    wait_until(lambda: server.hub._subscribers)
+
+    session = CaptureSession("gui", str(tmp_path / "out"), source=str(slides_dir), engine="block")
+    session.journal_sync_interval = 0.05
+    manager.start_session(session)
+    listener.join(timeout=15)
+
+    saved = [event for event in events if event["event"] == "saved"]
+    assert [event["event"] for event in events][0] == "started"
+    assert len(saved) == session.saved_count == 3
+    assert client.session("gui")["saved_count"] == 3
+
+
+def test_stop_cancels_open_event_streams(server, caplog):
+    server, _ = server
+    client = ControlClient(port=server.port)
+    listener = threading.Thread(target=lambda: list(client.events(timeout=10)), daemon=True)
+    listener.start()
+    wait_until(lambda: server.hub._subscribers)
+    with caplog.at_level(logging.ERROR, logger="asyncio"):
+        server.stop()
+        listener.join(timeout=5)
+    assert not listener.is_alive()
+    assert not server._thread.is_alive()
+    assert not server._streams
+    assert not caplog.records
+
+
+def raw_request(port, head, body=b""):
+    """ヘッダーをそのまま送り、(ステータス, 応答本文) を返す"""
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as sock:
+        sock.sendall(head.encode("latin-1") + b"\r\n" + body)
+        response = b""
+        while chunk := sock.recv(65536):
+            response += chunk
+    status_line, _, rest = response.partition(b"\r\n")
+    return int(status_line.split()[1]), json.loads(rest.partition(b"\r\n\r\n")[2])
+
+
+def test_bad_content_length_is_400(server):
+    server, _ = server
+    status, data = raw_request(
+        server.port, "POST /sessions HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Length: abc\r\n"
+    )
+    assert status == 400 and "Content-Length" in data["error"]
+
+
+@pytest.mark.parametrize("options", [{"folder": ["x"]}, {"folder": "x", "name": 1}, {"stable_ticks": [1]}])
+def test_non_string_options_are_400(server, options):
+    server, _ = server
+    with pytest.raises(ControlError) as error:
+        ControlClient(port=server.port).request("POST", "/sessions", options)
+    assert error.value.status == 400
+
+
+@pytest.mark.parametrize(
+    "header",
+    ["Host: evil.example:8765", "Host: 127.0.0.1\r\nOrigin: http://evil.example", "Origin: null"],
+)
+def test_cross_origin_requests_rejected_without_token(server, header):
+    server, _ = server
+    status, _ = raw_request(server.port, f"GET /status HTTP/1.1\r\n{header}\r\n")
+    assert status == 403
+    status, _ = raw_request(
+        server.port, "GET /status HTTP/1.1\r\nHost: localhost\r\nOrigin: http://127.0.0.1:8765\r\n"
+    )
+    assert status == 200
+
+
+def test_remove_stopped_session(server, slides_dir, tmp_path, monkeypatch):
+    server, manager = server
+    monkeypatch.chdir(tmp_path)  # API の保存フォルダ名はカレントフォルダからの相対パス
+    client = ControlClient(port=server.port)
+    client.start("out", name="replay", source=str(slides_dir), engine="block")
+    with pytest.raises(ControlError) as error:
+        client.remove("nonexistent")
+    assert error.value.status == 404
+    wait_until(lambda: client.session("replay")["state"] == "stopped")
+    assert client.remove("replay") == {"removed": "replay"}
+    assert manager.get("replay") is None
+    assert client.status()["sessions"] == []
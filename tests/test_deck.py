@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""デッキの並べ替えと、完成した PDF / zip の構造"""
+import json
+import re
+import zipfile
+
+import cv2
+import numpy as np
+import pytest
+
+from deck import DeckBuilder, parse_deck_spec
+
+# seq の順に幅を変え、ページの並びを幅で確かめる
+WIDTHS = [160, 200, 240, 280]
+ARRIVAL = [2, 0, 3, 1]  # 保存の確定順 (キャプチャ順と前後する)
+
+
+def write_slides(folder):
+    paths = []
+    for seq, width in enumerate(WIDTHS):
+        path = folder / f"screenshot_{seq}.png"
+        cv2.imwrite(str(path), np.full((90, width, 3), 40 * seq, np.uint8))
+        paths.append(str(path))
+    return paths
+
+
+def build(tmp_path, spec):
+    paths = write_slides(tmp_path)
+    deck_path = str(tmp_path / f"deck.{spec}")
+    builder = DeckBuilder(deck_path, parse_deck_spec(spec), reorder_window=16)
+    for seq in ARRIVAL:
+        builder.add(paths[seq], {"seq": seq, "label": f"label{seq}"})
+    assert builder.finalize(timeout=10) == deck_path
+    assert builder.page_count == len(WIDTHS) and builder.failed_count == 0
+    return deck_path
+
+
+def test_pdf_pages_in_capture_order_with_valid_xref(tmp_path):
+    with open(build(tmp_path, "pdf"), "rb") as f:
+        data = f.read()
+    assert data.startswith(b"%PDF-1.4") and data.rstrip().endswith(b"%%EOF")
+    startxref = int(re.search(rb"startxref\n(\d+)\n%%EOF", data).group(1))
+    assert data[startxref:].startswith(b"xref\n")
+    header = re.match(rb"xref\n0 (\d+)\n", data[startxref:])
+    size = int(header.group(1))
+    entries = data[startxref + header.end():].split(b"\n")[:size]
+    assert entries[0].startswith(b"0000000000 65535 f")
+    offsets = {}
+    for obj_id, entry in enumerate(entries[1:], start=1):
+        offset = int(entry[:10])
+        assert data[offset:].startswith(f"{obj_id} 0 obj\n".encode("ascii"))
+        offsets[obj_id] = offset
+    assert re.search(rb"/Size (\d+)", data[startxref:]).group(1) == str(size).encode("ascii")
+
+    def body(obj_id):
+        start = offsets[obj_id]
+        return data[start:data.index(b"endobj", start)]
+
+    catalog_root = int(re.search(rb"/Root (\d+) 0 R", data[startxref:]).group(1))
+    pages_id = int(re.search(rb"/Pages (\d+) 0 R", body(catalog_root)).group(1))
+    kids = [int(kid) for kid in re.findall(rb"(\d+) 0 R", body(pages_id).split(b"/Kids")[1])]
+    assert len(kids) == len(WIDTHS)
+    page_widths = [
+        float(re.search(rb"/MediaBox \[0 0 ([\d.]+)", body(kid)).group(1)) for kid in kids
+    ]
+    # dpi=144 では 1 ピクセル = 0.5 pt
+    assert page_widths == [width / 2 for width in WIDTHS]
+
+
+def test_zip_manifest_in_capture_order(tmp_path):
+    with zipfile.ZipFile(build(tmp_path, "zip")) as bundle:
+        assert bundle.testzip() is None
+        manifest = json.loads(bundle.read("manifest.json"))
+        slides = manifest["slides"]
+        assert [entry["file"] for entry in slides] == [f"screenshot_{seq}.png" for seq in range(4)]
+        assert [entry["page"] for entry in slides] == [1, 2, 3, 4]
+        assert [entry["label"] for entry in slides] == [f"label{seq}" for seq in range(4)]
+        for entry, width in zip(slides, WIDTHS):
+            image = cv2.imdecode(np.frombuffer(bundle.read(entry["entry"]), np.uint8), cv2.IMREAD_COLOR)
+            assert image.shape[1] == width
+
+
+@pytest.mark.parametrize("spec", ["pdf", "zip"])
+def test_empty_deck_is_not_written(tmp_path, spec):
+    builder = DeckBuilder(str(tmp_path / f"deck.{spec}"), parse_deck_spec(spec))
+    assert builder.finalize(timeout=10) is None
+    assert list(tmp_path.iterdir()) == []
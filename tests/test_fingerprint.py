@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import cv2
+
+from conftest import draw_slide
+from fingerprint import FingerprintEngine
+
+SIZE_4K = (3840, 2160)
+
+
+def slide_4k(bullets, title="Quarterly results"):
+    """draw_slide の 1280x720 の構図をそのまま 4K に拡大する"""
+    return cv2.resize(draw_slide(bullets, title), SIZE_4K, interpolation=cv2.INTER_LINEAR)
+
+
+def test_reference_keeps_only_quarter_scale_detail():
+    engine = FingerprintEngine()
+    reference = engine.to_reference(engine.prepare(slide_4k(3)))
+    assert reference.detail.shape == (540, 960)
+    assert reference.nbytes < 1024 * 1024
+
+
+def test_cursor_is_similar_and_new_slide_is_not():
+    # draw_slide は白地が大半で、箇条書き1行の追加は詳細画像の 1% ほどしか変えない
+    engine = FingerprintEngine(threshold=0.995)
+    reference = engine.to_reference(engine.prepare(slide_4k(3)))
+    with_cursor = slide_4k(3)
+    cv2.rectangle(with_cursor, (1920, 1080), (1944, 1120), (0, 0, 0), -1)
+    assert engine.is_similar(engine.prepare(with_cursor), reference)
+    assert not engine.is_similar(engine.prepare(slide_4k(4)), reference)
+    assert not engine.is_similar(engine.prepare(slide_4k(3, title="Agenda")), reference)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""さかのぼり保存用のフレームとプールの上限を、超える前に守るか"""
+import numpy as np
+import pytest
+from PIL import Image
+
+from frame import Frame, frame_from_pil
+from frame_pool import FramePool, FrameRingBuffer, PoolExhaustedError
+
+
+def make_frame(nbytes=1000):
+    return Frame(np.zeros((nbytes // 4, 4), np.uint8), "GRAY")
+
+
+def test_ring_buffer_evicts_before_admitting():
+    ring = FrameRingBuffer(seconds=60.0, max_frames=100, max_bytes=3000)
+    peak = 0
+    for tick in range(10):
+        assert ring.push([make_frame()], f"{tick}", timestamp=tick)
+        peak = max(peak, ring.nbytes)
+    assert peak <= 3000
+    assert [label for label, _ in ring.snapshot()] == ["7", "8", "9"]
+
+
+def test_ring_buffer_rejects_oversized_tick():
+    ring = FrameRingBuffer(seconds=60.0, max_frames=100, max_bytes=3000)
+    ring.push([make_frame()], "0", timestamp=0)
+    assert not ring.push([make_frame(4000)], "1", timestamp=1)
+    assert len(ring) == 0 and ring.nbytes == 0
+
+
+def test_pil_frames_count_against_pool_limit():
+    pool = FramePool(max_bytes=2 * 64 * 64 * 3)
+    image = Image.new("RGB", (64, 64), (10, 20, 30))
+    held = [frame_from_pil(image, pool), frame_from_pil(image, pool)]
+    assert pool.allocated_bytes == 2 * 64 * 64 * 3
+    assert held[0].data[0, 0].tolist() == [10, 20, 30]
+    with pytest.raises(PoolExhaustedError):
+        frame_from_pil(image, pool)
+    # 手放したバッファは使い回す
+    held.pop()
+    frame_from_pil(image, pool)
+    assert pool.reused_count == 1 and pool.allocated_count == 2
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""ジャーナル経由の保存と、クラッシュ後の recover()"""
+import json
+import os
+
+from conftest import draw_slide
+from frame import Frame
+from journal import JOURNAL_FILENAME, SessionJournal, recover, temp_path_for
+from session import CaptureSession
+
+
+def write_saves(folder, names, sync_interval=0.05):
+    """names の各ファイルを一時ファイル経由で確定し、ジャーナルを閉じる"""
+    journal = SessionJournal(str(folder), sync_interval=sync_interval)
+    journal.log_event("start", session="test")
+    committed = []
+    for number, name in enumerate(names):
+        path = str(folder / name)
+        with open(temp_path_for(path), "wb") as f:
+            f.write(b"x" * (100 + number))
+        journal.commit(
+            temp_path_for(path), path, {"type": "saved", "bytes": 100 + number}, on_commit=committed.append
+        )
+    assert journal.close(timeout=5)
+    return committed
+
+
+def test_commit_renames_and_records(tmp_path):
+    committed = write_saves(tmp_path, ["a.png", "b.png"])
+    assert sorted(os.path.basename(path) for path in committed) == ["a.png", "b.png"]
+    assert sorted(os.listdir(tmp_path)) == ["a.png", "b.png", JOURNAL_FILENAME]
+    with open(tmp_path / JOURNAL_FILENAME, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [r["file"] for r in records if r["type"] == "saved"] == ["a.png", "b.png"]
+
+
+def test_recover_after_crash(tmp_path):
+    write_saves(tmp_path, ["a.png", "b.png", "c.png"])
+    # クラッシュを模す: 確定前の一時ファイル、追記途中の行、消えたファイル
+    with open(temp_path_for(str(tmp_path / "d.png")), "wb") as f:
+        f.write(b"partial")
+    with open(tmp_path / JOURNAL_FILENAME, "a", encoding="utf-8") as f:
+        f.write('{"type": "saved", "file": "d.pn')
+    os.remove(tmp_path / "b.png")
+
+    state = recover(str(tmp_path))
+    assert state.removed_temp_files == 1
+    assert not os.path.exists(temp_path_for(str(tmp_path / "d.png")))
+    assert state.missing_files == 1
+    assert list(state.saved) == ["a.png", "c.png"]
+    assert state.saved_count == 2
+    assert state.total_bytes == 100 + 102
+    assert state.last_saved_filename == "c.png"
+    assert state.sessions == 1
+
+
+def test_session_restores_folder_total(tmp_path):
+    folder = tmp_path / "out"
+    for run, bullets in enumerate([(1, 2), (3,)]):
+        session = CaptureSession("test", str(folder), engine="block")
+        session.journal_sync_interval = 0.05
+        session.validate()
+        session.open()
+        session.begin("test")
+        for tick, count in enumerate(bullets):
+            session.process([Frame(draw_slide(count), "BGR")], f"{run}_{tick}")
+        session.close()
+    status = session.status()
+    assert status["saved_count"] == 1
+    assert status["folder_total"] == 3
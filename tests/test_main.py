@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""main.py を import しただけでは (spawn のワーカーなど) ログ出力先を設定しないか"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_does_not_open_log_file(tmp_path):
+    code = (
+        "import logging, main; "
+        "print(len(logging.getLogger().handlers))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=tmp_path,
+        env=dict(os.environ, PYTHONPATH=ROOT),
+        stdout=subprocess.PIPE,
+        text=True,
+        timeout=60,
+        check=True,
+    )
+    assert completed.stdout.strip() == "0"
+    assert not (tmp_path / "slide_capture_app.log").exists()
+
+
+def test_load_capture_modules_returns_namespace():
+    import main
+
+    capture = main.load_capture_modules()
+    assert capture.SessionManager and capture.SessionError and capture.sanitize_folder_name
+    assert main.load_capture_modules() is capture
+    assert main.capture_modules_loaded_at is not None
+    # 遅延読み込みした名前を main の名前空間に注入しない
+    assert not hasattr(main, "SessionManager")
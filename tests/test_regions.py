@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from PIL import Image
+
+import regions
+from frame_source import ScreenSource
+from regions import FULL_SCREEN, CaptureRegion
+
+# 仮想デスクトップ: プライマリ (0,0)-(1920,1080) と、左上にずれたセカンダリ (-1280,-200)-(0,824)
+PRIMARY = (0, 0, 1920, 1080)
+SECONDARY = (-1280, -200, 0, 824)
+DESKTOP = (-1280, -200, 1920, 1080)
+
+
+class FakeImageGrab:
+    """仮想デスクトップの座標ごとに異なる色を返す ImageGrab"""
+
+    def __init__(self):
+        left, top, right, bottom = DESKTOP
+        desktop = np.zeros((bottom - top, right - left, 3), np.uint8)
+        desktop[..., 0] = (np.arange(right - left) % 251)[None, :]
+        desktop[..., 1] = (np.arange(bottom - top) % 241)[:, None]
+        desktop[..., 2] = 0
+        desktop[0 - top:1080 - top, 0 - left:1920 - left, 2] = 200  # プライマリ
+        self.desktop = desktop
+        self.calls = []
+
+    def pixels(self, bbox):
+        left, top, right, bottom = bbox
+        return self.desktop[top - DESKTOP[1]:bottom - DESKTOP[1], left - DESKTOP[0]:right - DESKTOP[0]]
+
+    def grab(self, bbox=None, all_screens=False):
+        self.calls.append((bbox, all_screens))
+        if not all_screens:
+            bbox = bbox or PRIMARY
+        return Image.fromarray(np.ascontiguousarray(self.pixels(bbox or DESKTOP)))
+
+
+@pytest.fixture
+def fake_screen(monkeypatch):
+    grab = FakeImageGrab()
+    monkeypatch.setattr(regions, "ImageGrab", grab)
+    monkeypatch.setattr(regions, "primary_screen_bbox", lambda: PRIMARY)
+    return grab
+
+
+def test_mixed_full_screen_and_off_primary_rect(fake_screen):
+    rect = CaptureRegion("left", (-1200, -150, -200, 600))
+    frames = ScreenSource([FULL_SCREEN, rect]).read()
+
+    # 1回の取得で、両方の領域を仮想デスクトップから切り出す
+    assert len(fake_screen.calls) == 1
+    assert fake_screen.calls[0][1] is True
+    assert frames[0].shape[:2] == (1080, 1920)
+    assert np.array_equal(frames[0].data, fake_screen.pixels(PRIMARY))
+    assert frames[1].shape[:2] == (750, 1000)
+    assert np.array_equal(frames[1].data, fake_screen.pixels(rect.bbox))
+
+
+def test_full_screen_only_grabs_primary(fake_screen):
+    frames = ScreenSource([FULL_SCREEN]).read()
+    assert fake_screen.calls == [(None, False)]
+    assert frames[0].shape[:2] == (1080, 1920)
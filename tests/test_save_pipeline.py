@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""保存パイプラインのキュー満杯時の動作と停止時の書き込み"""
+import os
+import threading
+import time
+
+import numpy as np
+
+from journal import SessionJournal
+from save_pipeline import POLICY_BLOCK, POLICY_DROP_OLDEST, SaveWorkerPool
+
+
+class SlowEncoder:
+    """release() されるまでエンコードを止めるエンコーダーの代わり"""
+
+    name = "stub"
+    extension = ".bin"
+
+    def __init__(self, delays=None):
+        self.started = threading.Event()
+        self.released = threading.Event()
+        self.delays = delays or {}  # 画像の値 -> エンコードにかける秒数
+
+    def release(self):
+        self.released.set()
+
+    def encode(self, image):
+        self.started.set()
+        self.released.wait(5)
+        time.sleep(self.delays.get(int(image[0, 0, 0]), 0))
+        return np.frombuffer(image.tobytes(), dtype=np.uint8)
+
+
+def image(value):
+    return np.full((4, 4, 3), value, np.uint8)
+
+
+def test_drop_oldest_with_queue_of_one(tmp_path):
+    encoder = SlowEncoder()
+    saved = []
+    pool = SaveWorkerPool(
+        workers=1,
+        max_queue=1,
+        policy=POLICY_DROP_OLDEST,
+        encoder=encoder,
+        on_saved=lambda path, info: saved.append((os.path.basename(path), info["seq"])),
+    )
+    pool.submit(str(tmp_path / "0.bin"), image(0))
+    assert encoder.started.wait(5)  # 0 はワーカーがエンコード中
+    for value in (1, 2, 3):
+        assert pool.submit(str(tmp_path / f"{value}.bin"), image(value))
+    # キューに入るのは1件だけ。1 と 2 は新しいフレームに押し出される
+    assert pool.dropped_count == 2
+    assert pool.queue_depth == 1
+    encoder.release()
+    assert pool.shutdown(timeout=5)
+    assert saved == [("0.bin", 0), ("3.bin", 3)]
+    assert pool.saved_count == 2
+    assert sorted(os.listdir(tmp_path)) == ["0.bin", "3.bin"]
+
+
+def test_shutdown_flushes_queue_and_keeps_capture_order(tmp_path):
+    # 先に積んだフレームほどエンコードに時間がかかり、完了順は逆になる
+    encoder = SlowEncoder(delays={0: 0.3, 1: 0.15, 2: 0.0})
+    journal = SessionJournal(str(tmp_path), sync_interval=0.01)
+    saved = []
+    pool = SaveWorkerPool(
+        workers=3,
+        max_queue=1,
+        policy=POLICY_BLOCK,
+        encoder=encoder,
+        journal=journal,
+        on_saved=lambda path, info: saved.append(info["seq"]),
+    )
+    for value in range(3):
+        pool.submit(str(tmp_path / f"{value}.bin"), image(value))
+    encoder.release()
+    assert pool.shutdown(timeout=5)
+    journal.close(timeout=5)
+    assert sorted(saved) == [0, 1, 2]
+    assert saved != [0, 1, 2]  # 完了は順不同
+    assert pool.saved_count == 3 and pool.dropped_count == 0
+    # 最新のファイル名は完了順ではなくキャプチャ順で決まる
+    assert pool.last_saved_filename == "2.bin"
+    assert pool.submit(str(tmp_path / "late.bin"), image(9)) is False
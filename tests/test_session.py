@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""SessionManager とキャプチャループの停止・一覧"""
+import os
+import time
+
+import cv2
+import pytest
+
+from conftest import draw_slide, wait_until
+from frame import Frame
+from frame_source import FrameSource
+from session import STATE_STOPPED, CaptureSession, SessionManager
+
+
+class FailingSource(FrameSource):
+    """毎回取得に失敗する入力 (画面キャプチャのエラーを模す)"""
+
+    description = "失敗する入力"
+
+    def read(self):
+        self.frames_read += 1
+        raise OSError("grab failed")
+
+
+def test_stop_after_capture_error_does_not_wait_for_backoff(tmp_path):
+    manager = SessionManager()
+    source = FailingSource()
+    session = CaptureSession("failing", str(tmp_path / "out"))
+    manager.start_session(session, source)
+    wait_until(lambda: session.metrics.counters["errors"] >= 1)
+    time.sleep(0.1)  # エラー後の待機 (5 秒) に入るまで待つ
+    start = time.monotonic()
+    manager.stop_session("failing")
+    assert time.monotonic() - start < 2.0
+    assert session.state == STATE_STOPPED
+    assert source.frames_read == 1
+
+
+def test_stopped_sessions_are_pruned(tmp_path):
+    manager = SessionManager()
+    manager.max_stopped_sessions = 2
+    for number in range(4):
+        session = CaptureSession(f"s{number}", str(tmp_path / f"out{number}"))
+        manager.start_session(session, FailingSource())
+        manager.stop_session(session.name)
+    assert [session.name for session in manager.snapshot()] == ["s2", "s3"]
+
+
+def test_index_references_stay_within_byte_budget(tmp_path):
+    session = CaptureSession("refs", str(tmp_path / "out"), engine="full")
+    session.validate()
+    slides = [draw_slide(count, size=(320, 180)) for count in range(1, 5)]
+    # フル解像度の参照は画像と比較用の輝度画像
+    slide_bytes = slides[0].nbytes + slides[0].nbytes // 3
+    session.open(reference_max_bytes=slide_bytes * 5 // 2)
+    state = session.region_states[0]
+    for number, slide in enumerate(slides):
+        cv2.imwrite(os.path.join(state.save_path, f"{number}.png"), slide)
+    for number, slide in enumerate(slides):
+        current = session.comparator.prepare(Frame(slide, "BGR"))
+        assert session.confirm_repeat(state, current, f"{number}.png")
+    # 件数の上限 (4) より先にバイト数の上限で古い参照を手放す
+    assert list(state.index_references) == ["2.png", "3.png"]
+    assert session.reference_bytes == 2 * slide_bytes
+    # 1件で上限を超える参照は比較には使うが保持しない
+    session.reference_max_bytes = slide_bytes // 2
+    state.index_references.clear()
+    assert session.confirm_repeat(state, current, "3.png")
+    assert session.reference_bytes == 0
+    session.close()
+
+
+def test_memory_limit_applies_to_running_loop(tmp_path):
+    manager = SessionManager()
+    session = CaptureSession("limit", str(tmp_path / "out"))
+    manager.start_session(session, FailingSource())
+    manager.set_memory_limit(256)
+    assert session.loop.memory_limit_mb == 256
+    with pytest.raises(ValueError):
+        manager.set_memory_limit(-1)
+    assert manager.memory_limit_mb == 256
+    manager.stop_session("limit")
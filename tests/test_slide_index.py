@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import cv2
+import pytest
+
+from conftest import draw_slide, wait_until
+from session import STATE_STOPPED, CaptureSession, SessionManager
+from slide_index import hamming, slide_key
+
+
+def test_reveal_hashes_collide():
+    # 箇条書きを1行追加したスライドはハッシュだけでは元のスライドと区別できない
+    base, reveal = slide_key(draw_slide(3)), slide_key(draw_slide(4))
+    assert hamming(base.coarse, reveal.coarse) <= 4
+    assert hamming(base.fine, reveal.fine) <= 10
+
+
+@pytest.mark.parametrize("engine", ["block", "ssim"])
+def test_incremental_reveal_is_saved(run_session, engine):
+    session = run_session([draw_slide(3), draw_slide(4), draw_slide(5)], engine=engine)
+    status = session.status()
+    assert status["saved_count"] == 3
+    assert status["repeat_count"] == 0
+
+
+@pytest.mark.parametrize("engine", ["block", "ssim"])
+def test_return_to_previous_slide_is_repeat(run_session, engine):
+    session = run_session([draw_slide(3), draw_slide(4), draw_slide(3)], engine=engine)
+    status = session.status()
+    assert status["saved_count"] == 2
+    assert status["repeat_count"] == 1
+
+
+def test_replay_waits_for_saves_before_matching(tmp_path):
+    # 実時間より速い再生でも、直前に保存したスライドへの戻りを既出として扱う
+    folder = tmp_path / "slides"
+    folder.mkdir()
+    for number, image in enumerate([draw_slide(3), draw_slide(4), draw_slide(3), draw_slide(4)]):
+        cv2.imwrite(str(folder / f"{number:03d}.png"), image)
+    session = CaptureSession("replay", str(tmp_path / "out"), source=str(folder), engine="block")
+    manager = SessionManager()
+    manager.start_session(session)
+    wait_until(lambda: session.state == STATE_STOPPED)
+    status = session.status()
+    assert status["saved_count"] == 2
+    assert status["repeat_count"] == 2
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import cv2
+import numpy as np
+import pytest
+
+from conftest import draw_slide
+from fingerprint import StableFrameGate
+
+
+def noisy_frames(image, count, seed=0):
+    """圧縮ノイズ・カーソルの点滅・サブピクセル移動を加えた、静止した画面のフレーム列"""
+    rng = np.random.default_rng(seed)
+    height, width = image.shape[:2]
+    frames = []
+    for number in range(count):
+        frame = image.copy()
+        if number % 2:
+            cv2.rectangle(frame, (width // 2, height // 2), (width // 2 + 12, height // 2 + 20), (0, 0, 0), -1)
+        shift = np.float32([[1, 0, rng.uniform(-0.5, 0.5)], [0, 1, rng.uniform(-0.5, 0.5)]])
+        frame = cv2.warpAffine(frame, shift, (width, height), borderMode=cv2.BORDER_REPLICATE)
+        frame = np.clip(frame + rng.normal(0.0, 2.0, frame.shape), 0, 255).astype(np.uint8)
+        _, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, int(rng.integers(70, 86))])
+        frames.append(cv2.imdecode(encoded, cv2.IMREAD_COLOR))
+    return frames
+
+
+def test_noisy_static_frames_are_confirmed():
+    gate = StableFrameGate(stable_ticks=2)
+    results = [gate.confirm(frame) for frame in noisy_frames(draw_slide(3), 3)]
+    assert results == [False, False, True]
+
+
+def test_crossfade_is_held_until_stable():
+    before, after = draw_slide(2, title="Before"), draw_slide(5, title="After")
+    fade = [cv2.addWeighted(before, 1.0 - step, after, step, 0) for step in (0.25, 0.5, 0.75)]
+    gate = StableFrameGate(stable_ticks=2)
+    assert not any(gate.confirm(frame) for frame in fade)
+    assert [gate.confirm(after) for _ in range(3)] == [False, False, True]
+
+
+def test_wait_is_capped():
+    gate = StableFrameGate(stable_ticks=2, max_wait=4)
+    frames = [draw_slide(bullets) for bullets in range(6)]
+    assert [gate.confirm(frame) for frame in frames] == [False] * 4 + [True, False]
+
+
+@pytest.mark.parametrize("engine", ["fingerprint", "full"])
+def test_strict_engines_save_noisy_static_slide(run_session, engine):
+    # 1階調の差も変化とみなすエンジンでも、ノイズのある静止画面は保存される
+    session = run_session(noisy_frames(draw_slide(3), 8), engine=engine, stable_ticks=2)
+    assert session.saved_count >= 1